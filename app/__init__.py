@@ -1,19 +1,50 @@
 import logging
+from datetime import datetime, timedelta
 
 import stripe
 from fastapi import FastAPI
 
 from app.bootstrap import cors, exceptions
-from app.environ import STRIPE_PRIVATE_KEY
+from app.database import async_session_factory
+from app.environ import (ABANDONED_CART_DAYS, CART_SWEEP_BATCH_SIZE,
+                         CART_SWEEP_INTERVAL_SECONDS, JOB_BATCH_SIZE,
+                         JOB_POLL_INTERVAL_SECONDS, JOB_WORKERS,
+                         RESERVATION_SWEEP_BATCH_SIZE,
+                         RESERVATION_SWEEP_INTERVAL_SECONDS,
+                         STOCK_RECONCILE_INTERVAL_SECONDS,
+                         STRIPE_EVENT_BATCH_SIZE,
+                         STRIPE_EVENT_INTERVAL_SECONDS,
+                         STRIPE_EVENT_PRUNE_BATCH_SIZE,
+                         STRIPE_EVENT_PRUNE_INTERVAL_SECONDS,
+                         STRIPE_EVENT_RETENTION_DAYS,
+                         STRIPE_OUTBOX_BATCH_SIZE,
+                         STRIPE_OUTBOX_INTERVAL_SECONDS, STRIPE_PRIVATE_KEY,
+                         STRIPE_RECONCILE_INTERVAL_SECONDS,
+                         STRIPE_RECONCILE_LOOKBACK_DAYS)
+from app.inventory import (delete_abandoned_carts, reconcile_stock_shards,
+                           release_expired_reservations)
+from app.jobs import job_queue
 from app.routes.authentication import auth_router
 from app.routes.cart import cart_router
 from app.routes.category import category_router
+from app.routes.guest_cart import guest_cart_router
+from app.routes.metrics import metrics_router
 from app.routes.order import order_router
 from app.routes.product import product_router
 from app.routes.search import search_router
 from app.routes.user import user_router
 from app.routes.webhook import webhook_router
+from app.search.bm25 import rebuild_bm25_index
+from app.search.cache import (listen_for_catalog_changes,
+                              stop_listening_for_catalog_changes)
+from app.scheduler import scheduler
+from app.search.suggest import rebuild_suggestion_index
 from app.stripe_config import StripeShippingRateError, load_shipping_rates
+from app.stripe_customers import dispatch_customers
+from app.stripe_events import (RECONCILE_PAGE_SIZE, process_stripe_events,
+                               prune_stripe_events, reconcile_stripe_events,
+                               settle_expired_checkouts)
+from app.stripe_gateway import stripe_gateway
 
 stripe.api_key = STRIPE_PRIVATE_KEY
 
@@ -38,23 +69,122 @@ app = FastAPI(
 app.include_router(order_router, prefix="/order", tags=["order"])
 app.include_router(webhook_router, prefix="/webhook", tags=["webhook"])
 app.include_router(cart_router, prefix="/cart", tags=["cart"])
+app.include_router(guest_cart_router, prefix="/guest-cart", tags=["cart"])
 app.include_router(auth_router, prefix="/auth", tags=["authentication"])
 app.include_router(user_router, prefix="/user", tags=["user"])
 app.include_router(search_router, prefix="/search", tags=["search"])
 app.include_router(category_router, prefix="/category", tags=["category"])
 app.include_router(product_router, prefix="/product", tags=["product"])
+app.include_router(metrics_router, prefix="/metrics", tags=["metrics"])
 
 cors.setup_cors(app)
 exceptions.setup_exception_handlers(app)
 
 
 @app.on_event("startup")
-def on_startup(): # pragma: no cover
+async def on_startup(): # pragma: no cover
     try:
-        load_shipping_rates()
+        await load_shipping_rates()
     except StripeShippingRateError:
         logger = logging.getLogger("uvicorn.error")
         logger.warning("Not all shipping options are available. Make sure "
                        + "to follow the README and restart the container after running "
                        + "`docker compose exec backend python manage stripe setup` to setup "
                        + "the shipping options in Stripe.")
+
+
+@app.on_event("startup")
+async def build_search_indexes(): # pragma: no cover
+    async with async_session_factory() as db:
+        await rebuild_suggestion_index(db)
+        await rebuild_bm25_index(db)
+    await listen_for_catalog_changes()
+
+
+@scheduler.every(STOCK_RECONCILE_INTERVAL_SECONDS)
+async def reconcile_stock(): # pragma: no cover
+    async with async_session_factory() as db:
+        await reconcile_stock_shards(db)
+        await db.commit()
+
+
+@scheduler.every(RESERVATION_SWEEP_INTERVAL_SECONDS)
+async def release_expired_holds(): # pragma: no cover
+    # the carts still in checkout are only released once their session expired at Stripe
+    async with async_session_factory() as db:
+        await settle_expired_checkouts(db, RESERVATION_SWEEP_BATCH_SIZE)
+
+    # one short transaction per batch, so carts are never locked for long
+    while True:
+        async with async_session_factory() as db:
+            released = await release_expired_reservations(db, RESERVATION_SWEEP_BATCH_SIZE)
+            await db.commit()
+        if released < RESERVATION_SWEEP_BATCH_SIZE:
+            break
+
+
+@scheduler.every(CART_SWEEP_INTERVAL_SECONDS)
+async def sweep_abandoned_carts(): # pragma: no cover
+    older_than = datetime.utcnow() - timedelta(days=ABANDONED_CART_DAYS)
+    while True:
+        async with async_session_factory() as db:
+            deleted = await delete_abandoned_carts(db, older_than, CART_SWEEP_BATCH_SIZE)
+            await db.commit()
+        if deleted < CART_SWEEP_BATCH_SIZE:
+            break
+
+
+@scheduler.every(STRIPE_OUTBOX_INTERVAL_SECONDS)
+async def dispatch_stripe_customers(): # pragma: no cover
+    while True:
+        async with async_session_factory() as db:
+            dispatched = await dispatch_customers(db, STRIPE_OUTBOX_BATCH_SIZE)
+            await db.commit()
+        if dispatched < STRIPE_OUTBOX_BATCH_SIZE:
+            break
+
+
+@scheduler.every(STRIPE_EVENT_INTERVAL_SECONDS)
+async def process_webhook_events(): # pragma: no cover
+    while True:
+        async with async_session_factory() as db:
+            processed = await process_stripe_events(db, STRIPE_EVENT_BATCH_SIZE)
+            await db.commit()
+        if processed < STRIPE_EVENT_BATCH_SIZE:
+            break
+
+
+@scheduler.every(STRIPE_EVENT_PRUNE_INTERVAL_SECONDS)
+async def prune_webhook_events(): # pragma: no cover
+    older_than = datetime.utcnow() - timedelta(days=STRIPE_EVENT_RETENTION_DAYS)
+    while True:
+        async with async_session_factory() as db:
+            pruned = await prune_stripe_events(db, older_than, STRIPE_EVENT_PRUNE_BATCH_SIZE)
+            await db.commit()
+        if pruned < STRIPE_EVENT_PRUNE_BATCH_SIZE:
+            break
+
+
+@scheduler.every(STRIPE_RECONCILE_INTERVAL_SECONDS)
+async def reconcile_webhook_events(): # pragma: no cover
+    since = datetime.utcnow() - timedelta(days=STRIPE_RECONCILE_LOOKBACK_DAYS)
+    while True:
+        async with async_session_factory() as db:
+            fetched = await reconcile_stripe_events(db, RECONCILE_PAGE_SIZE, since)
+            await db.commit()
+        if fetched is None or fetched < RECONCILE_PAGE_SIZE:
+            break
+
+
+@app.on_event("startup")
+async def start_scheduler(): # pragma: no cover
+    scheduler.start()
+    job_queue.start(JOB_WORKERS, JOB_BATCH_SIZE, JOB_POLL_INTERVAL_SECONDS)
+
+
+@app.on_event("shutdown")
+async def on_shutdown(): # pragma: no cover
+    await scheduler.stop()
+    await job_queue.stop()
+    await stop_listening_for_catalog_changes()
+    stripe_gateway.shutdown()
@@ -5,6 +5,7 @@ from fastapi.responses import JSONResponse
 from pydantic import ValidationError
 
 from app.exceptions import JSONException
+from app.stripe_gateway import StripeTimeoutError
 
 
 async def validation_exception_handler(request, exc):
@@ -15,8 +16,13 @@ async def json_exception_handler(request, exc):
     return JSONResponse([exc.body], status_code=exc.code)
 
 
+async def stripe_timeout_handler(request, exc):
+    return JSONResponse({"detail": "The payment provider took too long to respond"}, status_code=504)
+
+
 def setup_exception_handlers(app):
     app.add_exception_handler(RequestValidationError,
                               validation_exception_handler)
     app.add_exception_handler(ValidationError, validation_exception_handler)
     app.add_exception_handler(JSONException, json_exception_handler)
+    app.add_exception_handler(StripeTimeoutError, stripe_timeout_handler)
@@ -57,8 +57,61 @@ JWT_SECRET = getenv('JWT_SECRET')
 JWT_EXPIRE_TIMEOUT_MINUTES = int(getenv('JWT_EXPIRE_TIMEOUT_MINUTES', 60))
 STRIPE_PRIVATE_KEY = getenv('STRIPE_PRIVATE_KEY')
 STRIPE_SIGNING_KEY = getenv('STRIPE_SIGNING_KEY')
+# the number of concurrent calls to Stripe, and how long one may take
+STRIPE_MAX_WORKERS = int(getenv('STRIPE_MAX_WORKERS', 8))
+STRIPE_TIMEOUT_SECONDS = float(getenv('STRIPE_TIMEOUT_SECONDS', 10))
+# how often the customers of new users are created in Stripe, and how many per transaction
+STRIPE_OUTBOX_INTERVAL_SECONDS = float(getenv('STRIPE_OUTBOX_INTERVAL_SECONDS', 5))
+STRIPE_OUTBOX_BATCH_SIZE = int(getenv('STRIPE_OUTBOX_BATCH_SIZE', 50))
+# how often the stored webhook events are processed, and how many per transaction
+STRIPE_EVENT_INTERVAL_SECONDS = float(getenv('STRIPE_EVENT_INTERVAL_SECONDS', 1))
+STRIPE_EVENT_BATCH_SIZE = int(getenv('STRIPE_EVENT_BATCH_SIZE', 100))
+# stripe retries an event for 3 days, processed events are remembered for longer and then pruned
+STRIPE_EVENT_RETENTION_DAYS = float(getenv('STRIPE_EVENT_RETENTION_DAYS', 30))
+STRIPE_EVENT_PRUNE_INTERVAL_SECONDS = float(getenv('STRIPE_EVENT_PRUNE_INTERVAL_SECONDS', 60 * 60))
+STRIPE_EVENT_PRUNE_BATCH_SIZE = int(getenv('STRIPE_EVENT_PRUNE_BATCH_SIZE', 1000))
+# how often the events the webhook missed are fetched from Stripe, and how far back the first run looks
+STRIPE_RECONCILE_INTERVAL_SECONDS = float(getenv('STRIPE_RECONCILE_INTERVAL_SECONDS', 5 * 60))
+STRIPE_RECONCILE_LOOKBACK_DAYS = float(getenv('STRIPE_RECONCILE_LOOKBACK_DAYS', 3))
+# how many event IDs every process remembers, to answer redeliveries without a write
+STRIPE_EVENT_RECENT_IDS = int(getenv('STRIPE_EVENT_RECENT_IDS', 10000))
 
 BASE_URL_UI = getenv('BASE_URL_UI')
 BASE_URL_API = getenv('BASE_URL_API')
 
 POSITIONSTACK_API_KEY = getenv('POSITIONSTACK_API_KEY')
+
+SEARCH_CACHE_TTL_SECONDS = float(getenv('SEARCH_CACHE_TTL_SECONDS', 60))
+SEARCH_CACHE_MAX_BYTES = int(getenv('SEARCH_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+
+# which engine serves the `fulltext` search mode, `postgres` or the in memory `bm25` index
+SEARCH_BACKEND = getenv('SEARCH_BACKEND', 'postgres')
+if SEARCH_BACKEND not in ['postgres', 'bm25']: # pragma: no cover
+    raise EnvironmentError(
+        f'Invalid search backend "{SEARCH_BACKEND}" found in the environment variable "SEARCH_BACKEND".')
+
+PAGE_COUNT_CACHE_TTL_SECONDS = float(getenv('PAGE_COUNT_CACHE_TTL_SECONDS', 60))
+PAGE_COUNT_ESTIMATE_THRESHOLD = int(getenv('PAGE_COUNT_ESTIMATE_THRESHOLD', 1000))
+
+# how often the stock of sharded products is copied back into Product.quantity
+STOCK_RECONCILE_INTERVAL_SECONDS = float(getenv('STOCK_RECONCILE_INTERVAL_SECONDS', 5))
+
+# how long adding to the cart holds the stock, and how often expired holds are given back
+CART_RESERVATION_MINUTES = float(getenv('CART_RESERVATION_MINUTES', 60))
+RESERVATION_SWEEP_INTERVAL_SECONDS = float(getenv('RESERVATION_SWEEP_INTERVAL_SECONDS', 60))
+RESERVATION_SWEEP_BATCH_SIZE = int(getenv('RESERVATION_SWEEP_BATCH_SIZE', 500))
+
+# carts untouched for this long are deleted, along with their items
+ABANDONED_CART_DAYS = float(getenv('ABANDONED_CART_DAYS', 30))
+CART_SWEEP_INTERVAL_SECONDS = float(getenv('CART_SWEEP_INTERVAL_SECONDS', 60 * 60))
+CART_SWEEP_BATCH_SIZE = int(getenv('CART_SWEEP_BATCH_SIZE', 500))
+
+# the workers running the background jobs inside every app process, 0 leaves them to `manage worker`
+JOB_WORKERS = int(getenv('JOB_WORKERS', 2))
+JOB_BATCH_SIZE = int(getenv('JOB_BATCH_SIZE', 10))
+JOB_POLL_INTERVAL_SECONDS = float(getenv('JOB_POLL_INTERVAL_SECONDS', 1))
+# how long a worker owns the jobs it claimed before they are handed to another one
+JOB_LEASE_SECONDS = float(getenv('JOB_LEASE_SECONDS', 5 * 60))
+
+# how long the cart of a shopper who isn't logged in is kept in their browser
+GUEST_CART_COOKIE_DAYS = float(getenv('GUEST_CART_COOKIE_DAYS', 30))
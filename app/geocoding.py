@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+import requests
+from app import models
+from app.environ import POSITIONSTACK_API_KEY
+from app.jobs import job_queue
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+def _forward(address: str) -> requests.Response: # pragma: no cover
+    return requests.get('http://api.positionstack.com/v1/forward', params={
+        'access_key': POSITIONSTACK_API_KEY,
+        'query': address,
+        'limit': 1,
+    }, timeout=10)
+
+
+@job_queue.task
+async def geocode_order(db: AsyncSession, order_id: int, address: str): # pragma: no cover
+    """Fill in the coordinates of an order's shipping address.
+
+    Args:
+        db (AsyncSession): The database session.
+        order_id (int): The order's ID.
+        address (str): The full shipping address.
+    """
+    res = await asyncio.to_thread(_forward, address)
+
+    # TODO: find better API throws too many 502 errors, the job is retried
+    if res.status_code != 200:
+        raise RuntimeError(f"Positionstack answered {res.status_code}.")
+
+    try:
+        data = res.json()
+    except json.JSONDecodeError:
+        # known issue returning html when overloaded
+        raise RuntimeError("Positionstack answered with something other than JSON.")
+
+    try:
+        latitude = data['data'][0]['latitude']
+        longitude = data['data'][0]['longitude']
+    except (IndexError, KeyError, TypeError):
+        # the address wasn't found, or the known issue with the API returning: {'data': [[]]}
+        return
+
+    order = await db.get(models.Order, order_id)
+    if order is not None:
+        order.latitude = latitude
+        order.longitude = longitude
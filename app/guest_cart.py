@@ -0,0 +1,119 @@
+import base64
+import hashlib
+import hmac
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from app import environ, inventory, models, security
+from fastapi import Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# The cart of a shopper who isn't logged in lives in a cookie, as
+# `<product_id>:<quantity>|...` followed by a truncated HMAC of it. Nothing is
+# written to the database and no stock is held until the cart is merged into
+# the user's cart at login.
+
+COOKIE_KEY = "guest_cart"
+MAX_ITEMS = 50
+_SIGNATURE_BYTES = 16
+
+
+def _sign(payload: str) -> str:
+    digest = hmac.new(
+        environ.JWT_SECRET.encode(), b"guest-cart:" + payload.encode(), hashlib.sha256
+    ).digest()[:_SIGNATURE_BYTES]
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+
+def encode(items: Dict[int, int]) -> str:
+    """Serialize and sign a guest cart.
+
+    Args:
+        items (Dict[int, int]): The quantity of every product in the cart.
+
+    Returns:
+        str: The value of the cookie.
+    """
+    payload = "|".join(f"{product_id}:{quantity}" for product_id, quantity in items.items())
+    return f"{payload}.{_sign(payload)}"
+
+
+def decode(value: str) -> Dict[int, int]:
+    """Verify and parse a guest cart cookie, an invalid cookie is an empty cart.
+
+    Args:
+        value (str): The value of the cookie.
+
+    Returns:
+        Dict[int, int]: The quantity of every product in the cart.
+    """
+    payload, _, signature = (value or "").rpartition(".")
+    if not payload or not hmac.compare_digest(signature, _sign(payload)):
+        return {}
+
+    items = {}
+    try:
+        for entry in payload.split("|")[:MAX_ITEMS]:
+            product_id, quantity = entry.split(":")
+            if int(quantity) > 0:
+                items[int(product_id)] = int(quantity)
+    except ValueError:
+        return {}
+    return items
+
+
+def set_cookie(response: Response, items: Dict[int, int]):
+    if not items:
+        unset_cookie(response)
+        return
+
+    expires = datetime.utcnow() + timedelta(days=environ.GUEST_CART_COOKIE_DAYS)
+    response.set_cookie(**security.create_session_cookie(
+        encode(items), expires.strftime(security.COOKIE_EXPIRE_FORMAT), key=COOKIE_KEY))
+
+
+def unset_cookie(response: Response):
+    response.set_cookie(**security.create_session_cookie(
+        '', 'Thu, 01 Jan 1970 00:00:00 GMT', key=COOKIE_KEY))
+
+
+async def get_products(db: AsyncSession, items: Dict[int, int]) -> List[models.Product]:
+    """Load the products of a guest cart, with their stock, in one query.
+
+    Args:
+        db (AsyncSession): The database session.
+        items (Dict[int, int]): The quantity of every product in the cart.
+
+    Returns:
+        List[models.Product]: The products that still exist, in the order they were added.
+    """
+    if not items:
+        return []
+
+    products = (await db.execute(
+        select(models.Product).where(models.Product.id.in_(list(items)))
+    )).scalars().all()
+
+    by_id = {product.id: product for product in products}
+    return [by_id[product_id] for product_id in items if product_id in by_id]
+
+
+async def merge_into_user_cart(db: AsyncSession, response: Response, user_id: int, value: Optional[str]):
+    """Move the guest cart of a shopper who just logged in into their cart, and drop the cookie.
+
+    Args:
+        db (AsyncSession): The database session.
+        response (Response): The response of the login.
+        user_id (int): The user's ID.
+        value (Optional[str]): The value of the guest cart cookie, if any.
+    """
+    if value is None:
+        return
+
+    items = decode(value)
+    if items:
+        await inventory.merge_cart_items(db, user_id, items)
+        await db.commit()
+
+    unset_cookie(response)
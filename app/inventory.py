@@ -0,0 +1,807 @@
+import functools
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from app import environ, models
+from sqlalchemy import (Integer, String, case, cast, column, delete, func,
+                        insert, literal, literal_column, select, true,
+                        union_all, update, values)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+# Every cart mutation moves stock between a product and a cart item in a single
+# statement. The stock is only taken when the conditional UPDATE of the product
+# matches, which postgres re-checks after waiting on a concurrent writer, so
+# stock can't be oversold and no row is read into Python first.
+#
+# Products with `stock_shards` set keep their stock spread over that many
+# ProductStockShard rows instead. Reservations lock whichever shard is free with
+# SKIP LOCKED, so concurrent carts don't queue on a single row, and
+# `reconcile_stock_shards` copies the totals back into Product.quantity for reads.
+#
+# The stock of a cart item is only held until its `reserved_until`, every change
+# to the item extends the hold and `release_expired_reservations` deletes the
+# items past it and gives their stock back. Product.quantity is therefore the
+# available stock at all times, reading it is a primary key lookup.
+#
+# A user's cart row is created by the statement adding its first item, the
+# partial unique index on Order.user_id makes concurrent first adds share it.
+# The statements changing a cart's items also add the difference to the cart's
+# item_count, subtotal_cents and total_weight, so reading them never loads the items,
+# and bump its version, which GET /cart/ serves as the ETag.
+
+# the objects already loaded in the session are refreshed by the caller when needed
+_no_sync = {"synchronize_session": False}
+
+
+def hold_deadline() -> datetime:
+    return datetime.utcnow() + timedelta(minutes=environ.CART_RESERVATION_MINUTES)
+
+
+def _price_cents():
+    return cast(func.round(models.Product.price * 100), Integer)
+
+
+def _cart_totals(product_id, delta):
+    """The change of a cart's totals when `delta` units of products are added, or removed when negative.
+
+    Args:
+        product_id: The products' IDs, a column of a CTE only returning the lines that changed.
+        delta: How many units of every product, a value or an expression.
+
+    Returns:
+        Subquery: A single row with the number of `lines` changed and the change of every total.
+    """
+    if isinstance(delta, int):
+        delta = literal(delta, Integer)
+
+    return select(
+        func.count().label("lines"),
+        func.coalesce(func.sum(delta), 0).label("item_count"),
+        func.coalesce(func.sum(delta * _price_cents()), 0).label("subtotal_cents"),
+        func.coalesce(func.sum(delta * models.Product.weight), 0).label("total_weight"),
+    ).where(models.Product.id == product_id).subquery("totals")
+
+
+def _touch_cart_statement(order_id: int, product_id, delta):
+    # bump the cart's updated_at and totals only when the mutation went through
+    totals = _cart_totals(product_id, delta)
+    return update(models.Order).where(
+        (models.Order.id == order_id) & (totals.c.lines > 0)
+    ).values(
+        updated_at=datetime.utcnow(),
+        version=models.Order.version + 1,
+        item_count=models.Order.item_count + totals.c.item_count,
+        subtotal_cents=models.Order.subtotal_cents + totals.c.subtotal_cents,
+        total_weight=models.Order.total_weight + totals.c.total_weight,
+    ).returning(models.Order.id)
+
+
+def _touch_cart(order_id: int, product_id, delta):
+    return _touch_cart_statement(order_id, product_id, delta).cte("touched")
+
+
+def _upsert_cart(user_id: int, product_id, delta):
+    # create the user's cart, or bump its updated_at and totals, only when the mutation went through
+    totals = _cart_totals(product_id, delta)
+    now = datetime.utcnow()
+    stmt = postgresql.insert(models.Order).from_select(
+        ["user_id", "status", "stripe_id", "updated_at", "created_at", "version",
+         "item_count", "subtotal_cents", "total_weight"],
+        select(
+            literal(user_id, Integer),
+            literal(models.OrderStatus.CART, models.Order.status.type),
+            literal(""),
+            literal(now),
+            literal(now),
+            literal(1, Integer),
+            totals.c.item_count,
+            totals.c.subtotal_cents,
+            totals.c.total_weight
+        ).where(totals.c.lines > 0)
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[models.Order.user_id],
+        # literals, bound values in the conflict clauses would be misplaced among the positional parameters
+        index_where=models.Order.status == literal_column(str(models.OrderStatus.CART.value)),
+        set_={
+            "updated_at": stmt.excluded.updated_at,
+            "version": models.Order.version + literal_column("1"),
+            "item_count": models.Order.item_count + stmt.excluded.item_count,
+            "subtotal_cents": models.Order.subtotal_cents + stmt.excluded.subtotal_cents,
+            "total_weight": models.Order.total_weight + stmt.excluded.total_weight,
+        }
+    ).returning(models.Order.id).cte("touched")
+
+
+def _take_stock(product_id, amount, skip_locked: bool):
+    """Take `amount` units (or give them back when negative) from a product or from one of its shards.
+
+    Args:
+        product_id: The product's ID, a value or a column of another CTE.
+        amount: How many units to take, a value or an expression.
+        skip_locked (bool): Whether to skip the shards locked by concurrent carts.
+
+    Returns:
+        Subquery: The ID of the product, only when the stock was taken.
+    """
+    single = update(models.Product).where(
+        (models.Product.id == product_id)
+        & (models.Product.stock_shards == 0)
+        & (models.Product.quantity >= amount)
+    ).values(
+        quantity=models.Product.quantity - amount
+    ).returning(models.Product.id).cte("single")
+
+    if isinstance(amount, int):
+        amount = literal(amount, Integer)
+
+    # a shard that ran low while it was waited on stays locked as the next one is tried, so waiting
+    # carts go through the shards in the same order, or two of them could wait on each other
+    shard = aliased(models.ProductStockShard)
+    picked = select(shard.product_id, shard.shard, amount.label("amount")).where(
+        (shard.product_id == product_id) & (shard.quantity >= amount)
+    ).order_by(
+        shard.quantity.desc() if skip_locked else shard.shard
+    ).limit(1).with_for_update(of=shard, skip_locked=skip_locked).subquery("picked")
+
+    sharded = update(models.ProductStockShard).where(
+        (models.ProductStockShard.product_id == picked.c.product_id)
+        & (models.ProductStockShard.shard == picked.c.shard)
+    ).values(
+        quantity=models.ProductStockShard.quantity - picked.c.amount
+    ).returning(models.ProductStockShard.product_id).cte("sharded")
+
+    return union_all(
+        select(single.c.id),
+        select(sharded.c.product_id)
+    ).subquery("taken")
+
+
+def _add_cart_item_statement(cart, product_id: int, quantity: int, skip_locked: bool):
+    taken = _take_stock(product_id, quantity, skip_locked)
+    touched = cart(taken.c.id, quantity)
+
+    stmt = postgresql.insert(models.OrderItem).from_select(
+        ["order_id", "product_id", "quantity", "reserved_until"],
+        select(
+            touched.c.id, taken.c.id, literal(quantity, Integer), literal(hold_deadline())
+        ).select_from(touched.join(taken, true()))
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[models.OrderItem.order_id, models.OrderItem.product_id],
+        set_={
+            "quantity": models.OrderItem.quantity + stmt.excluded.quantity,
+            "reserved_until": stmt.excluded.reserved_until,
+        }
+    ).returning(models.OrderItem.id)
+
+
+def _update_cart_item_statement(order_id: int, item_id: int, quantity: int, skip_locked: bool):
+    item = select(
+        models.OrderItem.product_id,
+        models.OrderItem.quantity
+    ).where(
+        (models.OrderItem.id == item_id) & (models.OrderItem.order_id == order_id)
+    ).with_for_update().cte("item")
+
+    taken = _take_stock(item.c.product_id, quantity - item.c.quantity, skip_locked)
+
+    return update(models.OrderItem).where(
+        (models.OrderItem.id == item_id) & (models.OrderItem.product_id == taken.c.id)
+    ).values(
+        quantity=quantity, reserved_until=hold_deadline()
+    ).returning(models.OrderItem.id).add_cte(
+        _touch_cart(order_id, taken.c.id, select(quantity - item.c.quantity).scalar_subquery())
+    )
+
+
+async def _has_stock_shards(db: AsyncSession, product_id) -> bool:
+    return bool((await db.execute(
+        select(models.Product.stock_shards).where(models.Product.id == product_id)
+    )).scalar_one_or_none())
+
+
+async def _add_cart_item(db: AsyncSession, cart, product_id: int, quantity: int) -> Optional[int]:
+    stmt = _add_cart_item_statement(cart, product_id, quantity, skip_locked=True)
+    item_id = (await db.execute(stmt, execution_options=_no_sync)).scalar_one_or_none()
+
+    # every shard with enough stock may have been locked, wait for one instead
+    if item_id is None and await _has_stock_shards(db, product_id):
+        stmt = _add_cart_item_statement(cart, product_id, quantity, skip_locked=False)
+        item_id = (await db.execute(stmt, execution_options=_no_sync)).scalar_one_or_none()
+
+    return item_id
+
+
+async def add_cart_item(db: AsyncSession, order_id: int, product_id: int, quantity: int) -> Optional[int]:
+    """Take stock from a product and add it to the cart, merging it with an existing item.
+
+    Args:
+        db (AsyncSession): The database session.
+        order_id (int): The cart's ID.
+        product_id (int): The product to add.
+        quantity (int): How many units to add.
+
+    Returns:
+        Optional[int]: The ID of the cart item, None when the product doesn't have enough stock or doesn't exist.
+    """
+    return await _add_cart_item(db, functools.partial(_touch_cart, order_id), product_id, quantity)
+
+
+async def add_to_user_cart(db: AsyncSession, user_id: int, product_id: int, quantity: int) -> Optional[int]:
+    """Take stock from a product and add it to the user's cart, creating the cart with its first item.
+
+    Args:
+        db (AsyncSession): The database session.
+        user_id (int): The user's ID.
+        product_id (int): The product to add.
+        quantity (int): How many units to add.
+
+    Returns:
+        Optional[int]: The ID of the cart item, None when the product doesn't have enough stock or doesn't exist.
+    """
+    return await _add_cart_item(db, functools.partial(_upsert_cart, user_id), product_id, quantity)
+
+
+async def update_cart_item(db: AsyncSession, order_id: int, item_id: int, quantity: int) -> Optional[int]:
+    """Set the quantity of a cart item, taking or returning the difference in stock.
+
+    Args:
+        db (AsyncSession): The database session.
+        order_id (int): The cart's ID.
+        item_id (int): The cart item's ID.
+        quantity (int): The new quantity of the item.
+
+    Returns:
+        Optional[int]: The ID of the cart item, None when the product doesn't have enough stock or the item isn't in the cart.
+    """
+    stmt = _update_cart_item_statement(order_id, item_id, quantity, skip_locked=True)
+    updated_id = (await db.execute(stmt, execution_options=_no_sync)).scalar_one_or_none()
+
+    if updated_id is None and await _has_stock_shards(
+        db, select(models.OrderItem.product_id).where(models.OrderItem.id == item_id).scalar_subquery()
+    ):
+        stmt = _update_cart_item_statement(order_id, item_id, quantity, skip_locked=False)
+        updated_id = (await db.execute(stmt, execution_options=_no_sync)).scalar_one_or_none()
+
+    return updated_id
+
+
+async def merge_cart_items(db: AsyncSession, user_id: int, items: Dict[int, int]) -> List[int]:
+    """Take the stock of several products and add them to the user's cart, creating it if needed.
+
+    The products without shards are merged by a single statement, the few with shards
+    are added one at a time. Products without enough stock are left out.
+
+    Args:
+        db (AsyncSession): The database session.
+        user_id (int): The user's ID.
+        items (Dict[int, int]): How many units of every product to add.
+
+    Returns:
+        List[int]: The IDs of the products added to the cart.
+    """
+    if not items:
+        return []
+
+    requested = values(
+        column("product_id", Integer), column("quantity", Integer), name="requested"
+    ).data(list(items.items()))
+
+    taken = update(models.Product).where(
+        (models.Product.id == requested.c.product_id)
+        & (models.Product.stock_shards == 0)
+        & (models.Product.quantity >= requested.c.quantity)
+    ).values(
+        quantity=models.Product.quantity - requested.c.quantity
+    ).returning(models.Product.id, requested.c.quantity).cte("taken")
+
+    touched = _upsert_cart(user_id, taken.c.id, taken.c.quantity)
+
+    stmt = postgresql.insert(models.OrderItem).from_select(
+        ["order_id", "product_id", "quantity", "reserved_until"],
+        select(
+            touched.c.id, taken.c.id, taken.c.quantity, literal(hold_deadline())
+        ).select_from(touched.join(taken, true()))
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.OrderItem.order_id, models.OrderItem.product_id],
+        set_={
+            "quantity": models.OrderItem.quantity + stmt.excluded.quantity,
+            "reserved_until": stmt.excluded.reserved_until,
+        }
+    ).returning(models.OrderItem.product_id)
+
+    merged = list((await db.execute(stmt, execution_options=_no_sync)).scalars().all())
+
+    sharded = (await db.execute(
+        select(models.Product.id).where(
+            models.Product.id.in_([product_id for product_id in items if product_id not in merged])
+            & (models.Product.stock_shards > 0)
+        )
+    )).scalars().all()
+
+    for product_id in sharded:
+        if await add_to_user_cart(db, user_id, product_id, items[product_id]) is not None:
+            merged.append(product_id)
+
+    return merged
+
+
+async def _apply_cart_change(db: AsyncSession, user_id: int, product_id: int, op: str, quantity: int) -> bool:
+    item = (await db.execute(
+        select(models.OrderItem.id, models.OrderItem.order_id, models.OrderItem.quantity).join(models.Order).where(
+            (models.Order.user_id == user_id)
+            & (models.Order.status == models.OrderStatus.CART)
+            & (models.OrderItem.product_id == product_id)
+        )
+    )).first()
+
+    current = item.quantity if item is not None else 0
+    target = {"set": quantity, "add": current + quantity}.get(op, 0)
+
+    if item is None:
+        return target > 0 and await add_to_user_cart(db, user_id, product_id, target) is not None
+    if target == 0:
+        return await remove_cart_item(db, item.order_id, item.id)
+    return await update_cart_item(db, item.order_id, item.id, target) is not None
+
+
+async def apply_cart_changes(db: AsyncSession, user_id: int, changes: List[Tuple[int, str, int]]) -> List[int]:
+    """Apply several changes to the user's cart, creating it if needed.
+
+    Every change sets, adds to or removes the quantity of a product. The products without
+    shards are changed by a single statement, which locks their cart items, moves the
+    difference in stock and upserts or deletes the items. The few with shards are changed
+    one at a time. A change that can't be applied leaves its product untouched.
+
+    Args:
+        db (AsyncSession): The database session.
+        user_id (int): The user's ID.
+        changes (List[Tuple[int, str, int]]): The product, the operation (`set`, `add` or `remove`)
+            and the quantity of every change, one per product.
+
+    Returns:
+        List[int]: The IDs of the products whose change was applied.
+    """
+    if not changes:
+        return []
+
+    requested = values(
+        column("product_id", Integer), column("op", String), column("quantity", Integer), name="requested"
+    ).data(changes)
+
+    cart_id = select(models.Order.id).where(
+        (models.Order.user_id == user_id) & (models.Order.status == models.OrderStatus.CART)
+    ).scalar_subquery()
+
+    # only the items already in the cart can be locked, new ones are inserted by adding to their quantity
+    locked = select(models.OrderItem.id, models.OrderItem.product_id, models.OrderItem.quantity).where(
+        (models.OrderItem.order_id == cart_id)
+        & models.OrderItem.product_id.in_(select(requested.c.product_id))
+    ).with_for_update().cte("locked")
+
+    current = func.coalesce(locked.c.quantity, 0)
+    target = case(
+        (requested.c.op == "set", requested.c.quantity),
+        (requested.c.op == "add", current + requested.c.quantity),
+        else_=0
+    )
+    lines = select(
+        requested.c.product_id,
+        locked.c.id.label("item_id"),
+        target.label("target"),
+        (target - current).label("delta")
+    ).select_from(
+        requested.outerjoin(locked, locked.c.product_id == requested.c.product_id)
+    ).where(
+        # there is nothing to remove from a product that isn't in the cart
+        (target > 0) | locked.c.id.isnot(None)
+    ).cte("lines")
+
+    taken = update(models.Product).where(
+        (models.Product.id == lines.c.product_id)
+        & (models.Product.stock_shards == 0)
+        & (models.Product.quantity >= lines.c.delta)
+    ).values(
+        quantity=models.Product.quantity - lines.c.delta
+    ).returning(models.Product.id, lines.c.item_id, lines.c.target, lines.c.delta).cte("taken")
+
+    touched = _upsert_cart(user_id, taken.c.id, taken.c.delta)
+
+    upsert = postgresql.insert(models.OrderItem).from_select(
+        ["order_id", "product_id", "quantity", "reserved_until"],
+        select(
+            touched.c.id, taken.c.id, taken.c.delta, literal(hold_deadline())
+        ).select_from(touched.join(taken, true())).where(taken.c.target > 0)
+    )
+    upserted = upsert.on_conflict_do_update(
+        index_elements=[models.OrderItem.order_id, models.OrderItem.product_id],
+        set_={
+            "quantity": models.OrderItem.quantity + upsert.excluded.quantity,
+            "reserved_until": upsert.excluded.reserved_until,
+        }
+    ).returning(models.OrderItem.product_id).cte("upserted")
+
+    removed = delete(models.OrderItem).where(
+        (models.OrderItem.id == taken.c.item_id) & (taken.c.target == 0)
+    ).returning(models.OrderItem.product_id).cte("removed")
+
+    applied = list((await db.execute(
+        select(taken.c.id).where(
+            taken.c.id.in_(union_all(select(upserted.c.product_id), select(removed.c.product_id)))
+        ),
+        execution_options=_no_sync
+    )).scalars().all())
+
+    sharded = (await db.execute(
+        select(models.Product.id).where(
+            models.Product.id.in_([product_id for product_id, _, _ in changes if product_id not in applied])
+            & (models.Product.stock_shards > 0)
+        )
+    )).scalars().all()
+
+    for product_id, op, quantity in changes:
+        if product_id in sharded and await _apply_cart_change(db, user_id, product_id, op, quantity):
+            applied.append(product_id)
+
+    return applied
+
+
+async def remove_cart_item(db: AsyncSession, order_id: int, item_id: int) -> bool:
+    """Delete a cart item and return its stock to the product.
+
+    Args:
+        db (AsyncSession): The database session.
+        order_id (int): The cart's ID.
+        item_id (int): The cart item's ID.
+
+    Returns:
+        bool: Whether the item was in the cart.
+    """
+    item = delete(models.OrderItem).where(
+        (models.OrderItem.id == item_id) & (models.OrderItem.order_id == order_id)
+    ).returning(models.OrderItem.id, models.OrderItem.product_id, models.OrderItem.quantity).cte("item")
+
+    single = update(models.Product).where(
+        (models.Product.id == item.c.product_id) & (models.Product.stock_shards == 0)
+    ).values(
+        quantity=models.Product.quantity + item.c.quantity
+    ).returning(models.Product.id).cte("single")
+
+    # the stock can't be lost when every shard is locked, so it waits on a shard picked by the item
+    sharded = update(models.ProductStockShard).where(
+        (models.ProductStockShard.product_id == item.c.product_id)
+        & (models.Product.id == item.c.product_id)
+        & (models.ProductStockShard.shard == item.c.id % func.nullif(models.Product.stock_shards, 0))
+    ).values(
+        quantity=models.ProductStockShard.quantity + item.c.quantity
+    ).returning(models.ProductStockShard.product_id).cte("sharded")
+
+    stmt = _touch_cart_statement(order_id, item.c.product_id, -item.c.quantity).add_cte(single).add_cte(sharded)
+
+    return (await db.execute(stmt, execution_options=_no_sync)).first() is not None
+
+
+async def hold_cart_items(db: AsyncSession, order_id: int, until: datetime) -> List[models.OrderItem]:
+    """Extend the hold of every item still in the cart, in one statement.
+
+    Items released by the sweeper are gone from the cart, the rest keep their stock until `until`
+    even if their hold expired in the meantime, since the sweeper skips the rows this locks.
+
+    Args:
+        db (AsyncSession): The database session.
+        order_id (int): The cart's ID.
+        until (datetime): The new deadline of the holds.
+
+    Returns:
+        List[models.OrderItem]: The items of the cart, with their products.
+    """
+    # the deadlines are part of the cart, so its version changes with them
+    bumped = update(models.Order).where(models.Order.id == order_id).values(
+        version=models.Order.version + 1
+    ).returning(models.Order.id).cte("bumped")
+
+    held = (await db.execute(
+        update(models.OrderItem).where(
+            models.OrderItem.order_id == order_id
+        ).values(reserved_until=until).returning(models.OrderItem.id).add_cte(bumped),
+        execution_options=_no_sync
+    )).scalars().all()
+
+    return (await db.execute(
+        select(models.OrderItem).where(
+            models.OrderItem.id.in_(held)
+        ).order_by(models.OrderItem.id).execution_options(populate_existing=True)
+    )).scalars().all()
+
+
+def _give_back_stock(released):
+    """Give the stock of deleted cart items back, with one UPDATE per table.
+
+    Args:
+        released: A CTE returning the `id`, `product_id` and `quantity` of the deleted items.
+
+    Returns:
+        The CTEs updating the products and the shards, the statement must reference both.
+    """
+    per_product = select(
+        released.c.product_id,
+        func.sum(released.c.quantity).label("quantity")
+    ).group_by(released.c.product_id).cte("per_product")
+
+    single = update(models.Product).where(
+        (models.Product.id == per_product.c.product_id) & (models.Product.stock_shards == 0)
+    ).values(
+        quantity=models.Product.quantity + per_product.c.quantity
+    ).returning(models.Product.id).cte("single")
+
+    # the same shard an item would have been given back to by remove_cart_item
+    shard = (released.c.id % func.nullif(models.Product.stock_shards, 0)).label("shard")
+    per_shard = select(
+        released.c.product_id,
+        shard,
+        func.sum(released.c.quantity).label("quantity")
+    ).join(
+        models.Product, models.Product.id == released.c.product_id
+    ).group_by(released.c.product_id, literal_column("shard")).cte("per_shard")
+
+    sharded = update(models.ProductStockShard).where(
+        (models.ProductStockShard.product_id == per_shard.c.product_id)
+        & (models.ProductStockShard.shard == per_shard.c.shard)
+    ).values(
+        quantity=models.ProductStockShard.quantity + per_shard.c.quantity
+    ).returning(models.ProductStockShard.product_id).cte("sharded")
+
+    return single, sharded
+
+
+def _pending_completion(order_id):
+    """Whether a webhook event completing the cart `order_id` waits to be applied.
+
+    Args:
+        order_id: The cart's ID, a column of the enclosing query.
+
+    Returns:
+        Exists: The condition.
+    """
+    return select(models.StripeEvent.id).where(
+        models.StripeEvent.processed_at.is_(None)
+        & (models.StripeEvent.type == "checkout.session.completed")
+        & (models.StripeEvent.payload[("data", "object", "metadata", "order_id")].astext == cast(order_id, String))
+    ).exists()
+
+
+async def release_expired_reservations(db: AsyncSession, batch_size: int) -> int:
+    """Delete up to `batch_size` cart items whose hold expired and give their stock back.
+
+    The items are locked with SKIP LOCKED, so a cart being checked out is never waited on,
+    and the stock is given back with one UPDATE per table. The items of a cart with a checkout
+    session are kept until `settle_expired_checkouts` made sure the session can't be paid anymore,
+    and so are those of a cart with a pending webhook event, which may be its completion.
+
+    Args:
+        db (AsyncSession): The database session.
+        batch_size (int): The maximum number of items to release.
+
+    Returns:
+        int: The number of items released, less than `batch_size` once none are left.
+    """
+    in_checkout = select(models.Order.id).where(
+        (models.Order.id == models.OrderItem.order_id)
+        & models.Order.checkout_session_id.isnot(None)
+    ).exists()
+
+    expired = select(models.OrderItem.id).where(
+        (models.OrderItem.reserved_until < datetime.utcnow()) & ~in_checkout
+        & ~_pending_completion(models.OrderItem.order_id)
+    ).limit(batch_size).with_for_update(skip_locked=True)
+
+    released = delete(models.OrderItem).where(
+        models.OrderItem.id.in_(expired)
+    ).returning(
+        models.OrderItem.id, models.OrderItem.order_id, models.OrderItem.product_id, models.OrderItem.quantity
+    ).cte("released")
+
+    single, sharded = _give_back_stock(released)
+
+    per_order = select(
+        released.c.order_id,
+        func.sum(released.c.quantity).label("item_count"),
+        func.sum(released.c.quantity * _price_cents()).label("subtotal_cents"),
+        func.sum(released.c.quantity * models.Product.weight).label("total_weight"),
+    ).join(
+        models.Product, models.Product.id == released.c.product_id
+    ).group_by(released.c.order_id).cte("per_order")
+
+    # the carts lose the items without being touched, they may still be abandoned
+    carts = update(models.Order).where(
+        models.Order.id == per_order.c.order_id
+    ).values(
+        version=models.Order.version + 1,
+        item_count=models.Order.item_count - per_order.c.item_count,
+        subtotal_cents=models.Order.subtotal_cents - per_order.c.subtotal_cents,
+        total_weight=models.Order.total_weight - per_order.c.total_weight,
+    ).returning(models.Order.id).cte("carts")
+
+    # referencing every CTE makes sure they are all part of the statement
+    counts = (await db.execute(select(
+        select(func.count()).select_from(released).scalar_subquery(),
+        select(func.count()).select_from(single).scalar_subquery(),
+        select(func.count()).select_from(sharded).scalar_subquery(),
+        select(func.count()).select_from(carts).scalar_subquery(),
+    ), execution_options=_no_sync)).one()
+
+    return counts[0]
+
+
+async def refresh_cart_totals(db: AsyncSession, product_id: Optional[int] = None):
+    """Recompute the totals of the carts from their items, after a product's price or weight changed.
+
+    Args:
+        db (AsyncSession): The database session.
+        product_id (Optional[int], optional): Only refresh the carts holding this product. Defaults to every cart.
+    """
+    def total(expression):
+        return select(func.coalesce(func.sum(expression), 0)).select_from(models.OrderItem).join(
+            models.Product, models.Product.id == models.OrderItem.product_id
+        ).where(models.OrderItem.order_id == models.Order.id).scalar_subquery()
+
+    stmt = update(models.Order).where(models.Order.status == models.OrderStatus.CART).values(
+        version=models.Order.version + 1,
+        item_count=total(models.OrderItem.quantity),
+        subtotal_cents=total(models.OrderItem.quantity * _price_cents()),
+        total_weight=total(models.OrderItem.quantity * models.Product.weight),
+    )
+
+    if product_id is not None:
+        stmt = stmt.where(models.Order.id.in_(
+            select(models.OrderItem.order_id).where(models.OrderItem.product_id == product_id)
+        ))
+
+    await db.execute(stmt, execution_options=_no_sync)
+
+
+async def set_stock_shards(db: AsyncSession, product_id: int, shards: int, quantity: Optional[int] = None) -> Optional[int]:
+    """Spread the stock of a product over `shards` rows, or move it back onto the product with 0.
+
+    Meant to be run before a promotion starts, cart items removed while it runs may return
+    their stock to the mode the product was in before.
+
+    Args:
+        db (AsyncSession): The database session.
+        product_id (int): The product's ID.
+        shards (int): The number of shards, 0 to disable sharding.
+        quantity (Optional[int], optional): The new stock. Defaults to the current stock.
+
+    Returns:
+        Optional[int]: The stock of the product, None when it doesn't exist.
+    """
+    product = (await db.execute(
+        select(models.Product.quantity, models.Product.stock_shards).where(
+            models.Product.id == product_id
+        ).with_for_update()
+    )).first()
+
+    if product is None:
+        return None
+
+    shard_quantities = (await db.execute(
+        select(models.ProductStockShard.quantity).where(
+            models.ProductStockShard.product_id == product_id
+        ).with_for_update()
+    )).scalars().all()
+
+    if quantity is None:
+        quantity = sum(shard_quantities) if product.stock_shards else product.quantity
+
+    await db.execute(
+        delete(models.ProductStockShard).where(models.ProductStockShard.product_id == product_id),
+        execution_options=_no_sync
+    )
+
+    if shards:
+        await db.execute(insert(models.ProductStockShard), [
+            {"product_id": product_id, "shard": shard, "quantity": quantity // shards + (shard < quantity % shards)}
+            for shard in range(shards)
+        ])
+
+    await db.execute(
+        update(models.Product).where(models.Product.id == product_id).values(quantity=quantity, stock_shards=shards),
+        execution_options=_no_sync
+    )
+
+    return quantity
+
+
+async def reconcile_stock_shards(db: AsyncSession) -> int:
+    """Copy the total stock of the sharded products that drifted into Product.quantity and even out their shards.
+
+    Rebalancing lets a reservation fit in a single shard again after the others ran low. The shards
+    are locked with SKIP LOCKED, a product with a shard held by a reservation is left for the next run.
+
+    Args:
+        db (AsyncSession): The database session.
+
+    Returns:
+        int: The number of products reconciled.
+    """
+    # read without locking, products nobody reserved since the last run are skipped
+    drifted = select(models.ProductStockShard.product_id).join(
+        models.Product, models.Product.id == models.ProductStockShard.product_id
+    ).group_by(models.ProductStockShard.product_id, models.Product.quantity).having(
+        (func.sum(models.ProductStockShard.quantity) != models.Product.quantity)
+        | (func.max(models.ProductStockShard.quantity) - func.min(models.ProductStockShard.quantity) > 1)
+    )
+
+    locked = select(
+        models.ProductStockShard.product_id,
+        models.ProductStockShard.quantity
+    ).where(
+        models.ProductStockShard.product_id.in_(drifted)
+    ).with_for_update(skip_locked=True).cte("locked")
+
+    # only the products whose every shard got locked have a known total
+    totals = select(
+        locked.c.product_id,
+        func.sum(locked.c.quantity).label("total"),
+        func.count().label("shards")
+    ).join(
+        models.Product, models.Product.id == locked.c.product_id
+    ).group_by(locked.c.product_id, models.Product.stock_shards).having(
+        func.count() == models.Product.stock_shards
+    ).cte("totals")
+
+    rebalanced = update(models.ProductStockShard).where(
+        models.ProductStockShard.product_id == totals.c.product_id
+    ).values(
+        quantity=totals.c.total / totals.c.shards
+        + case((models.ProductStockShard.shard < totals.c.total % totals.c.shards, 1), else_=0)
+    ).cte("rebalanced")
+
+    return len((await db.execute(
+        update(models.Product).where(
+            models.Product.id == totals.c.product_id
+        ).values(quantity=totals.c.total).add_cte(rebalanced).returning(models.Product.id),
+        execution_options=_no_sync
+    )).all())
+
+
+async def delete_abandoned_carts(db: AsyncSession, older_than: datetime, batch_size: int) -> int:
+    """Delete up to `batch_size` carts untouched since `older_than`, giving their stock back.
+
+    The carts are found through the (status, updated_at) index and locked with SKIP LOCKED,
+    so a cart being changed or checked out is left for the next batch. Like in
+    `release_expired_reservations`, a cart with a checkout session or a pending completion
+    event is kept, it may have been paid.
+
+    Args:
+        db (AsyncSession): The database session.
+        older_than (datetime): Carts whose last change is older than this are abandoned.
+        batch_size (int): The maximum number of carts to delete.
+
+    Returns:
+        int: The number of carts deleted, less than `batch_size` once none are left.
+    """
+    held = select(models.OrderItem.id).where(
+        (models.OrderItem.order_id == models.Order.id) & (models.OrderItem.reserved_until >= datetime.utcnow())
+    ).exists()
+
+    stale = select(models.Order.id).where(
+        (models.Order.status == models.OrderStatus.CART) & (models.Order.updated_at < older_than) & ~held
+        & models.Order.checkout_session_id.is_(None) & ~_pending_completion(models.Order.id)
+    ).limit(batch_size).with_for_update(skip_locked=True).cte("stale")
+
+    released = delete(models.OrderItem).where(
+        models.OrderItem.order_id.in_(select(stale.c.id))
+    ).returning(models.OrderItem.id, models.OrderItem.product_id, models.OrderItem.quantity).cte("released")
+
+    single, sharded = _give_back_stock(released)
+
+    stmt = delete(models.Order).where(
+        models.Order.id.in_(select(stale.c.id))
+    ).returning(models.Order.id).add_cte(released).add_cte(single).add_cte(sharded)
+
+    return len((await db.execute(stmt, execution_options=_no_sync)).all())
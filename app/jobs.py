@@ -0,0 +1,177 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from app import environ, models
+from app.database import async_session_factory
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger("uvicorn.error")
+
+# Background jobs are rows of the Job table. Enqueueing adds the row to the
+# caller's transaction, so a job exists if and only if the change asking for it
+# was committed. Workers claim a batch of due jobs with FOR UPDATE SKIP LOCKED
+# and lease them for JOB_LEASE_SECONDS. The work of a job commits along with
+# its deletion, and a failed job is retried with an exponential backoff until
+# it runs out of attempts. A worker that dies mid-job loses its lease, and
+# another worker takes the job over once the lease runs out.
+
+Task = Callable[..., Awaitable[None]]
+
+RETRY_BACKOFF_SECONDS = 10
+RETRY_MAX_BACKOFF_SECONDS = 60 * 60
+
+
+class JobQueue():
+    def __init__(self, session_factory: Callable[[], AsyncSession] = async_session_factory):
+        """Runs the tasks enqueued in the Job table, in the app or in `manage worker`.
+
+        Args:
+            session_factory (Callable[[], AsyncSession]): Opens the sessions the jobs run in.
+        """
+        self._session_factory = session_factory
+        self._tasks: Dict[str, Task] = {}
+        self._workers: List[asyncio.Task] = []
+
+    def task(self, fn: Task) -> Task:
+        """Register a task under its function's name.
+
+        A task is called with a database session, which is committed once it returns,
+        and the payload of the job as keyword arguments.
+        """
+        if fn.__name__ in self._tasks:
+            raise ValueError(f"A task named {fn.__name__} is already registered.")
+        self._tasks[fn.__name__] = fn
+        return fn
+
+    def enqueue(
+        self,
+        db: AsyncSession,
+        task: Task,
+        priority: int = 0,
+        delay: Optional[timedelta] = None,
+        max_attempts: int = 5,
+        **payload: Any
+    ) -> models.Job:
+        """Add a job to the session, it runs once the session is committed.
+
+        Args:
+            db (AsyncSession): The database session.
+            task (Task): The registered task.
+            priority (int, optional): Lower runs first.
+            delay (Optional[timedelta], optional): How long to wait before running the job.
+            max_attempts (int, optional): How many times the job runs before it is marked failed.
+            payload: The JSON serializable arguments of the task.
+
+        Returns:
+            models.Job: The job.
+        """
+        if self._tasks.get(task.__name__) is not task:
+            raise ValueError(f"The task {task.__name__} is not registered.")
+
+        job = models.Job(
+            task=task.__name__,
+            payload=payload,
+            priority=priority,
+            run_at=datetime.utcnow() + (delay or timedelta()),
+            max_attempts=max_attempts,
+        )
+        db.add(job)
+        return job
+
+    async def _claim(self, batch_size: int) -> List[Any]:
+        now = datetime.utcnow()
+        due = select(models.Job.id).where(
+            models.Job.failed_at.is_(None),
+            models.Job.run_at <= now,
+            or_(models.Job.locked_until.is_(None), models.Job.locked_until < now),
+        ).order_by(
+            models.Job.priority, models.Job.run_at
+        ).limit(batch_size).with_for_update(skip_locked=True)
+
+        async with self._session_factory() as db:
+            jobs = (await db.execute(
+                update(models.Job).where(models.Job.id.in_(due.scalar_subquery())).values(
+                    locked_until=now + timedelta(seconds=environ.JOB_LEASE_SECONDS),
+                    attempts=models.Job.attempts + 1,
+                ).returning(
+                    models.Job.id, models.Job.task, models.Job.payload, models.Job.priority,
+                    models.Job.run_at, models.Job.attempts, models.Job.max_attempts,
+                ),
+                execution_options={"synchronize_session": False}
+            )).all()
+            await db.commit()
+
+        return sorted(jobs, key=lambda job: (job.priority, job.run_at))
+
+    async def _run(self, job):
+        async with self._session_factory() as db:
+            try:
+                task = self._tasks.get(job.task)
+                if task is None:
+                    raise LookupError(f"The task {job.task} is not registered.")
+
+                await task(db, **job.payload)
+                await db.execute(delete(models.Job).where(models.Job.id == job.id))
+                await db.commit()
+                return
+            except Exception as e:
+                await db.rollback()
+                logger.exception(f"Job {job.id} ({job.task}) failed, attempt {job.attempts} of {job.max_attempts}.")
+                error = repr(e)
+
+            now = datetime.utcnow()
+            backoff = min(RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1), RETRY_MAX_BACKOFF_SECONDS)
+            await db.execute(
+                update(models.Job).where(models.Job.id == job.id).values(
+                    locked_until=None,
+                    last_error=error[:1000],
+                    run_at=now + timedelta(seconds=backoff),
+                    failed_at=now if job.attempts >= job.max_attempts else None,
+                ),
+                execution_options={"synchronize_session": False}
+            )
+            await db.commit()
+
+    async def work_once(self, batch_size: int) -> int:
+        """Claim a batch of due jobs and run them one after the other.
+
+        Args:
+            batch_size (int): The maximum number of jobs claimed.
+
+        Returns:
+            int: The number of jobs that ran, successfully or not.
+        """
+        jobs = await self._claim(batch_size)
+        for job in jobs:
+            await self._run(job)
+        return len(jobs)
+
+    async def work(self, batch_size: int, poll_interval: float):
+        """Run jobs until cancelled, waiting `poll_interval` seconds whenever the queue is drained."""
+        while True:
+            try:
+                ran = await self.work_once(batch_size)
+            except Exception:
+                # the database may be back by the next poll
+                logger.exception("Claiming jobs failed.")
+                ran = 0
+            if ran < batch_size:
+                await asyncio.sleep(poll_interval)
+
+    def start(self, workers: int, batch_size: int, poll_interval: float):
+        self._workers = [
+            asyncio.create_task(self.work(batch_size, poll_interval)) for _ in range(workers)
+        ]
+
+    async def stop(self):
+        # a job interrupted here is taken over once its lease runs out
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+
+job_queue = JobQueue()
@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from app.database import Base
+from sqlalchemy import Column, DateTime, Index, Integer, String, text
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+# a background task waiting to run, see app.jobs
+class Job(Base):
+    __tablename__ = "Job"
+    __table_args__ = (
+        # walks the jobs that may still run in the order they are claimed in
+        Index("ix_Job_priority_run_at", "priority", "run_at", postgresql_where=text("failed_at IS NULL")),
+    )
+
+    id = Column(Integer, primary_key=True)
+    task = Column(String, nullable=False)
+    payload = Column(JSONB, nullable=False, default=dict)
+    # lower runs first
+    priority = Column(Integer, default=0, nullable=False)
+    run_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    # a claimed job belongs to its worker until then, another worker takes it over afterwards
+    locked_until = Column(DateTime)
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, default=5, nullable=False)
+    last_error = Column(String)
+    # set once the job ran out of attempts, it is kept for inspection
+    failed_at = Column(DateTime)
+
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -2,7 +2,8 @@ import enum
 from datetime import datetime
 
 from app.database import Base
-from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, String
+from sqlalchemy import (Column, DateTime, Float, ForeignKey, Index, Integer,
+                        String, text)
 from sqlalchemy.orm import relationship
 
 from .helpers.enums import IntEnum
@@ -17,14 +18,37 @@ class OrderStatus(enum.IntEnum):
 
 class Order(Base):
     __tablename__ = "Order"
+    __table_args__ = (
+        # serves the order history, newest first, without sorting
+        Index("ix_Order_user_id_updated_at", "user_id", "updated_at", "id"),
+        # lets the sweeper find the abandoned carts without scanning the orders
+        Index("ix_Order_status_updated_at", "status", "updated_at"),
+        # a user has at most one cart (status 0), which adding the first item upserts on
+        Index("uq_Order_user_id_cart", "user_id", unique=True, postgresql_where=text("status = 0")),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("User.id"), nullable=False)
     status = Column(IntEnum(OrderStatus), default=OrderStatus.CART)
 
     stripe_id = Column(String, default="")
-    updated_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    # bumped by every statement changing the cart, it is the cart's ETag
+    version = Column(Integer, default=1, nullable=False)
+
+    # maintained by the statements changing the items, see app.inventory
+    item_count = Column(Integer, default=0, nullable=False)
+    subtotal_cents = Column(Integer, default=0, nullable=False)
+    total_weight = Column(Float, default=0, nullable=False)
+
+    # the last checkout session, handed out again while the cart's content is unchanged
+    checkout_session_id = Column(String)
+    checkout_url = Column(String)
+    checkout_hash = Column(String)
+    checkout_expires_at = Column(DateTime)
+
     amount_total = Column(Float)
     amount_subtotal = Column(Float)
     amount_shipping = Column(Float)
@@ -1,13 +1,23 @@
 from app.database import Base
-from sqlalchemy import Column, ForeignKey, Integer
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Integer,
+                        UniqueConstraint, text)
 from sqlalchemy.orm import relationship
 
 
 class OrderItem(Base):
     __tablename__ = "OrderItem"
+    __table_args__ = (
+        # a product appears once per order, which adding to the cart upserts on
+        UniqueConstraint("order_id", "product_id", name="uq_OrderItem_order_id_product_id"),
+        # only cart items hold stock until a deadline, which keeps the sweeper's index small
+        Index("ix_OrderItem_reserved_until", "reserved_until", postgresql_where=text("reserved_until IS NOT NULL")),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
     order_id = Column(Integer, ForeignKey("Order.id"), nullable=False)
     product_id = Column(Integer, ForeignKey("Product.id"), nullable=False)
     quantity = Column(Integer, default=1)
+    # the stock of a cart item is given back once this passes, null when it is held for good
+    reserved_until = Column(DateTime)
 
     product = relationship("Product", lazy="joined")
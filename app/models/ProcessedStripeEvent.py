@@ -0,0 +1,11 @@
+from datetime import datetime
+
+from app.database import Base
+from sqlalchemy import Column, DateTime, String
+
+
+# a Stripe event whose effects were applied, its redeliveries are skipped, see app.stripe_events
+class ProcessedStripeEvent(Base):
+    __tablename__ = "ProcessedStripeEvent"
+    event_id = Column(String, primary_key=True)
+    processed_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
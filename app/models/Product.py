@@ -1,23 +1,53 @@
 from app.database import Base
-from sqlalchemy import Column, Float, ForeignKey, Integer, String, event
-from sqlalchemy.orm import relationship
+from sqlalchemy import (DDL, Column, Computed, Float, ForeignKey, Index,
+                        Integer, String, event)
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred, relationship
 
 from .helpers import slugify_listener
 
+# the text search configuration used to stem both the documents and the queries
+SEARCH_CONFIG = "english"
+
 
 class Product(Base):
     __tablename__ = "Product"
+    __table_args__ = (
+        Index("ix_Product_search_vector", "search_vector", postgresql_using="gin"),
+        # trigram indexes power the typo tolerant search and speed up ILIKE '%q%'
+        Index("ix_Product_name_trgm", "name", postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}),
+        Index("ix_Product_description_trgm", "description", postgresql_using="gin",
+              postgresql_ops={"description": "gin_trgm_ops"}),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     slug = Column(String, unique=True, index=True, nullable=False)
     category_id = Column(Integer, ForeignKey("Category.id"), nullable=False)
     category = relationship("Category", back_populates="products")
     quantity = Column(Integer, default=0)
+    # when above 0 the stock lives in that many ProductStockShard rows and quantity is
+    # their total as of the last reconciliation, see app.inventory
+    stock_shards = Column(Integer, default=0, nullable=False)
     name = Column(String, nullable=False)
     image_url = Column(String, nullable=False)
     description = Column(String, nullable=False)
     price = Column(Float, nullable=False)
     weight = Column(Float, nullable=False)
 
+    # the product's Stripe Product and current Price, kept in sync by app.stripe_catalog
+    stripe_product_id = Column(String)
+    stripe_price_id = Column(String)
+    stripe_unit_amount = Column(Integer)
+    # the hash of the details last sent to Stripe
+    stripe_hash = Column(String)
+
+    # maintained by postgres on every write, matches in the name outrank matches in the description
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', name), 'A') || "
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', description), 'B')",
+        persisted=True
+    )))
+
 
 event.listen(Product.name, 'set', slugify_listener, retval=False)
+event.listen(Product.__table__, 'before_create', DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
@@ -0,0 +1,9 @@
+from app.database import Base
+from sqlalchemy import Column, ForeignKey, Integer
+
+
+class ProductStockShard(Base):
+    __tablename__ = "ProductStockShard"
+    product_id = Column(Integer, ForeignKey("Product.id"), primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    quantity = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,13 @@
+from datetime import datetime
+
+from app.database import Base
+from sqlalchemy import Column, DateTime, String
+
+
+# how far a reconciliation walked a Stripe list, see app.stripe_events
+class StripeCursor(Base):
+    __tablename__ = "StripeCursor"
+    name = Column(String, primary_key=True)
+    # the newest object reconciled, None until the first run completed
+    object_id = Column(String)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
@@ -0,0 +1,17 @@
+from datetime import datetime
+from uuid import uuid4
+
+from app.database import Base
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+
+
+# a user whose Stripe customer is yet to be created, see app.stripe_customers
+class StripeCustomerOutbox(Base):
+    __tablename__ = "StripeCustomerOutbox"
+    user_id = Column(Integer, ForeignKey("User.id", ondelete="CASCADE"), primary_key=True)
+    # random, user IDs repeat across the databases sharing a Stripe account
+    idempotency_key = Column(String, default=lambda: str(uuid4()), nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    last_error = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -0,0 +1,21 @@
+from datetime import datetime
+
+from app.database import Base
+from sqlalchemy import Column, DateTime, Index, Integer, String, text
+from sqlalchemy.dialects.postgresql import JSONB
+
+
+# a webhook delivery from Stripe, stored as is and processed in the background, see app.stripe_events
+class StripeEvent(Base):
+    __tablename__ = "StripeEvent"
+    __table_args__ = (
+        # the consumer walks the pending events oldest first
+        Index("ix_StripeEvent_pending", "received_at", postgresql_where=text("processed_at IS NULL")),
+    )
+
+    id = Column(Integer, primary_key=True)
+    event_id = Column(String, nullable=False)
+    type = Column(String, nullable=False)
+    payload = Column(JSONB, nullable=False)
+    received_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    processed_at = Column(DateTime)
@@ -9,7 +9,8 @@ from app.database import Base
 class User(Base):
     __tablename__ = "User"
     id = Column(Integer, primary_key=True, index=True)
-    stripe_id = Column(String, nullable=False)
+    # None until the StripeCustomerOutbox entry of the user is dispatched
+    stripe_id = Column(String)
     
     firstname = Column(String, nullable=False)
     lastname = Column(String, nullable=False)
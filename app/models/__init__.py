@@ -5,9 +5,15 @@ from app.database import engine as _engine
 from .Address import Address
 from .Category import Category
 from .Delivery import Delivery
+from .Job import Job
 from .Order import Order, OrderStatus
 from .OrderItem import OrderItem
+from .ProcessedStripeEvent import ProcessedStripeEvent
 from .Product import Product
+from .ProductStockShard import ProductStockShard
+from .StripeCursor import StripeCursor
+from .StripeCustomerOutbox import StripeCustomerOutbox
+from .StripeEvent import StripeEvent
 from .User import User
 
 
@@ -0,0 +1,175 @@
+import json
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Tuple
+
+from app import environ
+from fastapi_pagination import create_page, resolve_params
+from fastapi_pagination.bases import AbstractPage, is_cursor
+from fastapi_pagination.ext.async_sqlalchemy import \
+    paginate as paginate_with_cursor
+from fastapi_pagination.ext.sqlalchemy import count_query, paginate_query
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+
+class CountStrategy(ABC):
+    """Decides how the total of a page is computed."""
+
+    @abstractmethod
+    async def count(self, db: AsyncSession, stmt: Select) -> Tuple[int, bool]:
+        """Count the rows a statement selects.
+
+        Args:
+            db (AsyncSession): The database session.
+            stmt (Select): The statement being paginated.
+
+        Returns:
+            Tuple[int, bool]: The total, and whether it is only an approximation.
+        """
+
+    def stats(self) -> dict:
+        return {}
+
+
+class ExactCount(CountStrategy):
+    async def count(self, db: AsyncSession, stmt: Select) -> Tuple[int, bool]:
+        return (await db.execute(count_query(stmt))).scalar_one(), False
+
+
+class CachedCount(CountStrategy):
+    def __init__(self, ttl: float, max_entries: int = 1024):
+        """Remembers exact counts per query shape and parameters for `ttl` seconds.
+
+        Call `invalidate` whenever the rows being counted are written.
+
+        Args:
+            ttl (float): How many seconds a count stays fresh.
+            max_entries (int, optional): How many counts to remember. Defaults to 1024.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._counts: "OrderedDict[Any, Tuple[float, int]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def count(self, db: AsyncSession, stmt: Select) -> Tuple[int, bool]:
+        compiled = stmt.compile()
+        key = (str(compiled), tuple(sorted(compiled.params.items())))
+
+        cached = self._counts.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            self._counts.move_to_end(key)
+            self.hits += 1
+            return cached[1], False
+
+        self.misses += 1
+        total, _ = await ExactCount().count(db, stmt)
+
+        self._counts[key] = (time.monotonic() + self.ttl, total)
+        self._counts.move_to_end(key)
+        while len(self._counts) > self.max_entries:
+            self._counts.popitem(last=False)
+
+        return total, False
+
+    def invalidate(self):
+        self._counts.clear()
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._counts),
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+class explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, stmt: Select):
+        self.stmt = stmt
+
+
+@compiles(explain, "postgresql")
+def _compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.stmt, **kw)
+
+
+class EstimatedCount(CountStrategy):
+    def __init__(self, threshold: int):
+        """Uses the planner's row estimate when it is above `threshold`, and an exact count otherwise.
+
+        Planning is much cheaper than counting a large result, and past a certain size users only
+        need to know roughly how many pages there are. The estimate comes from the table statistics
+        (`pg_class.reltuples` and the column histograms), so it is as fresh as the last ANALYZE.
+
+        Args:
+            threshold (int): The estimate above which the exact count is skipped.
+        """
+        self.threshold = threshold
+
+        self.estimated = 0
+        self.exact = 0
+
+    async def count(self, db: AsyncSession, stmt: Select) -> Tuple[int, bool]:
+        plan = (await db.execute(explain(stmt))).scalar_one()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        estimate = int(plan[0]["Plan"]["Plan Rows"])
+
+        if estimate > self.threshold:
+            self.estimated += 1
+            return estimate, True
+
+        self.exact += 1
+        return await ExactCount().count(db, stmt)
+
+    def stats(self) -> dict:
+        return {
+            "threshold": self.threshold,
+            "estimated": self.estimated,
+            "exact": self.exact,
+        }
+
+
+exact_count = ExactCount()
+
+# the strategies of the paginated routes, the cached ones are invalidated wherever their rows are written
+# the past orders are counted exactly, a user's orders are a range of an index and a cached count
+# would go stale in every other process whenever a checkout completes
+category_count = CachedCount(ttl=environ.PAGE_COUNT_CACHE_TTL_SECONDS)
+search_count = EstimatedCount(threshold=environ.PAGE_COUNT_ESTIMATE_THRESHOLD)
+
+
+async def paginate(db: AsyncSession, stmt: Select, count: CountStrategy = exact_count) -> AbstractPage:
+    """Paginate a statement, using `count` to compute the total of numbered pages.
+
+    Cursor pages are delegated to sqlakeyset and never counted.
+
+    Args:
+        db (AsyncSession): The database session.
+        stmt (Select): The statement to paginate, it must be ordered.
+        count (CountStrategy, optional): How to compute the total. Defaults to an exact count.
+
+    Returns:
+        AbstractPage: The page of the route's response model.
+    """
+    params = resolve_params()
+
+    if is_cursor(params.to_raw_params()):
+        return await paginate_with_cursor(db, stmt, params)
+
+    total, approximate = await count.count(db, stmt)
+    items = (await db.execute(paginate_query(stmt, params))).unique().scalars().all()
+
+    return create_page(items, total, params, total_is_approximate=approximate)
@@ -1,8 +1,9 @@
-import stripe
-from app import models, schemas, security
+from typing import Optional
+
+from app import guest_cart, models, schemas, security
 from app.database import get_database
 from app.security import pwd_context
-from fastapi import APIRouter, Depends, HTTPException, Response, status
+from fastapi import APIRouter, Cookie, Depends, HTTPException, Response, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -31,7 +32,8 @@ async def get_access_token(response: Response):
 async def get_access_token(
     response: Response,
     data: OAuth2PasswordRequestForm = Depends(),
-    db: AsyncSession = Depends(get_database)
+    db: AsyncSession = Depends(get_database),
+    guest_cart_cookie: Optional[str] = Cookie(None, alias=guest_cart.COOKIE_KEY)
 ):
 
     user = await security.get_user_by_email(db, email=data.username)
@@ -42,6 +44,8 @@ async def get_access_token(
             detail="Incorrect username or password",
         )
 
+    await guest_cart.merge_into_user_cart(db, response, user.id, guest_cart_cookie)
+
     access_token = create_access_token(user)
 
     security.set_access_token_cookie(response, access_token)
@@ -56,7 +60,8 @@ async def get_access_token(
 async def register_new_user(
     response: Response,
     new_user_details: schemas.user.NewUserIn,
-    db: AsyncSession = Depends(get_database)
+    db: AsyncSession = Depends(get_database),
+    guest_cart_cookie: Optional[str] = Cookie(None, alias=guest_cart.COOKIE_KEY)
 ):
     existing_user = await security.get_user_by_email(db, email=new_user_details.username)
     if existing_user:
@@ -65,23 +70,23 @@ async def register_new_user(
             detail="User already exists",
         )
 
-    stripe_customer = stripe.Customer.create(
-        name=f"{new_user_details.firstname} {new_user_details.lastname}",
-        email=new_user_details.username
-    )
-
     new_user = models.User(
         email=new_user_details.username,
-        stripe_id=stripe_customer.id,
         firstname=new_user_details.firstname,
         lastname=new_user_details.lastname,
         password=pwd_context.hash(new_user_details.password)
     )
 
     db.add(new_user)
+    await db.flush()
+
+    # the stripe customer is created by the outbox dispatcher, see app.stripe_customers
+    db.add(models.StripeCustomerOutbox(user_id=new_user.id))
     await db.commit()
     await db.refresh(new_user)
 
+    await guest_cart.merge_into_user_cart(db, response, new_user.id, guest_cart_cookie)
+
     access_token = create_access_token(new_user)
 
     security.set_access_token_cookie(response, access_token)
@@ -1,161 +1,333 @@
 import functools
-from datetime import datetime
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Sequence
+from uuid import uuid4
 
 import stripe
-from app import models, schemas, security
+from app import (inventory, models, schemas, security, stripe_catalog,
+                 stripe_customers)
 from app.database import get_database
 from app.environ import BASE_URL_UI
 from app.stripe_config import shipping_rates
-from fastapi import APIRouter, Depends, Request
+from app.stripe_gateway import stripe_gateway
+from fastapi import APIRouter, Depends, Request, Response
 from fastapi.exceptions import HTTPException
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 cart_router = APIRouter()
 
+# the shortest expiry stripe allows, the stock is held a little longer so a
+# session completed at the last second still has it
+CHECKOUT_SESSION_MINUTES = 30
+CHECKOUT_HOLD_GRACE_MINUTES = 10
 
-async def get_user_current_order(db: AsyncSession = Depends(get_database), user: schemas.user.UserContext = Depends(security.get_current_user)) -> models.Order:
-    """Get the current order for the user or create one if it doesn't exist.
+# an open checkout session is only handed out again if it has this long left
+CHECKOUT_REUSE_MIN_MINUTES = 5
+
+# carts lighter than this many pounds are offered complimentary shipping
+COMPLIMENTARY_SHIPPING_MAX_WEIGHT = 20
+
+
+async def get_user_current_order(db: AsyncSession = Depends(get_database), user: schemas.user.UserContext = Depends(security.get_current_user)) -> Optional[models.Order]:
+    """Get the current order for the user.
+
+    The cart is only created along with its first item, so reading it never writes.
 
     Args:
         db (AsyncSession): The database session.
         user UserContext: The currently logged user context.
 
     Returns:
-        models.Order: The current order for the user.
+        Optional[models.Order]: The current order for the user, None when they haven't added anything yet.
     """
-    cart = (await db.execute(
+    return (await db.execute(
         select(models.Order).where((models.Order.user_id == user.id) & (models.Order.status == models.OrderStatus.CART))
     )).scalars().first()
 
+
+async def get_cart_item(db: AsyncSession, order_item_id: int) -> models.OrderItem:
+    # the cart loaded its items before they were changed, so refresh them
+    return (await db.execute(
+        select(models.OrderItem).where(models.OrderItem.id == order_item_id).execution_options(populate_existing=True)
+    )).scalars().one()
+
+
+def get_empty_cart() -> dict:
+    now = datetime.utcnow()
+    return {
+        "id": None, "status": models.OrderStatus.CART, "updated_at": now, "created_at": now, "items": [],
+        "item_count": 0, "subtotal_cents": 0, "total_weight": 0,
+    }
+
+
+def cart_etag(cart_id: Optional[int], version: int) -> str:
+    # weak, the version doesn't cover the live stock of the products in the cart
+    return f'W/"{cart_id or 0}.{version}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match compares weakly, and lists several tags or `*`
+    def opaque(tag):
+        return tag[2:] if tag.startswith("W/") else tag
+
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or opaque(etag) in [opaque(tag) for tag in tags]
+
+
+@cart_router.get("/", response_model=schemas.order.OrderCartOut, responses={304: {"description": "The cart didn't change."}})
+async def get_cart(
+        request: Request,
+        response: Response,
+        user: schemas.user.UserContext = Depends(security.get_current_user),
+        db: AsyncSession = Depends(get_database)
+    ):
+    """Get the current users cart items.
+
+    The response carries the cart's version as a weak ETag, a request with a matching
+    If-None-Match gets a 304 after looking the version up, without loading the items.
+    Price and weight changes bump the version of the carts holding the product, stock
+    changes don't, so the products' quantity may lag until the cart itself changes.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        current = (await db.execute(
+            select(models.Order.id, models.Order.version).where(
+                (models.Order.user_id == user.id) & (models.Order.status == models.OrderStatus.CART)
+            )
+        )).first()
+
+        etag = cart_etag(current.id, current.version) if current is not None else cart_etag(None, 0)
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+    cart = await get_user_current_order(db, user)
+
     if cart is None:
-        cart = models.Order(user_id=user.id, status=models.OrderStatus.CART)
-        db.add(cart)
-        await db.commit()
-        await db.refresh(cart)
+        response.headers["ETag"] = cart_etag(None, 0)
+        return get_empty_cart()
+
+    response.headers["ETag"] = cart_etag(cart.id, cart.version)
     return cart
 
 
-@cart_router.get("/", response_model=schemas.order.OrderCartOut)
-async def get_cart(cart: models.Order = Depends(get_user_current_order)):
-    """Get the current users cart items."""
-    return cart
+@cart_router.get("/summary/", response_model=schemas.order.OrderCartSummaryOut)
+async def get_cart_summary(
+        user: schemas.user.UserContext = Depends(security.get_current_user),
+        db: AsyncSession = Depends(get_database)
+    ):
+    """Get the totals of the current users cart, read from the cart row without loading its items."""
+    summary = (await db.execute(
+        select(
+            models.Order.id, models.Order.item_count, models.Order.subtotal_cents, models.Order.total_weight
+        ).where((models.Order.user_id == user.id) & (models.Order.status == models.OrderStatus.CART))
+    )).first()
+
+    if summary is None:
+        return {"id": None, "item_count": 0, "subtotal_cents": 0, "total_weight": 0, "free_shipping": True}
+
+    return {**summary._asdict(), "free_shipping": summary.total_weight < COMPLIMENTARY_SHIPPING_MAX_WEIGHT}
 
 
 @cart_router.post("/", response_model=schemas.order.OrderItemOut)
 async def add_to_cart(
         item: schemas.product.ProductCartItemIn,
-        cart: models.Order = Depends(get_user_current_order),
+        user: schemas.user.UserContext = Depends(security.get_current_user),
         db: AsyncSession = Depends(get_database)
     ):
-    """Add an item to the current users cart."""
-    
-    product = (await db.execute(select(models.Product).where(models.Product.id == item.product_id))).scalars().first()
-    product.quantity -= item.quantity 
-    
-    if (product.quantity < 0):
+    """Add an item to the current users cart, creating the cart with its first item."""
+
+    order_item_id = await inventory.add_to_user_cart(db, user.id, item.product_id, item.quantity)
+
+    if order_item_id is None:
+        if (await db.execute(select(models.Product.id).where(models.Product.id == item.product_id))).first() is None:
+            raise HTTPException(status_code=404, detail="Product not found")
         raise HTTPException(status_code=400, detail="Not enough stock")
 
-    order_item = (await db.execute(select(models.OrderItem).where(
-        (models.OrderItem.product_id == item.product_id) & (models.OrderItem.order_id == cart.id)
-    ))).scalars().first()
-    if order_item is None:
-        order_item = models.OrderItem(product_id=item.product_id, order_id=cart.id, quantity=item.quantity)
-        db.add(order_item)
-    else:
-        order_item.quantity += item.quantity
-    
-    cart.updated_at = datetime.utcnow()        
     await db.commit()
-    await db.refresh(cart)
 
-    return order_item
+    return await get_cart_item(db, order_item_id)
+
+
+@cart_router.patch("/", response_model=schemas.order.OrderCartChangesOut)
+async def change_cart(
+        body: schemas.order.CartChangesIn,
+        user: schemas.user.UserContext = Depends(security.get_current_user),
+        db: AsyncSession = Depends(get_database)
+    ):
+    """Apply many changes to the current users cart at once, returning the cart and the changes that failed."""
+
+    changes = [(change.product_id, change.op.value, change.quantity) for change in body.changes]
+    applied = set(await inventory.apply_cart_changes(db, user.id, changes))
+    await db.commit()
+
+    failed = [change for change in body.changes if change.product_id not in applied]
+    errors = []
+    if failed:
+        products = set((await db.execute(
+            select(models.Product.id).where(models.Product.id.in_([change.product_id for change in failed]))
+        )).scalars().all())
+
+        for change in failed:
+            if change.product_id not in products:
+                detail = "Product not found"
+            elif change.op == schemas.order.CartChangeOp.REMOVE or change.quantity == 0:
+                detail = "Cart item was not found"
+            else:
+                detail = "Not enough stock"
+            errors.append({"product_id": change.product_id, "detail": detail})
+
+    cart = (await db.execute(
+        select(models.Order).where(
+            (models.Order.user_id == user.id) & (models.Order.status == models.OrderStatus.CART)
+        ).execution_options(populate_existing=True)
+    )).scalars().first()
+
+    if cart is None:
+        return {**get_empty_cart(), "errors": errors}
+    return {**schemas.order.OrderCartOut.from_orm(cart).dict(), "errors": errors}
 
 
 @cart_router.patch("/{item_id}", response_model=schemas.order.OrderItemOut)
 async def update_cart_item(
         item_id: int,
         item: schemas.product.ProductCartItemUpdate,
-        cart: models.Order = Depends(get_user_current_order),
+        cart: Optional[models.Order] = Depends(get_user_current_order),
         db: AsyncSession = Depends(get_database)
     ):
     """Add an item to the current users cart."""
-    
-    order_item = (await db.execute(select(models.OrderItem).where(
-        (models.OrderItem.id == item_id) & (models.OrderItem.order_id == cart.id)
-    ))).scalars().first()
-    
-    if order_item is None:
+
+    if cart is None:
         raise HTTPException(status_code=404, detail="Cart item was not found")
 
-    quantity_diff = order_item.quantity - item.quantity
-    order_item.quantity = item.quantity
-    order_item.product.quantity += quantity_diff
+    order_item_id = await inventory.update_cart_item(db, cart.id, item_id, item.quantity)
 
-    if (order_item.product.quantity < 0):
+    if order_item_id is None:
+        if (await db.execute(select(models.OrderItem.id).where(
+            (models.OrderItem.id == item_id) & (models.OrderItem.order_id == cart.id)
+        ))).first() is None:
+            raise HTTPException(status_code=404, detail="Cart item was not found")
         raise HTTPException(status_code=400, detail="Not enough stock")
-    
-    cart.updated_at = datetime.utcnow()
+
     await db.commit()
-    await db.refresh(order_item)
 
-    return order_item
+    return await get_cart_item(db, order_item_id)
 
 
 @cart_router.delete("/{item_id}", status_code=204)
 async def delete_cart_item(
         item_id: int,
-        cart: models.Order = Depends(get_user_current_order),
+        cart: Optional[models.Order] = Depends(get_user_current_order),
         db: AsyncSession = Depends(get_database)
     ):
     """Delete an item from the current users cart."""
 
-    order_item = (await db.execute(select(models.OrderItem).where(
-        (models.OrderItem.id == item_id) & (models.OrderItem.order_id == cart.id)
-    ))).scalars().first()
-
-    if order_item is None:
+    if cart is None or not await inventory.remove_cart_item(db, cart.id, item_id):
         raise HTTPException(status_code=404, detail="Cart item was not found")
 
-    order_item.product.quantity += order_item.quantity
-    cart.updated_at = datetime.utcnow()
-    
-    await db.delete(order_item)
     await db.commit()
-    await db.refresh(cart)
+
+
+def get_shipping_options(total_weight: float) -> List[dict]:
+    options = [
+        { 'shipping_rate': shipping_rates['standard'] },
+        { 'shipping_rate': shipping_rates['express'] },
+    ]
+
+    # provide free shipping option for orders under 20 pounds
+    if total_weight < COMPLIMENTARY_SHIPPING_MAX_WEIGHT:
+        options.insert(0, { 'shipping_rate': shipping_rates['complimentary'] })
+
+    return options
+
+
+def checkout_hash(customer: str, items: Sequence[models.OrderItem], shipping_options: List[dict]) -> str:
+    """Hash what a checkout session is made of, two carts with the same hash get the same session.
+
+    Args:
+        customer (str): The user's Stripe customer ID.
+        items (Sequence[models.OrderItem]): The items of the cart, with their products.
+        shipping_options (List[dict]): The shipping options offered.
+
+    Returns:
+        str: The hex digest of the content.
+    """
+    content = json.dumps({
+        "customer": customer,
+        "items": sorted(
+            (item.product_id, item.quantity, int(item.product.price * 100)) for item in items
+        ),
+        "shipping": [option['shipping_rate'] for option in shipping_options],
+    })
+    return hashlib.sha256(content.encode()).hexdigest()
 
 
 @cart_router.post("/checkout/")
 async def checkout_cart(
         user: schemas.user.UserContext = Depends(security.get_current_user),
-        cart: models.Order = Depends(get_user_current_order),
+        cart: Optional[models.Order] = Depends(get_user_current_order),
+        db: AsyncSession = Depends(get_database)
     ):
-    """Checkout the current users cart."""
+    """Checkout the current users cart.
 
-    total_weight = functools.reduce(float.__add__, [item.product.weight * item.quantity for item in cart.items])
+    The stock of the items is held until the checkout session expires.
+    """
 
-    shipping_options = (
-        { 'shipping_rate': shipping_rates['standard'] },
-        { 'shipping_rate': shipping_rates['express'] },
-    )
+    if cart is None:
+        raise HTTPException(status_code=400, detail="Cart is empty")
+
+    # the stripe customer of a new user may still be waiting in the outbox
+    customer_id = user.stripe_id or await stripe_customers.resolve_customer(db, user.id)
+
+    now = datetime.utcnow()
+
+    # a repeated checkout of an unchanged cart gets the session it already has, without touching stripe
+    if (
+        cart.checkout_session_id
+        and cart.checkout_expires_at > now + timedelta(minutes=CHECKOUT_REUSE_MIN_MINUTES)
+        and cart.checkout_hash == checkout_hash(customer_id, cart.items, get_shipping_options(cart.total_weight))
+    ):
+        return { "id": cart.checkout_session_id, "url": cart.checkout_url }
 
-    # provide free shipping option for orders over 20 pounds
-    if total_weight < 20:
-        shipping_options = (
-            { 'shipping_rate': shipping_rates['complimentary'] },
-            *shipping_options
-        )
+    # rounded up to the minute so requests racing for the same cart send identical parameters,
+    # stripe rejects a reused idempotency key whose parameters differ
+    expires_at = (now + timedelta(minutes=CHECKOUT_SESSION_MINUTES + 1)).replace(second=0, microsecond=0)
+    items = await inventory.hold_cart_items(db, cart.id, expires_at + timedelta(minutes=CHECKOUT_HOLD_GRACE_MINUTES))
 
-    checkout_session = stripe.checkout.Session.create(
+    if not items:
+        raise HTTPException(status_code=400, detail="Cart is empty")
+
+    await db.commit()
+
+    # items released since the cart was loaded are gone from its totals too
+    await db.refresh(cart, ["total_weight"])
+
+    shipping_options = get_shipping_options(cart.total_weight)
+    content_hash = checkout_hash(customer_id, items, shipping_options)
+
+    # the expiry is part of the key, so a session that expired is never replayed
+    expires_at_timestamp = int(expires_at.replace(tzinfo=timezone.utc).timestamp())
+    idempotency_key = f"checkout:{cart.id}:{content_hash}:{expires_at_timestamp}"
+
+    create_session = functools.partial(
+        stripe_gateway.call,
+        "checkout.session.create",
+        stripe.checkout.Session.create,
         payment_method_types=['card'],
         success_url=f"{BASE_URL_UI}/orders/{cart.id}?stripe=success",
         cancel_url=f"{BASE_URL_UI}/shop?expand=cart&stripe=canceled",
-        customer=user.stripe_id,
+        customer=customer_id,
+        expires_at=expires_at_timestamp,
         metadata={
             "order_id": cart.id
         },
         line_items=[
             {
+                "price": item.product.stripe_price_id,
+                "quantity": item.quantity,
+            } if stripe_catalog.is_synced(item.product) else {
                 "price_data": {
                     "currency": "usd",
                     "tax_behavior": "exclusive",
@@ -167,7 +339,7 @@ async def checkout_cart(
                     },
                 },
                 "quantity": item.quantity,
-            } for item in cart.items
+            } for item in items
         ],
         customer_update={
             'shipping': 'auto',
@@ -182,4 +354,16 @@ async def checkout_cart(
         mode="payment",
     )
 
+    try:
+        checkout_session = await create_session(idempotency_key=idempotency_key)
+    except stripe.error.IdempotencyError:
+        # the key was used with other parameters, like the inline price of a product synced since
+        checkout_session = await create_session(idempotency_key=f"{idempotency_key}:{uuid4()}")
+
+    cart.checkout_session_id = checkout_session.id
+    cart.checkout_url = checkout_session.url
+    cart.checkout_hash = content_hash
+    cart.checkout_expires_at = expires_at
+    await db.commit()
+
     return { "id": checkout_session.id, "url": checkout_session.url }
\ No newline at end of file
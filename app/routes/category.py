@@ -3,10 +3,12 @@ from typing import Any, List, Optional
 from app import models, schemas
 from app.database import get_database
 from app.dependencies.field_expansion import FieldExpansionQueryParams
+from app.pagination import category_count, paginate
+from app.search.cache import notify_catalog_changed, search_cache
+from app.search.suggest import index_category
 from app.security import get_current_superuser
 from fastapi import APIRouter, Depends, HTTPException
-from fastapi_pagination import Page, add_pagination
-from fastapi_pagination.ext.async_sqlalchemy import paginate
+from fastapi_pagination import add_pagination
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
@@ -14,11 +16,19 @@ from sqlalchemy.orm import selectinload
 category_router = APIRouter()
 
 
-@category_router.get("/", response_model=Page[schemas.category.CategoryOut])
+@category_router.get("/", response_model=schemas.pagination.Page[schemas.category.CategoryOut])
 async def get_all_categories(    
     db: AsyncSession = Depends(get_database)
 ):
-    """List all categories."""
+    """List all categories. The total is cached until a category is created."""
+    return await paginate(db, select(models.Category).order_by(models.Category.slug.asc()), category_count)
+
+
+@category_router.get("/cursor/", response_model=schemas.pagination.CursorPage[schemas.category.CategoryOut])
+async def get_all_categories_with_cursor(
+    db: AsyncSession = Depends(get_database)
+):
+    """List all categories, paginated with opaque cursors instead of page numbers."""
     return await paginate(db, select(models.Category).order_by(models.Category.slug.asc()))
 
 
@@ -61,9 +71,16 @@ async def create_category(
         raise HTTPException(status_code=409, detail="Category will not have a unique slug.")
     
     db.add(category)
+    await db.flush()
 
+    await notify_catalog_changed(db, category_id=category.id)
     await db.commit()
     await db.refresh(category)
+
+    # after the commit, a count taken meanwhile would be cached without the category
+    category_count.invalidate()
+    index_category(category)
+    search_cache.clear()
     
     return category
 
@@ -0,0 +1,103 @@
+from typing import Dict, Optional
+
+from app import guest_cart, schemas
+from app.database import get_database
+from fastapi import APIRouter, Cookie, Depends, Response
+from fastapi.exceptions import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+
+guest_cart_router = APIRouter()
+
+
+async def get_guest_cart_items(guest_cart_cookie: Optional[str] = Cookie(None, alias=guest_cart.COOKIE_KEY)) -> Dict[int, int]:
+    """Get the items of the guest cart, an invalid or missing cookie is an empty cart.
+
+    Args:
+        guest_cart_cookie (Optional[str]): The signed guest cart cookie.
+
+    Returns:
+        Dict[int, int]: The quantity of every product in the cart.
+    """
+    return guest_cart.decode(guest_cart_cookie)
+
+
+async def get_guest_cart_out(db: AsyncSession, items: Dict[int, int]) -> dict:
+    products = await guest_cart.get_products(db, items)
+    return {
+        "items": [
+            {
+                "product": product,
+                "quantity": items[product.id],
+                "in_stock": product.quantity >= items[product.id],
+            } for product in products
+        ]
+    }
+
+
+async def set_quantity(db: AsyncSession, response: Response, items: Dict[int, int], product_id: int, quantity: int) -> dict:
+    items[product_id] = quantity
+
+    cart = await get_guest_cart_out(db, items)
+    item = next((item for item in cart["items"] if item["product"].id == product_id), None)
+
+    if item is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    if not item["in_stock"]:
+        raise HTTPException(status_code=400, detail="Not enough stock")
+
+    guest_cart.set_cookie(response, items)
+    return cart
+
+
+@guest_cart_router.get("/", response_model=schemas.order.GuestCartOut)
+async def get_cart(
+        items: Dict[int, int] = Depends(get_guest_cart_items),
+        db: AsyncSession = Depends(get_database)
+    ):
+    """Get the cart of a shopper who isn't logged in, with the stock checked in one query."""
+    return await get_guest_cart_out(db, items)
+
+
+@guest_cart_router.post("/", response_model=schemas.order.GuestCartOut)
+async def add_to_cart(
+        item: schemas.product.ProductCartItemIn,
+        response: Response,
+        items: Dict[int, int] = Depends(get_guest_cart_items),
+        db: AsyncSession = Depends(get_database)
+    ):
+    """Add an item to the guest cart. The stock is only held once the cart is merged at login."""
+
+    if item.product_id not in items and len(items) >= guest_cart.MAX_ITEMS:
+        raise HTTPException(status_code=400, detail="Cart is full")
+
+    return await set_quantity(db, response, items, item.product_id, items.get(item.product_id, 0) + item.quantity)
+
+
+@guest_cart_router.patch("/{product_id}", response_model=schemas.order.GuestCartOut)
+async def update_cart_item(
+        product_id: int,
+        item: schemas.product.ProductCartItemUpdate,
+        response: Response,
+        items: Dict[int, int] = Depends(get_guest_cart_items),
+        db: AsyncSession = Depends(get_database)
+    ):
+    """Set the quantity of a product in the guest cart."""
+
+    if product_id not in items:
+        raise HTTPException(status_code=404, detail="Cart item was not found")
+
+    return await set_quantity(db, response, items, product_id, item.quantity)
+
+
+@guest_cart_router.delete("/{product_id}", status_code=204)
+async def delete_cart_item(
+        product_id: int,
+        response: Response,
+        items: Dict[int, int] = Depends(get_guest_cart_items)
+    ):
+    """Delete a product from the guest cart."""
+
+    if items.pop(product_id, None) is None:
+        raise HTTPException(status_code=404, detail="Cart item was not found")
+
+    guest_cart.set_cookie(response, items)
@@ -0,0 +1,25 @@
+from app import schemas
+from app.pagination import category_count, search_count
+from app.search.cache import search_cache
+from app.security import get_current_superuser
+from app.stripe_events import recent_events
+from app.stripe_gateway import stripe_gateway
+from fastapi import APIRouter, Depends
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get("/")
+async def get_metrics(
+    user: schemas.user.UserContext = Depends(get_current_superuser) # gaurd to make sure only superusers can see the metrics
+):
+    """Internal counters of this process, used to size the caches."""
+    return {
+        "search_cache": search_cache.stats(),
+        "page_counts": {
+            "category": category_count.stats(),
+            "search": search_count.stats(),
+        },
+        "stripe": stripe_gateway.stats(),
+        "stripe_events": recent_events.stats(),
+    }
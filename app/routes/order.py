@@ -1,28 +1,42 @@
 from fastapi import APIRouter, Depends
 from fastapi.exceptions import HTTPException
-from fastapi_pagination import Page, add_pagination
-from fastapi_pagination.ext.async_sqlalchemy import paginate
+from fastapi_pagination import add_pagination
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import models, schemas
 from app.database import get_database
+from app.pagination import paginate
 from app.security import get_current_user
 
 order_router = APIRouter()
 
-@order_router.get("/", response_model=Page[schemas.order.OrderOut])
+
+def past_orders_statement(user_id: int):
+    # the id breaks ties between orders updated at the same time so cursors stay stable
+    return select(models.Order).where(
+        (models.Order.user_id == user_id) & (models.Order.status != models.OrderStatus.CART)
+    ).order_by(models.Order.updated_at.desc(), models.Order.id.desc())
+
+
+@order_router.get("/", response_model=schemas.pagination.Page[schemas.order.OrderOut])
 async def get_all_past_orders(
         user: models.User = Depends(get_current_user),
         db: AsyncSession = Depends(get_database)
     ):
     """List all past orders. Does not include current order."""
 
-    stmt = select(models.Order).where(
-        (models.Order.user_id == user.id) & (models.Order.status != models.OrderStatus.CART)
-    ).order_by(models.Order.updated_at.desc())
+    return await paginate(db, past_orders_statement(user.id))
+
+
+@order_router.get("/cursor/", response_model=schemas.pagination.CursorPage[schemas.order.OrderOut])
+async def get_all_past_orders_with_cursor(
+        user: models.User = Depends(get_current_user),
+        db: AsyncSession = Depends(get_database)
+    ):
+    """List all past orders, paginated with opaque cursors instead of page numbers. Does not include current order."""
 
-    return await paginate(db, stmt)
+    return await paginate(db, past_orders_statement(user.id))
 
 @order_router.get("/{order_id}/", response_model=schemas.order.OrderOut, response_model_exclude_none=True)
 async def get_order_by_id(
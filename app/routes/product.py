@@ -1,8 +1,12 @@
 from typing import Any, List, Optional
 
-from app import models, schemas
+from app import inventory, models, schemas, stripe_catalog
 from app.database import get_database
 from app.dependencies.field_expansion import FieldExpansionQueryParams
+from app.jobs import job_queue
+from app.search import bm25
+from app.search.cache import notify_catalog_changed, search_cache
+from app.search.suggest import index_product
 from app.security import get_current_employee
 from fastapi import APIRouter, Depends
 from fastapi.exceptions import HTTPException
@@ -26,12 +30,30 @@ async def update_product(
     if item_update is None:
         raise HTTPException(status_code=404, detail="Product not found")
 
+    price_changed = item_update.price != new_product_info.price
+
     item_update.quantity = new_product_info.quantity
     item_update.price = new_product_info.price
 
+    if price_changed:
+        await db.flush()
+        await inventory.refresh_cart_totals(db, product_id)
+
+    if item_update.stock_shards:
+        await inventory.set_stock_shards(db, product_id, item_update.stock_shards, new_product_info.quantity)
+
+    # a product that was never synced waits for `manage stripe sync-catalog`, checkout sends its details meanwhile
+    if item_update.stripe_product_id is not None and not stripe_catalog.is_synced(item_update):
+        job_queue.enqueue(db, stripe_catalog.sync_changed_product, product_id=product_id)
+
+    await notify_catalog_changed(db, product_id=product_id)
     await db.commit()
     await db.refresh(item_update)
 
+    index_product(item_update)
+    bm25.index_product(item_update)
+    search_cache.clear()
+
     return item_update
 
 
@@ -1,48 +1,389 @@
 from typing import Any, List, Optional
 
-from app import models, schemas
+from app import environ, models, schemas
 from app.database import get_database
 from app.dependencies.field_expansion import FieldExpansionQueryParams
-from fastapi import APIRouter, Depends, Query
-from fastapi_pagination import Page, add_pagination
-from fastapi_pagination.ext.async_sqlalchemy import paginate
-from sqlalchemy import or_, select
+from app.models.Product import SEARCH_CONFIG
+from app.pagination import paginate, search_count
+from app.search.bm25 import bm25_index
+from app.search.cache import search_cache
+from app.search.suggest import normalize_prefix, suggestion_index
+from fastapi import APIRouter, Depends, Query, Request, Response
+from fastapi_pagination import add_pagination, create_page, resolve_params
+from sqlalchemy import bindparam, cast, func, literal_column, or_, select
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
+from sqlalchemy.sql import Select
 
 search_router = APIRouter()
 
+# long queries are accepted but only the leading terms are matched, which keeps
+# the tsquery and the number of trigrams to compare bounded
+MAX_QUERY_TERMS = 8
+MAX_FUZZY_QUERY_LENGTH = 32
+MAX_SUGGESTIONS = 3
 
-@search_router.get("/", response_model=Page[schemas.product.ProductOut], response_model_exclude_none=True)
+PRICE_FACET_BUCKET_SIZE = 5
+WEIGHT_FACET_BUCKET_SIZE = 1
+
+
+def normalize_query(q: str) -> str:
+    """Collapse whitespace and drop any terms past `MAX_QUERY_TERMS`.
+
+    Args:
+        q (str): The raw search query.
+
+    Returns:
+        str: The query that will be matched against the products.
+    """
+    return " ".join(q.split()[:MAX_QUERY_TERMS])
+
+
+def fulltext_search_statement(q: str) -> Select:
+    """Match products against the GIN indexed search vector and rank them by relevance.
+
+    Args:
+        q (str): The search query, parsed with the same syntax as web search engines.
+
+    Returns:
+        Select: The statement selecting the matching products.
+    """
+    query = func.websearch_to_tsquery(literal_column(f"'{SEARCH_CONFIG}'::regconfig"), q)
+
+    return select(models.Product).where(
+        models.Product.search_vector.op('@@')(query)
+    ).order_by(
+        func.ts_rank(models.Product.search_vector, query).desc(),
+        models.Product.slug.asc()
+    )
+
+
+def ilike_search_statement(q: str) -> Select:
+    """Match products containing the query anywhere in their name or description.
+
+    Still finds partial words and is served by the trigram indexes.
+
+    Args:
+        q (str): The search query.
+
+    Returns:
+        Select: The statement selecting the matching products.
+    """
+    return select(models.Product).where(
+        or_(
+            models.Product.name.ilike(f"%{q}%"),
+            models.Product.description.ilike(f"%{q}%")
+        )
+    ).order_by(models.Product.slug.asc())
+
+
+def fuzzy_search_statement(q: str) -> Select:
+    """Match products with a word similar to the query in their name or description.
+
+    Uses the trigram indexes, the query is cut to `MAX_FUZZY_QUERY_LENGTH` characters.
+
+    Args:
+        q (str): The search query, possibly misspelled.
+
+    Returns:
+        Select: The statement selecting the matching products, most similar first.
+    """
+    q = q[:MAX_FUZZY_QUERY_LENGTH]
+
+    return select(models.Product).where(
+        or_(
+            models.Product.name.op('%>')(q),
+            models.Product.description.op('%>')(q)
+        )
+    ).order_by(
+        func.greatest(
+            func.word_similarity(q, models.Product.name),
+            func.word_similarity(q, models.Product.description)
+        ).desc(),
+        models.Product.slug.asc()
+    )
+
+
+def bm25_search_statement(q: str) -> Select:
+    """Rank products with the in memory BM25 index, the database only loads the matches by primary key.
+
+    Matches any of the query terms, without the web search syntax of `fulltext`.
+
+    Args:
+        q (str): The search query.
+
+    Returns:
+        Select: The statement selecting the matching products in the order of the index.
+    """
+    ids_type = ARRAY(models.Product.id.type)
+    ranked = func.unnest(
+        cast(bindparam("bm25_ids", bm25_index.search(q), type_=ids_type), ids_type)
+    ).table_valued("id", with_ordinality="rank").render_derived()
+
+    return select(models.Product).join(
+        ranked, ranked.c.id == models.Product.id
+    ).order_by(ranked.c.rank.asc())
+
+
+search_statements = {
+    schemas.search.SearchMode.FULLTEXT:
+        bm25_search_statement if environ.SEARCH_BACKEND == "bm25" else fulltext_search_statement,
+    schemas.search.SearchMode.FUZZY: fuzzy_search_statement,
+    schemas.search.SearchMode.ILIKE: ilike_search_statement,
+    schemas.search.SearchMode.BM25: bm25_search_statement,
+}
+
+
+def facets_statement(stmt: Select) -> Select:
+    """Count the products matched by a search per category, price range, weight range and availability.
+
+    Every facet comes from the same scan of the matches thanks to GROUPING SETS.
+
+    Args:
+        stmt (Select): The search statement, including its filters.
+
+    Returns:
+        Select: A statement returning one row per facet value.
+    """
+    matches = stmt.order_by(None).with_only_columns(
+        models.Product.category_id,
+        (func.floor(models.Product.price / PRICE_FACET_BUCKET_SIZE) * PRICE_FACET_BUCKET_SIZE).label('price'),
+        (func.floor(models.Product.weight / WEIGHT_FACET_BUCKET_SIZE) * WEIGHT_FACET_BUCKET_SIZE).label('weight'),
+        (models.Product.quantity > 0).label('in_stock'),
+    ).subquery()
+
+    return select(
+        matches.c.category_id,
+        matches.c.price,
+        matches.c.weight,
+        matches.c.in_stock,
+        func.grouping(matches.c.category_id).label('by_category'),
+        func.grouping(matches.c.price).label('by_price'),
+        func.grouping(matches.c.weight).label('by_weight'),
+        func.count().label('count'),
+    ).group_by(
+        func.grouping_sets(matches.c.category_id, matches.c.price, matches.c.weight, matches.c.in_stock)
+    )
+
+
+async def load_facets(db: AsyncSession, stmt: Select) -> schemas.search.SearchFacets:
+    facets = schemas.search.SearchFacets(categories=[], price=[], weight=[], in_stock=0, out_of_stock=0)
+
+    for row in (await db.execute(facets_statement(stmt))).all():
+        if row.by_category == 0:
+            facets.categories.append(schemas.search.CategoryFacet(category_id=row.category_id, count=row.count))
+        elif row.by_price == 0:
+            facets.price.append(schemas.search.RangeFacet(
+                start=row.price, end=row.price + PRICE_FACET_BUCKET_SIZE, count=row.count))
+        elif row.by_weight == 0:
+            facets.weight.append(schemas.search.RangeFacet(
+                start=row.weight, end=row.weight + WEIGHT_FACET_BUCKET_SIZE, count=row.count))
+        elif row.in_stock:
+            facets.in_stock = row.count
+        else:
+            facets.out_of_stock = row.count
+
+    facets.categories.sort(key=lambda facet: facet.count, reverse=True)
+    facets.price.sort(key=lambda facet: facet.start)
+    facets.weight.sort(key=lambda facet: facet.start)
+
+    return facets
+
+
+async def fuzzy_search(db: AsyncSession, stmt: Select, q: str, facets: Optional[schemas.search.SearchFacets]) -> schemas.search.SearchPage:
+    """Run a fuzzy search statement, the page, the total and the "did you mean" suggestions all
+    come from a single query.
+
+    Args:
+        db (AsyncSession): The database session.
+        stmt (Select): The fuzzy search statement, including its filters and expansions.
+        q (str): The search query, possibly misspelled.
+        facets (Optional[schemas.search.SearchFacets]): The facets to return with the page.
+
+    Returns:
+        schemas.search.SearchPage: The ranked page of products.
+    """
+    q = q[:MAX_FUZZY_QUERY_LENGTH]
+    params = resolve_params()
+    raw_params = params.to_raw_params()
+
+    stmt = stmt.add_columns(
+        func.word_similarity(q, models.Product.name).label('name_score'),
+        func.count().over().label('total')
+    ).limit(raw_params.limit).offset(raw_params.offset)
+
+    rows = (await db.execute(stmt)).all()
+    total = rows[0].total if rows else 0
+
+    suggestions = None
+    # only offer suggestions when nothing was spelled exactly like the query
+    if rows and all(row.name_score < 1 for row in rows):
+        ranked = sorted(rows, key=lambda row: row.name_score, reverse=True)
+        suggestions = [row.Product.name for row in ranked[:MAX_SUGGESTIONS]]
+
+    return create_page([row.Product for row in rows], total, params, suggestions=suggestions, facets=facets)
+
+
+class SearchQueryParams():
+    def __init__(
+        self,
+        q: str = Query(
+            default=...,
+            description="The search query. Only the first few terms are used.",
+            max_length=100
+        ),
+        mode: schemas.search.SearchMode = Query(
+            default=schemas.search.SearchMode.FULLTEXT,
+            description="How to match the query. `fulltext` ranks by relevance, `fuzzy` tolerates typos, "
+                        + "`ilike` matches partial words and `bm25` ranks with the in memory index."
+        ),
+        category_id: Optional[int] = Query(
+            default=None,
+            description="Only match products in this category."
+        ),
+        min_price: Optional[float] = Query(
+            default=None,
+            description="Only match products costing at least this much.",
+            ge=0
+        ),
+        max_price: Optional[float] = Query(
+            default=None,
+            description="Only match products costing at most this much.",
+            ge=0
+        ),
+        in_stock: Optional[bool] = Query(
+            default=None,
+            description="Only match products that are (or are not) in stock."
+        ),
+    ):
+        """The query and filters shared by the search endpoints."""
+        self.q = normalize_query(q)
+        self.mode = mode
+        self.category_id = category_id
+        self.min_price = min_price
+        self.max_price = max_price
+        self.in_stock = in_stock
+
+    def key(self) -> tuple:
+        # every mode is case insensitive
+        return (self.q.lower(), self.mode, self.category_id, self.min_price, self.max_price, self.in_stock)
+
+    def statement(self) -> Select:
+        """Build the search statement of the mode with the filters pushed down into its WHERE clause.
+
+        Returns:
+            Select: The statement selecting the matching products, best matches first.
+        """
+        stmt = search_statements[self.mode](self.q)
+
+        if self.category_id is not None:
+            stmt = stmt.where(models.Product.category_id == self.category_id)
+        if self.min_price is not None:
+            stmt = stmt.where(models.Product.price >= self.min_price)
+        if self.max_price is not None:
+            stmt = stmt.where(models.Product.price <= self.max_price)
+        if self.in_stock is not None:
+            stmt = stmt.where(models.Product.quantity > 0 if self.in_stock else models.Product.quantity <= 0)
+
+        return stmt
+
+
+search_expansions = FieldExpansionQueryParams({
+    'category': selectinload(models.Product.category)
+})
+
+
+@search_router.get("/", response_model=schemas.search.SearchPage[schemas.product.ProductOut], response_model_exclude_none=True)
 async def search(
-    q: str = Query(
-        default=...,
-        description="The search query.",
-        max_length=20
+    request: Request,
+    search_params: SearchQueryParams = Depends(),
+    facets: bool = Query(
+        default=False,
+        description="Also count the matching products per category, price, weight and availability."
     ),
-    expansions: Optional[List[Any]] = Depends(FieldExpansionQueryParams({
-        'category': selectinload(models.Product.category)
-    })),
+    expansions: Optional[List[Any]] = Depends(search_expansions),
     db: AsyncSession = Depends(get_database)
 ):
     """Returns a list of products that match the search query in their name or description field
 
+    Responses are cached for a short while. Product stock shown in cached
+    results can lag behind by up to `SEARCH_CACHE_TTL_SECONDS`. Totals above
+    `PAGE_COUNT_ESTIMATE_THRESHOLD` are estimated, see `total_is_approximate`.
+
     Exapndable fields:
         - category
     """
 
-    stmt = select(models.Product).where(
-        or_(
-            models.Product.name.ilike(f"%{q}%"),
-            models.Product.description.ilike(f"%{q}%")
-        )
-    ).order_by(models.Product.slug.asc())
+    params = resolve_params()
+
+    cache_key = (*search_params.key(), facets, request.query_params.get('expand'), params.page, params.size)
+    body = search_cache.get(cache_key)
+
+    if body is not None:
+        return Response(body, media_type="application/json", headers={"X-Cache": "hit"})
+
+    stmt = search_params.statement()
+
+    search_facets = await load_facets(db, stmt) if facets else None
 
     if expansions:
         stmt = stmt.options(*expansions)
-    results = await paginate(db, stmt)
 
-    return results
+    if search_params.mode == schemas.search.SearchMode.FUZZY:
+        results = await fuzzy_search(db, stmt, search_params.q, search_facets)
+    else:
+        results = await paginate(db, stmt, search_count)
+        results.facets = search_facets
+
+    body = results.json(exclude_none=True).encode()
+    search_cache.set(cache_key, body)
+
+    return Response(body, media_type="application/json", headers={"X-Cache": "miss"})
+
+
+@search_router.get("/cursor/", response_model=schemas.pagination.CursorPage[schemas.product.ProductOut], response_model_exclude_none=True)
+async def search_with_cursor(
+    search_params: SearchQueryParams = Depends(),
+    expansions: Optional[List[Any]] = Depends(search_expansions),
+    db: AsyncSession = Depends(get_database)
+):
+    """Same as the search endpoint, but paginated with opaque cursors instead of page numbers.
+
+    Doesn't count the matches, so scrolling deep into the results costs the same as the first page.
+
+    Exapndable fields:
+        - category
+    """
+
+    stmt = search_params.statement()
+
+    if expansions:
+        stmt = stmt.options(*expansions)
+
+    return await paginate(db, stmt)
+
+
+@search_router.get("/suggest/", response_model=List[schemas.search.Suggestion])
+async def suggest(
+    q: str = Query(
+        default=...,
+        description="What the user has typed so far.",
+        min_length=1,
+        max_length=100
+    ),
+    limit: int = Query(
+        default=5,
+        description="The maximum number of suggestions.",
+        ge=1,
+        le=suggestion_index.k
+    )
+):
+    """Returns the most popular products and categories with a word starting with the query.
+
+    Served from an in memory index, so it is cheap enough to call on every keystroke.
+    """
+    return suggestion_index.suggest(normalize_prefix(q), limit)
 
 
 add_pagination(search_router)
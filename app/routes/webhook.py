@@ -1,15 +1,13 @@
 import json
-from datetime import datetime
-from traceback import print_exc
 
-import requests
 import stripe
 from app import models
 from app.database import get_database
-from app.environ import ENVIRONMENT, POSITIONSTACK_API_KEY, STRIPE_SIGNING_KEY
+from app.environ import ENVIRONMENT, STRIPE_SIGNING_KEY
+from app.stripe_events import recent_events
 from fastapi import APIRouter, Depends, Request
 from fastapi.exceptions import HTTPException
-from sqlalchemy import select
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 webhook_router = APIRouter()
@@ -20,70 +18,33 @@ async def stripe_webhook(
     request: Request,
     db: AsyncSession = Depends(get_database)
 ):
+    """Store a Stripe event and acknowledge it right away, it is processed in the background by app.stripe_events."""
 
     request_body = await request.body()
 
-    # Retrieve the event by verifying the signature using the raw body and secret if webhook signing is configured.
+    # Verify the signature using the raw body and secret if webhook signing is configured.
     try:
-        event = stripe.Webhook.construct_event(
-            request_body,
+        stripe.WebhookSignature.verify_header(
+            request_body.decode("utf-8"),
             request.headers["stripe-signature"],
             STRIPE_SIGNING_KEY
         )
     except (stripe.error.SignatureVerificationError, KeyError) as e:
         if ENVIRONMENT == "production":  # pragma: no cover
             raise HTTPException(status_code=400, detail=f"Bad signature.")
-        else:  # pragma: no cover
-            event = json.loads(request_body)
 
-    if event['type'] == 'checkout.session.completed':
-        checkout_session = event['data']['object']
-        order_id = int(checkout_session['metadata']['order_id'])
+    event = json.loads(request_body)
 
-        stmt = select(models.Order).where(models.Order.id == order_id)
-        order = (await db.execute(stmt)).scalars().first()
+    # a redelivery of an event this process already stored or applied
+    if event['id'] in recent_events:
+        return
 
-        order.stripe_id = checkout_session['payment_intent']
-        order.status = models.OrderStatus.ORDERED
+    await db.execute(insert(models.StripeEvent).values(
+        event_id=event['id'],
+        type=event['type'],
+        payload=event,
+    ))
+    # committed before answering, stripe must only stop retrying once the event is stored
+    await db.commit()
 
-        order.amount_total = round(checkout_session['amount_total'] / 100, 2)
-        order.amount_subtotal = round(
-            checkout_session['amount_subtotal'] / 100, 2)
-        order.amount_tax = round(
-            checkout_session['total_details']['amount_tax'] / 100, 2)
-        order.amount_shipping = round(
-            checkout_session['total_details']['amount_shipping'] / 100, 2)
-
-        address = checkout_session['shipping_details']['address']
-        short_address = address['line1'] + (" " + address['line2']
-                                            if address['line2'] else '') + ', ' + address['city']
-        long_address = short_address + ', ' + \
-            address['state'] + ', ' + address['postal_code'] + \
-            ', ' + address['country']
-
-        try:
-            res = requests.get('http://api.positionstack.com/v1/forward', params={
-                'access_key': POSITIONSTACK_API_KEY,
-                'query': long_address,
-                'limit': 1,
-            })
-
-            # TODO: find better API throws too many 502 errors
-            if res.status_code == 200:
-                data = res.json()
-
-                if len(data['data']) > 0:
-                    order.latitude = data['data'][0]['latitude']
-                    order.longitude = data['data'][0]['longitude']
-        except json.JSONDecodeError:
-            # known issue returning html when overloaded
-            pass
-        except TypeError:
-            # known issue with positionstack API returning: {'data': [[]]}
-            pass
-        except Exception as e:
-            # ignore all other errors but report them
-            print_exc(e)
-
-        order.address = short_address
-        order.updated_at = datetime.utcnow()
+    recent_events.add(event['id'])
@@ -0,0 +1,52 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Tuple
+
+logger = logging.getLogger("uvicorn.error")
+
+Job = Callable[[], Awaitable[None]]
+
+
+class Scheduler:
+    def __init__(self):
+        """Runs coroutines periodically in the background of the app's event loop.
+
+        Every process runs every job, so jobs must be safe to run concurrently.
+        """
+        self._jobs: List[Tuple[float, Job]] = []
+        self._tasks: List[asyncio.Task] = []
+
+    def every(self, seconds: float) -> Callable[[Job], Job]:
+        """Register a job to run every `seconds` seconds once the scheduler is started.
+
+        Args:
+            seconds (float): The time between the end of a run and the start of the next one.
+
+        Returns:
+            Callable[[Job], Job]: A decorator registering the job.
+        """
+        def decorator(job: Job) -> Job:
+            self._jobs.append((seconds, job))
+            return job
+        return decorator
+
+    async def _run(self, seconds: float, job: Job):
+        while True:
+            await asyncio.sleep(seconds)
+            try:
+                await job()
+            except Exception:
+                # keep the job scheduled, the next run may well succeed
+                logger.exception(f"Scheduled job {job.__name__} failed.")
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._run(seconds, job)) for seconds, job in self._jobs]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+scheduler = Scheduler()
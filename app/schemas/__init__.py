@@ -1 +1,2 @@
-from . import authentication, category, order, product, user
+from . import (authentication, category, order, pagination, product, search,
+               user)
@@ -1,7 +1,8 @@
+import enum
 from datetime import datetime
 from typing import List, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, conint, conlist, validator
 
 from app.models.Order import OrderStatus
 from app.schemas.product import ProductOut
@@ -12,22 +13,81 @@ class OrderItemOut(BaseModel):
     order_id: int = Field(..., description="The order's ID.", example=42)
     quantity: int = Field(..., description="The quantity of the product in the cart.", example=1)
     product: ProductOut = Field(..., description="The product in the order.")
+    reserved_until: Optional[datetime] = Field(
+        None, description="When the stock held for a cart item is released, null once ordered.", example="2021-05-01T01:00:00.000000")
 
     class Config:
         orm_mode = True
 
+class GuestCartItemOut(BaseModel):
+    product: ProductOut = Field(..., description="The product in the cart.")
+    quantity: int = Field(..., description="The quantity of the product in the cart.", example=1)
+    in_stock: bool = Field(..., description="Whether the quantity is still in stock, it is only held once merged at login.", example=True)
+
+
+class GuestCartOut(BaseModel):
+    items: List[GuestCartItemOut] = Field(..., description="The items in the cart, in the order they were added.")
+
+
+class OrderCartSummaryOut(BaseModel):
+    id: Optional[int] = Field(..., description="The cart id, null until the first item is added.", example=1)
+    item_count: int = Field(..., description="The number of units in the cart.", example=3)
+    subtotal_cents: int = Field(..., description="The price of the items in cents, before shipping and tax.", example=1797)
+    total_weight: float = Field(..., description="The weight of the items in pounds.", example=4.5)
+    free_shipping: bool = Field(..., description="Whether the cart is light enough for complimentary shipping.", example=True)
+
+    class Config:
+        orm_mode = True
+
+
+class CartChangeOp(str, enum.Enum):
+    SET = "set"
+    ADD = "add"
+    REMOVE = "remove"
+
+
+class CartChangeIn(BaseModel):
+    product_id: int = Field(..., description="The product id.", example=1)
+    op: CartChangeOp = Field(CartChangeOp.SET, description="Whether to set, add to or remove the quantity of the product.", example=CartChangeOp.SET)
+    quantity: conint(strict=True, ge=0) = Field(0, description="The quantity to set or add, 0 removes the product.", example=2)
+
+
+class CartChangesIn(BaseModel):
+    changes: conlist(CartChangeIn, min_items=1, max_items=100) = Field(..., description="The changes, at most one per product.")
+
+    @validator("changes")
+    def one_change_per_product(cls, changes):
+        if len({change.product_id for change in changes}) != len(changes):
+            raise ValueError("a product can only be changed once")
+        return changes
+
+
+class CartChangeErrorOut(BaseModel):
+    product_id: int = Field(..., description="The product id of the change.", example=1)
+    detail: str = Field(..., description="Why the change wasn't applied.", example="Not enough stock")
+
+
 class OrderCartOut(BaseModel):
-    id: int = Field(..., description="The cart id.", example=1) 
+    id: Optional[int] = Field(..., description="The cart id, null until the first item is added.", example=1) 
     status: OrderStatus = Field(..., description="The cart status.", example=OrderStatus.CART)
     updated_at: datetime = Field(..., description="The datetime the cart was updated at.", example="2021-05-01T00:00:00.000000") 
+    item_count: int = Field(..., description="The number of units in the cart.", example=3)
+    subtotal_cents: int = Field(..., description="The price of the items in cents, before shipping and tax.", example=1797)
+    total_weight: float = Field(..., description="The weight of the items in pounds.", example=4.5)
     created_at: datetime = Field(..., description="The datetime the cart was created at.", example="2021-05-01T00:00:00.000000")
     items: List[OrderItemOut] = Field(..., description="The items in the cart.")
 
     class Config:
         orm_mode = True
 
+
+
+class OrderCartChangesOut(OrderCartOut):
+    errors: List[CartChangeErrorOut] = Field(..., description="The changes that weren't applied, the others were.")
+
         
 class OrderOut(OrderCartOut):
+    id: int = Field(..., description="The order id.", example=1)
     amount_total: float = Field(..., description="The total amount of the order.", example=42.0)
     amount_subtotal: float = Field(..., description="The subtotal amount of the order.", example=42.0)
     amount_shipping: float = Field(..., description="The shipping amount of the order.", example=42.0)
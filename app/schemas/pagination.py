@@ -0,0 +1,31 @@
+import binascii
+from typing import Generic, Optional, TypeVar
+
+from fastapi import HTTPException, Query
+from fastapi_pagination import Page as BasePage
+from fastapi_pagination.bases import CursorRawParams
+from fastapi_pagination.cursor import CursorPage as BaseCursorPage
+from fastapi_pagination.cursor import CursorParams as BaseCursorParams
+from pydantic import Field
+
+T = TypeVar("T")
+
+
+class CursorParams(BaseCursorParams):
+    cursor: Optional[str] = Query(None, description="The cursor of the page to get, from `next_page` or `previous_page`.")
+    size: int = Query(50, ge=1, le=100, description="Page size")
+
+    def to_raw_params(self) -> CursorRawParams:
+        try:
+            return super().to_raw_params()
+        except (binascii.Error, UnicodeDecodeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+class CursorPage(BaseCursorPage[T], Generic[T]):
+    __params_type__ = CursorParams
+
+
+class Page(BasePage[T], Generic[T]):
+    total_is_approximate: bool = Field(
+        False, description="Whether `total` is an estimate rather than an exact count.", example=False)
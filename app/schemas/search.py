@@ -0,0 +1,52 @@
+import enum
+from typing import Generic, List, Optional, TypeVar
+
+from pydantic import BaseModel, Field
+
+from .pagination import Page
+
+T = TypeVar("T")
+
+
+class SearchMode(str, enum.Enum):
+    FULLTEXT = "fulltext"
+    FUZZY = "fuzzy"
+    ILIKE = "ilike"
+    BM25 = "bm25"
+
+
+class SuggestionType(str, enum.Enum):
+    PRODUCT = "product"
+    CATEGORY = "category"
+
+
+class Suggestion(BaseModel):
+    type: SuggestionType = Field(..., description="Whether the suggestion is a product or a category.", example=SuggestionType.PRODUCT)
+    name: str = Field(..., description="The name to display.", example="Broccoli")
+    slug: str = Field(..., description="The slug of the product or category.", example="broccoli")
+
+
+class CategoryFacet(BaseModel):
+    category_id: int = Field(..., description="The category's ID.", example=42)
+    count: int = Field(..., description="The number of matching products in the category.", example=7)
+
+
+class RangeFacet(BaseModel):
+    start: float = Field(..., description="The inclusive lower bound of the bucket.", example=5.0)
+    end: float = Field(..., description="The exclusive upper bound of the bucket.", example=10.0)
+    count: int = Field(..., description="The number of matching products in the bucket.", example=3)
+
+
+class SearchFacets(BaseModel):
+    categories: List[CategoryFacet] = Field(..., description="The matching products per category.")
+    price: List[RangeFacet] = Field(..., description="The matching products per price range.")
+    weight: List[RangeFacet] = Field(..., description="The matching products per weight range.")
+    in_stock: int = Field(..., description="The number of matching products in stock.", example=12)
+    out_of_stock: int = Field(..., description="The number of matching products out of stock.", example=1)
+
+
+class SearchPage(Page[T], Generic[T]):
+    suggestions: Optional[List[str]] = Field(
+        None, description="Product names the user may have meant. Only set for fuzzy searches.", example=["Broccoli"])
+    facets: Optional[SearchFacets] = Field(
+        None, description="Counts over every matching product. Only set when requested.")
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseModel, EmailStr, Field
 
 
@@ -10,7 +12,7 @@ class NewUserIn(BaseModel):
 
 class UserContext(BaseModel):
     id: int = Field(..., description="The id of the user", example=1)
-    stripe_id: str = Field(..., description="The id of the user in stripe", example="cus_MrTJhD1j3KQwTX")
+    stripe_id: Optional[str] = Field(None, description="The id of the user in stripe, none until it is created", example="cus_MrTJhD1j3KQwTX")
     
     firstname: str = Field(..., description="The firstname of the user", example="John")
     lastname: str = Field(..., description="The lastname of the user", example="Doe")
@@ -0,0 +1,249 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from app import models
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+_word_split = re.compile(r"[^a-z0-9]+")
+
+# words too common in product copy to tell products apart
+STOP_WORDS = frozenset({
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is",
+    "it", "of", "on", "or", "that", "the", "this", "to", "with", "your",
+})
+
+# a term in the name counts as much as this many terms in the description
+NAME_WEIGHT = 2
+
+
+def _stem(word: str) -> str:
+    # fold the common english plurals, so "apple" finds "apples" and "berry" finds "berries"
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase, plural folded terms, without the stop words.
+
+    Args:
+        text (str): A product name, description or search query.
+
+    Returns:
+        List[str]: The terms, in order and with repetitions.
+    """
+    return [_stem(word) for word in _word_split.split(text.lower()) if word and word not in STOP_WORDS]
+
+
+class BM25Index:
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        """An inverted index of the catalog scored with Okapi BM25.
+
+        The postings of every term are a pair of numpy arrays (document rows and term
+        frequencies), so scoring a query is a handful of vectorized operations per term.
+        Updating a product tombstones its old row and appends a new one, the dead rows
+        are dropped once they make up half of the index.
+
+        Args:
+            k1 (float, optional): How quickly repeated terms stop adding to the score. Defaults to 1.2.
+            b (float, optional): How much long documents are penalized. Defaults to 0.75.
+        """
+        self.k1 = k1
+        self.b = b
+        self.clear()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def clear(self):
+        self._terms: Dict[str, int] = {}
+        self._docs: List[np.ndarray] = []
+        self._tfs: List[np.ndarray] = []
+
+        self._product_ids = np.zeros(0, dtype=np.int64)
+        self._doc_lengths = np.zeros(0, dtype=np.float32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._size = 0
+
+        # product id -> row
+        self._rows: Dict[int, int] = {}
+        self._total_length = 0.0
+
+    @staticmethod
+    def _frequencies(name: str, description: str) -> Counter:
+        frequencies = Counter(tokenize(description))
+        for term, count in Counter(tokenize(name)).items():
+            frequencies[term] += count * NAME_WEIGHT
+        return frequencies
+
+    def _term_id(self, term: str) -> int:
+        term_id = self._terms.get(term)
+        if term_id is None:
+            term_id = self._terms[term] = len(self._docs)
+            self._docs.append(np.zeros(0, dtype=np.int32))
+            self._tfs.append(np.zeros(0, dtype=np.float32))
+        return term_id
+
+    def _grow(self):
+        capacity = max(16, 2 * len(self._alive))
+        self._product_ids = np.resize(self._product_ids, capacity)
+        self._doc_lengths = np.resize(self._doc_lengths, capacity)
+        self._alive = np.resize(self._alive, capacity)
+        self._alive[self._size:] = False
+
+    def build(self, products: Iterable[Tuple[int, str, str]]):
+        """Replace the whole index, building every posting array at once.
+
+        Args:
+            products (Iterable[Tuple[int, str, str]]): The (id, name, description) of every product.
+        """
+        self.clear()
+
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        product_ids = []
+        doc_lengths = []
+
+        for row, (product_id, name, description) in enumerate(products):
+            frequencies = self._frequencies(name, description)
+            for term, count in frequencies.items():
+                docs, tfs = postings.setdefault(term, ([], []))
+                docs.append(row)
+                tfs.append(count)
+            product_ids.append(product_id)
+            doc_lengths.append(sum(frequencies.values()))
+            self._rows[product_id] = row
+
+        for term, (docs, tfs) in postings.items():
+            self._terms[term] = len(self._docs)
+            self._docs.append(np.array(docs, dtype=np.int32))
+            self._tfs.append(np.array(tfs, dtype=np.float32))
+
+        self._product_ids = np.array(product_ids, dtype=np.int64)
+        self._doc_lengths = np.array(doc_lengths, dtype=np.float32)
+        self._alive = np.ones(len(product_ids), dtype=bool)
+        self._size = len(product_ids)
+        self._total_length = float(sum(doc_lengths))
+
+    def add(self, product_id: int, name: str, description: str):
+        """Index a product, replacing its previous version.
+
+        Args:
+            product_id (int): The product's ID.
+            name (str): The product's name.
+            description (str): The product's description.
+        """
+        self.remove(product_id)
+
+        if self._size == len(self._alive):
+            self._grow()
+
+        row = self._size
+        self._size += 1
+
+        frequencies = self._frequencies(name, description)
+        for term, count in frequencies.items():
+            term_id = self._term_id(term)
+            self._docs[term_id] = np.append(self._docs[term_id], np.int32(row))
+            self._tfs[term_id] = np.append(self._tfs[term_id], np.float32(count))
+
+        length = sum(frequencies.values())
+        self._product_ids[row] = product_id
+        self._doc_lengths[row] = length
+        self._alive[row] = True
+        self._rows[product_id] = row
+        self._total_length += length
+
+    def remove(self, product_id: int):
+        """Remove a product, does nothing if it isn't indexed.
+
+        Args:
+            product_id (int): The product's ID.
+        """
+        row = self._rows.pop(product_id, None)
+        if row is None:
+            return
+
+        self._alive[row] = False
+        self._total_length -= float(self._doc_lengths[row])
+
+        if self._size - len(self._rows) > max(len(self._rows), 64):
+            self._compact()
+
+    def _compact(self):
+        alive = self._alive[:self._size]
+        new_rows = np.cumsum(alive, dtype=np.int32) - 1
+
+        for term_id, docs in enumerate(self._docs):
+            live = alive[docs]
+            self._docs[term_id] = new_rows[docs[live]]
+            self._tfs[term_id] = self._tfs[term_id][live]
+
+        self._product_ids = self._product_ids[:self._size][alive]
+        self._doc_lengths = self._doc_lengths[:self._size][alive]
+        self._size = len(self._product_ids)
+        self._alive = np.ones(self._size, dtype=bool)
+        self._rows = {int(product_id): row for row, product_id in enumerate(self._product_ids)}
+
+    def search(self, q: str) -> List[int]:
+        """Rank the products containing any of the query terms.
+
+        Args:
+            q (str): The search query.
+
+        Returns:
+            List[int]: The IDs of the matching products, best match first and ties broken by ID.
+        """
+        if not self._rows:
+            return []
+
+        count = len(self._rows)
+        average_length = self._total_length / count
+        scores = np.zeros(self._size, dtype=np.float32)
+
+        for term in set(tokenize(q)):
+            term_id = self._terms.get(term)
+            if term_id is None:
+                continue
+
+            docs = self._docs[term_id]
+            live = self._alive[docs]
+            docs = docs[live]
+            if not len(docs):
+                continue
+            tfs = self._tfs[term_id][live]
+
+            idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+            norms = self.k1 * (1 - self.b + self.b * self._doc_lengths[docs] / average_length)
+            # the rows of a posting array are unique, so a fancy indexed add is safe
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norms)
+
+        matches = np.flatnonzero(scores)
+        order = np.lexsort((self._product_ids[matches], -scores[matches]))
+
+        return self._product_ids[matches[order]].tolist()
+
+
+bm25_index = BM25Index()
+
+
+def index_product(product: models.Product):
+    bm25_index.add(product.id, product.name, product.description)
+
+
+async def rebuild_bm25_index(db: AsyncSession):
+    """Reload the name and description of every product.
+
+    Args:
+        db (AsyncSession): The database session.
+    """
+    products = (await db.execute(
+        select(models.Product.id, models.Product.name, models.Product.description)
+    )).all()
+
+    bm25_index.build(products)
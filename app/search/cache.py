@@ -0,0 +1,270 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Set
+
+import asyncpg
+from app import environ, models
+from app.database import async_session_factory
+from app.pagination import category_count
+from app.search import bm25, suggest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# postgres channel used to tell every app process that the catalog changed
+CATALOG_CHANNEL = "catalog_changed"
+# how often the idle listener checks its connection, and waits before reconnecting
+CATALOG_LISTENER_PING_SECONDS = 30
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class _Entry:
+    __slots__ = ("value", "expires_at", "hits")
+
+    def __init__(self, value: bytes, expires_at: float):
+        self.value = value
+        self.expires_at = expires_at
+        self.hits = 0
+
+
+class SearchCache:
+    def __init__(self, max_bytes: int, ttl: float, eviction_sample: int = 8, clock: Callable[[], float] = time.monotonic):
+        """A size bounded cache of serialized search responses.
+
+        Entries expire after `ttl` seconds. When full, the least popular of the `eviction_sample`
+        least recently used entries is evicted, so a burst of one-off queries can't push out
+        the handful of queries most of the traffic is made of.
+
+        Args:
+            max_bytes (int): The maximum total size of the cached responses.
+            ttl (float): How many seconds an entry stays fresh.
+            eviction_sample (int, optional): How many entries to consider when evicting. Defaults to 8.
+            clock (Callable[[], float], optional): Returns the current time in seconds. Defaults to time.monotonic.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.eviction_sample = eviction_sample
+        self.clock = clock
+
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, key: Hashable):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.value)
+
+    def _evict(self):
+        now = self.clock()
+        candidates = itertools.islice(self._entries.items(), self.eviction_sample)
+        # expired entries go first, then the ones with the fewest hits
+        key, entry = min(candidates, key=lambda item: (item[1].expires_at > now, item[1].hits))
+        if entry.expires_at > now:
+            self.evictions += 1
+        else:
+            self.expirations += 1
+        self._drop(key)
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """Get a fresh cached response.
+
+        Args:
+            key (Hashable): Identifies the search.
+
+        Returns:
+            Optional[bytes]: The cached response, None on a miss.
+        """
+        entry = self._entries.get(key)
+
+        if entry is not None and entry.expires_at <= self.clock():
+            self._drop(key)
+            self.expirations += 1
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entry.hits += 1
+        self._entries.move_to_end(key)
+        return entry.value
+
+    def set(self, key: Hashable, value: bytes):
+        """Cache a response, evicting others to make room for it.
+
+        Args:
+            key (Hashable): Identifies the search.
+            value (bytes): The serialized response.
+        """
+        if len(value) > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._drop(key)
+
+        while self._bytes + len(value) > self.max_bytes:
+            self._evict()
+
+        self._entries[key] = _Entry(value, self.clock() + self.ttl)
+        self._bytes += len(value)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+search_cache = SearchCache(
+    max_bytes=environ.SEARCH_CACHE_MAX_BYTES,
+    ttl=environ.SEARCH_CACHE_TTL_SECONDS
+)
+
+
+async def notify_catalog_changed(db: AsyncSession, product_id: Optional[int] = None, category_id: Optional[int] = None):
+    """Tell every process that the catalog changed, once the transaction commits.
+
+    They clear their cached searches and reindex the product or category that changed, or
+    every one of them when neither is given. The caller clears the cache of its own process
+    after committing, a search served before the commit would cache the old catalog again.
+
+    Args:
+        db (AsyncSession): The session of the transaction that changed the catalog.
+        product_id (Optional[int], optional): The product that changed.
+        category_id (Optional[int], optional): The category that changed.
+    """
+    if product_id is not None:
+        payload = f"product:{product_id}"
+    elif category_id is not None:
+        payload = f"category:{category_id}"
+    else:
+        payload = ""
+
+    await db.execute(select(func.pg_notify(CATALOG_CHANNEL, payload)))
+
+
+async def reindex_catalog(db: AsyncSession, payload: str):
+    """Bring the search indexes of this process up to date with a catalog change notification.
+
+    Args:
+        db (AsyncSession): The database session.
+        payload (str): The notification's payload, see `notify_catalog_changed`.
+    """
+    kind, _, object_id = payload.partition(":")
+
+    if kind == "product":
+        product = await db.get(models.Product, int(object_id))
+        if product is None:
+            bm25.bm25_index.remove(int(object_id))
+            suggest.suggestion_index.remove(("product", int(object_id)))
+        else:
+            bm25.index_product(product)
+            suggest.index_product(product)
+    elif kind == "category":
+        category = await db.get(models.Category, int(object_id))
+        if category is None:
+            suggest.suggestion_index.remove(("category", int(object_id)))
+        else:
+            suggest.index_category(category)
+    else:
+        await suggest.rebuild_suggestion_index(db)
+        await bm25.rebuild_bm25_index(db)
+
+
+_listener: Optional[asyncio.Task] = None
+_reindexing: Set[asyncio.Task] = set()
+
+
+def _on_catalog_changed(connection, pid, channel, payload: str): # pragma: no cover
+    search_cache.clear()
+    category_count.invalidate()
+
+    # the notification arrives once the change is committed, so reading it back sees it
+    task = asyncio.create_task(_reindex(payload))
+    _reindexing.add(task)
+    task.add_done_callback(_reindexing.discard)
+
+
+async def _reindex(payload: str): # pragma: no cover
+    try:
+        async with async_session_factory() as db:
+            await reindex_catalog(db, payload)
+    except Exception:
+        logger.exception(f"Reindexing the catalog change {payload!r} failed.")
+
+
+async def _listen(): # pragma: no cover
+    reconnecting = False
+    while True:
+        try:
+            connection = await asyncpg.connect(environ.DATABASE_URL)
+        except Exception:
+            logger.exception("Connecting the catalog listener failed.")
+            await asyncio.sleep(CATALOG_LISTENER_PING_SECONDS)
+            continue
+
+        try:
+            closed = asyncio.Event()
+            connection.add_termination_listener(lambda _: closed.set())
+            await connection.add_listener(CATALOG_CHANNEL, _on_catalog_changed)
+
+            # the changes made while disconnected were missed, everything is reloaded
+            if reconnecting:
+                logger.warning("The catalog listener reconnected.")
+                _on_catalog_changed(connection, None, CATALOG_CHANNEL, "")
+
+            # a dropped connection is noticed when it closes, or when a ping fails
+            while not closed.is_set():
+                try:
+                    await asyncio.wait_for(closed.wait(), CATALOG_LISTENER_PING_SECONDS)
+                except asyncio.TimeoutError:
+                    await asyncio.wait_for(connection.execute("SELECT 1"), CATALOG_LISTENER_PING_SECONDS)
+        except asyncio.CancelledError:
+            await connection.close(timeout=CATALOG_LISTENER_PING_SECONDS)
+            raise
+        except Exception:
+            logger.exception("The catalog listener lost its connection.")
+
+        connection.terminate()
+        reconnecting = True
+
+
+async def listen_for_catalog_changes(): # pragma: no cover
+    """Clear the search cache and the category count, and reindex what changed, whenever any process,
+    including `manage db populate`, changes the catalog. The listener reconnects whenever its connection drops."""
+    global _listener
+    _listener = asyncio.create_task(_listen())
+
+
+async def stop_listening_for_catalog_changes(): # pragma: no cover
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        await asyncio.gather(_listener, return_exceptions=True)
+        _listener = None
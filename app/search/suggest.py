@@ -0,0 +1,232 @@
+import bisect
+import re
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app import models, schemas
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+Key = Tuple[str, int]
+
+_word_split = re.compile(r"[^a-z0-9]+")
+
+
+def terms_for(*texts: str) -> List[str]:
+    """Every suffix of the words in the texts, so "ice cream" can be found by typing "cream".
+
+    Args:
+        texts (str): The names and slugs to index.
+
+    Returns:
+        List[str]: The distinct terms to insert in the index.
+    """
+    terms = set()
+    for text in texts:
+        words = [word for word in _word_split.split(text.lower()) if word]
+        terms.update(" ".join(words[i:]) for i in range(len(words)))
+    return sorted(terms)
+
+
+def normalize_prefix(prefix: str) -> str:
+    """Normalize typed input the same way as the terms, keeping a trailing space as a word boundary.
+
+    Args:
+        prefix (str): What the user has typed so far.
+
+    Returns:
+        str: The prefix to look up.
+    """
+    return " ".join(word for word in _word_split.split(prefix.lower()) if word) + \
+        (" " if prefix[-1:].isspace() else "")
+
+
+class _Node:
+    __slots__ = ("children", "entries", "top")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        # keys of the entries with a term ending at this node
+        self.entries = set()
+        # the best ranked keys anywhere below this node, best first
+        self.top: List[Key] = []
+
+
+class PrefixIndex:
+    def __init__(self, k: int = 10):
+        """A trie where every node remembers the `k` most popular entries below it.
+
+        Lookups only walk the prefix, so they never depend on the size of the catalog.
+
+        Args:
+            k (int, optional): The maximum number of suggestions a lookup can return. Defaults to 10.
+        """
+        self.k = k
+        self._root = _Node()
+        self._entries: Dict[Key, Tuple[int, schemas.search.Suggestion, List[str]]] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _rank(self, key: Key):
+        popularity, suggestion, _ = self._entries[key]
+        return (-popularity, len(suggestion.name), suggestion.name)
+
+    def _path(self, term: str, create: bool = False) -> Optional[List[_Node]]:
+        node = self._root
+        path = [node]
+        for char in term:
+            child = node.children.get(char)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[char] = _Node()
+            node = child
+            path.append(node)
+        return path
+
+    def _offer(self, node: _Node, key: Key):
+        if key in node.top:
+            return
+        ranks = [self._rank(other) for other in node.top]
+        position = bisect.bisect(ranks, self._rank(key))
+        if position < self.k:
+            node.top.insert(position, key)
+            del node.top[self.k:]
+
+    def _recompute(self, node: _Node):
+        candidates = set(node.entries)
+        for child in node.children.values():
+            candidates.update(child.top)
+        node.top = sorted(candidates, key=self._rank)[:self.k]
+
+    def add(self, key: Key, terms: Iterable[str], suggestion: schemas.search.Suggestion, popularity: Optional[int] = None):
+        """Insert or replace an entry.
+
+        Args:
+            key (Key): Identifies the entry, a (type, id) pair.
+            terms (Iterable[str]): The normalized terms the entry can be found by.
+            suggestion (schemas.search.Suggestion): What a lookup returns for the entry.
+            popularity (Optional[int], optional): How high to rank the entry. Defaults to keeping
+                the current popularity of an existing entry, or 0.
+        """
+        if popularity is None:
+            popularity = self._entries[key][0] if key in self._entries else 0
+        if key in self._entries:
+            self.remove(key)
+
+        terms = list(terms)
+        self._entries[key] = (popularity, suggestion, terms)
+
+        for term in terms:
+            path = self._path(term, create=True)
+            path[-1].entries.add(key)
+            for node in path:
+                self._offer(node, key)
+
+    def remove(self, key: Key):
+        """Remove an entry, does nothing if it isn't indexed.
+
+        Args:
+            key (Key): The (type, id) pair the entry was added with.
+        """
+        if key not in self._entries:
+            return
+
+        _, _, terms = self._entries[key]
+
+        for term in terms:
+            path = self._path(term)
+            path[-1].entries.discard(key)
+
+        # the rankings are still needed to refill the nodes the entry is evicted from
+        for term in terms:
+            for node in reversed(self._path(term)):
+                if key in node.top:
+                    node.top.remove(key)
+                    self._recompute(node)
+
+        # prune the branches that no longer lead anywhere
+        for term in terms:
+            path = self._path(term)
+            if path is None:
+                continue
+            for parent, char in reversed(list(zip(path, term))):
+                child = parent.children[char]
+                if child.entries or child.children:
+                    break
+                del parent.children[char]
+
+        del self._entries[key]
+
+    def suggest(self, prefix: str, limit: int) -> List[schemas.search.Suggestion]:
+        """Get the most popular entries with a term starting with the prefix.
+
+        Args:
+            prefix (str): A normalized prefix, see `normalize_prefix`.
+            limit (int): The number of suggestions to return, capped at `k`.
+
+        Returns:
+            List[schemas.search.Suggestion]: The suggestions, most popular first.
+        """
+        path = self._path(prefix)
+        if path is None:
+            return []
+        return [self._entries[key][1] for key in path[-1].top[:limit]]
+
+    def clear(self):
+        self._root = _Node()
+        self._entries = {}
+
+
+suggestion_index = PrefixIndex()
+
+
+def index_product(product: models.Product, popularity: Optional[int] = None):
+    suggestion_index.add(
+        ("product", product.id),
+        terms_for(product.name, product.slug),
+        schemas.search.Suggestion(type="product", name=product.name, slug=product.slug),
+        popularity
+    )
+
+
+def index_category(category: models.Category, popularity: Optional[int] = None):
+    suggestion_index.add(
+        ("category", category.id),
+        terms_for(category.name, category.slug),
+        schemas.search.Suggestion(type="category", name=category.name, slug=category.slug),
+        popularity
+    )
+
+
+async def rebuild_suggestion_index(db: AsyncSession):
+    """Reload every product and category name, ranked by the number of units sold.
+
+    Args:
+        db (AsyncSession): The database session.
+    """
+    units_sold = select(
+        models.OrderItem.product_id,
+        func.sum(models.OrderItem.quantity).label("units")
+    ).join(
+        models.Order, models.Order.id == models.OrderItem.order_id
+    ).where(
+        models.Order.status != models.OrderStatus.CART
+    ).group_by(models.OrderItem.product_id).subquery()
+
+    products = (await db.execute(
+        select(models.Product, func.coalesce(units_sold.c.units, 0)).outerjoin(
+            units_sold, units_sold.c.product_id == models.Product.id
+        )
+    )).all()
+    categories = (await db.execute(select(models.Category))).scalars().all()
+
+    category_popularity = {}
+    for product, units in products:
+        category_popularity[product.category_id] = category_popularity.get(product.category_id, 0) + units
+
+    suggestion_index.clear()
+    for product, units in products:
+        index_product(product, units)
+    for category in categories:
+        index_category(category, category_popularity.get(category.id, 0))
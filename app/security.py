@@ -32,9 +32,9 @@ def create_access_token(data: dict):
     return encoded_jwt
 
 
-def create_session_cookie(value, expires):
+def create_session_cookie(value, expires, key='session'):
     cookie = {
-        'key': 'session',
+        'key': key,
         'value': value,
         'expires': expires,
         'httponly': True
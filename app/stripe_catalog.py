@@ -0,0 +1,176 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Tuple
+
+import stripe
+from app import environ, models
+from app.jobs import job_queue
+from app.stripe_gateway import stripe_gateway
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger("uvicorn.error")
+
+# Every product has a Stripe Product whose default Price is the product's price,
+# so checkout sends price IDs instead of the details of every product. A product
+# is synced again once the hash of its details differs from the one last sent.
+# Stripe prices can't change, a new price replaces the old one, which is archived.
+
+
+def price_cents(price: float) -> int:
+    return int(round(price * 100))
+
+
+def catalog_hash(product: models.Product) -> str:
+    """Hash the details of a product that Stripe knows about.
+
+    Args:
+        product (models.Product): The product.
+
+    Returns:
+        str: The hex digest of the details.
+    """
+    content = json.dumps([product.name, product.description, product.image_url, price_cents(product.price)])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def is_synced(product: models.Product) -> bool:
+    """Whether the Stripe price of a product can be sent at checkout."""
+    return product.stripe_price_id is not None and product.stripe_hash == catalog_hash(product)
+
+
+async def sync_product(product: models.Product):
+    """Create or update the Stripe Product and Price of a product.
+
+    The IDs are set on the product once Stripe has them, the caller commits them.
+
+    Args:
+        product (models.Product): The product.
+    """
+    content_hash = catalog_hash(product)
+    cents = price_cents(product.price)
+    details = {
+        "name": product.name,
+        "description": product.description,
+        "images": [product.image_url],
+    }
+    price_data = {
+        "currency": "usd",
+        "unit_amount": cents,
+        "tax_behavior": "exclusive",
+    }
+
+    # nothing is set on the product before every call succeeded, a retry replays the same keys
+    if product.stripe_product_id is None:
+        stripe_product = await stripe_gateway.call(
+            "product.create",
+            stripe.Product.create,
+            **details,
+            metadata={"product_id": product.id},
+            default_price_data=price_data,
+            idempotency_key=f"catalog-product:{product.id}:{content_hash}",
+        )
+        stripe_product_id, price_id = stripe_product.id, stripe_product.default_price
+    else:
+        stripe_product_id, price_id = product.stripe_product_id, product.stripe_price_id
+        if price_id is None or product.stripe_unit_amount != cents:
+            price = await stripe_gateway.call(
+                "price.create",
+                stripe.Price.create,
+                product=stripe_product_id,
+                **price_data,
+                idempotency_key=f"catalog-price:{stripe_product_id}:{cents}:{product.stripe_price_id or ''}",
+            )
+            price_id = price.id
+
+        # the hash last sent is part of the key, so changing a product back is sent again
+        await stripe_gateway.call(
+            "product.modify",
+            stripe.Product.modify,
+            stripe_product_id,
+            **details,
+            default_price=price_id,
+            idempotency_key=f"catalog-product-update:{stripe_product_id}:{product.stripe_hash or ''}:{content_hash}:{price_id}",
+        )
+
+        # the old price can only be archived once it isn't the default anymore
+        if product.stripe_price_id is not None and product.stripe_price_id != price_id:
+            await stripe_gateway.call(
+                "price.modify",
+                stripe.Price.modify,
+                product.stripe_price_id,
+                active=False,
+                idempotency_key=f"catalog-price-archive:{product.stripe_price_id}",
+            )
+
+    product.stripe_product_id = stripe_product_id
+    product.stripe_price_id = price_id
+    product.stripe_unit_amount = cents
+    product.stripe_hash = content_hash
+
+
+async def sync_catalog(
+    db: AsyncSession,
+    concurrency: int = environ.STRIPE_MAX_WORKERS,
+    batch_size: int = 100,
+    force: bool = False
+) -> Tuple[int, int]:
+    """Sync the products whose details changed since they were last sent to Stripe.
+
+    The products are diffed a batch at a time, the changed ones of a batch are synced
+    concurrently and committed together. A failed product is synced again next time.
+
+    Args:
+        db (AsyncSession): The database session.
+        concurrency (int, optional): The maximum number of products synced at once.
+        batch_size (int, optional): The number of products diffed and committed at once.
+        force (bool, optional): Sync every product, changed or not.
+
+    Returns:
+        Tuple[int, int]: The number of products synced and the number that failed.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def sync(product: models.Product):
+        async with semaphore:
+            await sync_product(product)
+
+    synced = failed = 0
+    last_id = 0
+    while True:
+        products = (await db.execute(
+            select(models.Product).where(models.Product.id > last_id).order_by(models.Product.id).limit(batch_size)
+        )).scalars().all()
+        if not products:
+            break
+        last_id = products[-1].id
+
+        changed = [product for product in products if force or not is_synced(product)]
+        results = await asyncio.gather(*(sync(product) for product in changed), return_exceptions=True)
+        await db.commit()
+
+        for product, result in zip(changed, results):
+            if isinstance(result, Exception):
+                logger.error(f"Syncing product {product.id} to Stripe failed: {result}")
+                failed += 1
+            else:
+                synced += 1
+
+    return synced, failed
+
+
+@job_queue.task
+async def sync_changed_product(db: AsyncSession, product_id: int): # pragma: no cover
+    """Sync a product that is already in Stripe after it was updated.
+
+    Until it ran, checkout sends the product's details inline.
+
+    Args:
+        db (AsyncSession): The database session.
+        product_id (int): The product's ID.
+    """
+    product = await db.get(models.Product, product_id)
+    if product is not None and product.stripe_product_id is not None and not is_synced(product):
+        await sync_product(product)
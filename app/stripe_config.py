@@ -1,4 +1,5 @@
 import stripe
+from app.stripe_gateway import stripe_gateway
 
 
 class StripeShippingRateError(Exception):
@@ -11,10 +12,15 @@ shipping_rates = {
     'complimentary': None,
 }
 
-def load_shipping_rates(): # pragma: no cover
-    res = stripe.ShippingRate.list(active=True)
+def _list_active_shipping_rates(): # pragma: no cover
+    # paging fetches the next pages lazily, so it runs on the gateway's pool too
+    return list(stripe.ShippingRate.list(active=True).auto_paging_iter())
 
-    for rate in res.auto_paging_iter():
+
+async def load_shipping_rates(): # pragma: no cover
+    rates = await stripe_gateway.call("shipping_rate.list", _list_active_shipping_rates)
+
+    for rate in rates:
         rate_type = rate['metadata'].get('type')
         if rate_type is not None and rate_type in shipping_rates:
             shipping_rates[rate_type] = rate['id']
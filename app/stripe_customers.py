@@ -0,0 +1,116 @@
+import asyncio
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import stripe
+from app import models
+from app.stripe_gateway import stripe_gateway
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# A new user is inserted along with a StripeCustomerOutbox entry, in the same
+# transaction, and their Stripe customer is created afterwards by the dispatcher,
+# so signing up never waits on Stripe. A failed entry is retried with an
+# exponential backoff. Checkout resolves the customer of a pending user itself.
+# Each entry carries a random idempotency key, which is replaced whenever Stripe
+# answered it with an error, since Stripe would replay that error for the key.
+
+OUTBOX_BACKOFF_SECONDS = 30
+OUTBOX_MAX_BACKOFF_SECONDS = 60 * 60
+
+
+def next_attempt_at(attempts: int) -> datetime:
+    """When to retry an entry that failed `attempts` times."""
+    return datetime.utcnow() + timedelta(
+        seconds=min(OUTBOX_BACKOFF_SECONDS * 2 ** (attempts - 1), OUTBOX_MAX_BACKOFF_SECONDS))
+
+
+async def _create_customer(user: models.User, idempotency_key: str) -> str:
+    # keyed by outbox entry, so a dispatch and a checkout racing for the same user create one customer
+    customer = await stripe_gateway.call(
+        "customer.create",
+        stripe.Customer.create,
+        name=f"{user.firstname} {user.lastname}",
+        email=user.email,
+        metadata={"user_id": user.id},
+        idempotency_key=f"customer:{idempotency_key}",
+    )
+    return customer["id"]
+
+
+def _answered_by_stripe(error: Exception) -> bool:
+    # stripe replays the error it answered a key with, unlike a request that never reached it
+    return isinstance(error, stripe.error.StripeError) and not isinstance(error, stripe.error.APIConnectionError)
+
+
+async def dispatch_customers(db: AsyncSession, batch_size: int) -> int:
+    """Create the Stripe customers of a batch of due outbox entries.
+
+    The entries are locked with SKIP LOCKED, so concurrent dispatchers and checkouts
+    never create the same customer twice. The caller commits.
+
+    Args:
+        db (AsyncSession): The database session.
+        batch_size (int): The maximum number of entries dispatched.
+
+    Returns:
+        int: The number of entries dispatched, including the failed ones.
+    """
+    entries = (await db.execute(
+        select(models.StripeCustomerOutbox, models.User).join(
+            models.User, models.User.id == models.StripeCustomerOutbox.user_id
+        ).where(
+            models.StripeCustomerOutbox.next_attempt_at <= datetime.utcnow()
+        ).order_by(
+            models.StripeCustomerOutbox.next_attempt_at
+        ).limit(batch_size).with_for_update(skip_locked=True, of=models.StripeCustomerOutbox)
+    )).all()
+
+    results = await asyncio.gather(
+        *(_create_customer(user, entry.idempotency_key) for entry, user in entries), return_exceptions=True
+    )
+
+    for (entry, user), result in zip(entries, results):
+        if isinstance(result, Exception):
+            entry.attempts += 1
+            entry.next_attempt_at = next_attempt_at(entry.attempts)
+            entry.last_error = repr(result)[:500]
+            # a timed out request may still create the customer, its retry keeps the key
+            if _answered_by_stripe(result):
+                entry.idempotency_key = str(uuid4())
+        else:
+            user.stripe_id = result
+            await db.delete(entry)
+
+    return len(entries)
+
+
+async def resolve_customer(db: AsyncSession, user_id: int) -> str:
+    """Get the Stripe customer of a user, creating it now if the outbox hasn't yet.
+
+    Waits for a dispatcher holding the user's entry, then commits to release it.
+
+    Args:
+        db (AsyncSession): The database session.
+        user_id (int): The user's ID.
+
+    Returns:
+        str: The ID of the Stripe customer.
+    """
+    entry = (await db.execute(
+        select(models.StripeCustomerOutbox).where(
+            models.StripeCustomerOutbox.user_id == user_id
+        ).with_for_update()
+    )).scalars().first()
+
+    user = (await db.execute(
+        select(models.User).where(models.User.id == user_id).execution_options(populate_existing=True)
+    )).scalars().one()
+
+    if user.stripe_id is None:
+        user.stripe_id = await _create_customer(user, entry.idempotency_key if entry is not None else str(uuid4()))
+    if entry is not None:
+        await db.delete(entry)
+
+    await db.commit()
+    return user.stripe_id
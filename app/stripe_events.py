@@ -0,0 +1,424 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+import stripe
+from app import environ, models
+from app.geocoding import geocode_order
+from app.jobs import job_queue
+from app.stripe_gateway import stripe_gateway
+from sqlalchemy import (Float, Integer, String, column, delete, select, update,
+                        values)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger("uvicorn.error")
+
+# The webhook only stores the events it receives, so Stripe is answered with a
+# single insert however busy the app is. The consumer claims the pending events
+# a batch at a time, with SKIP LOCKED so several processes can share the work,
+# and applies all the completed checkouts of a batch with one UPDATE.
+#
+# Stripe delivers events at least once. The ID of every applied event goes into
+# ProcessedStripeEvent, and the consumer skips the events already in there
+# before any order work. Each process also remembers the IDs it recently saw,
+# so the webhook answers a redelivery without writing anything.
+#
+# Events the webhook never received are caught up by the reconciliation. It
+# pages through Stripe's event list from a persisted cursor and applies each
+# page the same way as the consumer.
+#
+# A cart keeps the stock of its checkout session until the session can't be
+# paid anymore. Once the hold ran out, the session is expired at Stripe, and a
+# session that was completed meanwhile turns the cart into an order right away.
+
+_no_sync = {"synchronize_session": False}
+
+# the events applied to the orders, and the cursor of their reconciliation
+APPLIED_EVENT_TYPES = ['checkout.session.completed']
+EVENTS_CURSOR = "events"
+# the largest page stripe lists
+RECONCILE_PAGE_SIZE = 100
+
+
+class RecentEventIds():
+    def __init__(self, max_entries: int):
+        """Remembers the IDs of the last `max_entries` events seen by this process.
+
+        Args:
+            max_entries (int): How many IDs to remember.
+        """
+        self.max_entries = max_entries
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, event_id: str) -> bool:
+        if event_id in self._ids:
+            self._ids.move_to_end(event_id)
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        return False
+
+    def add(self, event_id: str):
+        self._ids[event_id] = None
+        self._ids.move_to_end(event_id)
+        while len(self._ids) > self.max_entries:
+            self._ids.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._ids),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+recent_events = RecentEventIds(environ.STRIPE_EVENT_RECENT_IDS)
+
+
+def _completed_order(checkout_session: dict) -> Tuple:
+    address = checkout_session['shipping_details']['address']
+    short_address = address['line1'] + (" " + address['line2']
+                                        if address['line2'] else '') + ', ' + address['city']
+    long_address = short_address + ', ' + \
+        address['state'] + ', ' + address['postal_code'] + \
+        ', ' + address['country']
+
+    return (
+        int(checkout_session['metadata']['order_id']),
+        checkout_session['payment_intent'],
+        round(checkout_session['amount_total'] / 100, 2),
+        round(checkout_session['amount_subtotal'] / 100, 2),
+        round(checkout_session['total_details']['amount_tax'] / 100, 2),
+        round(checkout_session['total_details']['amount_shipping'] / 100, 2),
+        short_address,
+        long_address,
+    )
+
+
+async def complete_orders(db: AsyncSession, checkout_sessions: List[dict]) -> List[int]:
+    """Turn the carts of completed checkout sessions into orders, with one UPDATE per table.
+
+    Carts that are already orders are left alone, so replaying a session is harmless.
+
+    Args:
+        db (AsyncSession): The database session.
+        checkout_sessions (List[dict]): The completed checkout sessions.
+
+    Returns:
+        List[int]: The IDs of the carts that became orders.
+    """
+    rows: Dict[int, Tuple] = {}
+    for checkout_session in checkout_sessions:
+        try:
+            row = _completed_order(checkout_session)
+        except (KeyError, TypeError, ValueError):
+            logger.exception(f"Malformed checkout session {checkout_session.get('id')}, skipping it.")
+            continue
+        # the first completion of a cart wins, like it does across batches
+        rows.setdefault(row[0], row)
+
+    if not rows:
+        return []
+
+    completed = values(
+        column("order_id", Integer), column("payment_intent", String),
+        column("amount_total", Float), column("amount_subtotal", Float),
+        column("amount_tax", Float), column("amount_shipping", Float),
+        column("address", String), column("long_address", String),
+        name="completed"
+    ).data(list(rows.values()))
+
+    ordered = (await db.execute(
+        update(models.Order).where(
+            (models.Order.id == completed.c.order_id)
+            & (models.Order.status == models.OrderStatus.CART)
+        ).values(
+            stripe_id=completed.c.payment_intent,
+            status=models.OrderStatus.ORDERED,
+            amount_total=completed.c.amount_total,
+            amount_subtotal=completed.c.amount_subtotal,
+            amount_tax=completed.c.amount_tax,
+            amount_shipping=completed.c.amount_shipping,
+            address=completed.c.address,
+            updated_at=datetime.utcnow(),
+        ).returning(models.Order.id, completed.c.long_address),
+        execution_options=_no_sync
+    )).all()
+
+    if not ordered:
+        return []
+
+    # the stock held for the carts now belongs to the orders for good
+    await db.execute(
+        update(models.OrderItem).where(
+            models.OrderItem.order_id.in_([order_id for order_id, _ in ordered])
+        ).values(reserved_until=None),
+        execution_options=_no_sync
+    )
+
+    # the geocoding API is slow and flaky, it is called by the job queue
+    for order_id, long_address in ordered:
+        job_queue.enqueue(db, geocode_order, priority=10, order_id=order_id, address=long_address)
+
+    return [order_id for order_id, _ in ordered]
+
+
+async def apply_events(db: AsyncSession, events: Dict[str, dict]) -> List[str]:
+    """Apply the events that weren't applied yet, the primary key of ProcessedStripeEvent settles races.
+
+    Args:
+        db (AsyncSession): The database session.
+        events (Dict[str, dict]): The events, by ID.
+
+    Returns:
+        List[str]: The IDs of the events applied now.
+    """
+    if not events:
+        return []
+
+    fresh = set((await db.execute(
+        postgresql.insert(models.ProcessedStripeEvent).values([
+            {"event_id": event_id} for event_id in events
+        ]).on_conflict_do_nothing().returning(models.ProcessedStripeEvent.event_id)
+    )).scalars().all())
+
+    await complete_orders(db, [
+        event['data']['object'] for event_id, event in events.items()
+        if event_id in fresh and event['type'] == 'checkout.session.completed'
+    ])
+
+    return [event_id for event_id in events if event_id in fresh]
+
+
+async def process_stripe_events(db: AsyncSession, batch_size: int) -> int:
+    """Process a batch of the pending webhook events, oldest first. The caller commits.
+
+    Args:
+        db (AsyncSession): The database session.
+        batch_size (int): The maximum number of events processed.
+
+    Returns:
+        int: The number of events processed.
+    """
+    events = (await db.execute(
+        select(models.StripeEvent).where(
+            models.StripeEvent.processed_at.is_(None)
+        ).order_by(
+            models.StripeEvent.received_at
+        ).limit(batch_size).with_for_update(skip_locked=True)
+    )).scalars().all()
+
+    if not events:
+        return 0
+
+    # the first delivery of every event
+    firsts = {}
+    for event in events:
+        firsts.setdefault(event.event_id, event.payload)
+
+    await apply_events(db, firsts)
+
+    await db.execute(
+        update(models.StripeEvent).where(
+            models.StripeEvent.id.in_([event.id for event in events])
+        ).values(processed_at=datetime.utcnow()),
+        execution_options=_no_sync
+    )
+
+    for event_id in firsts:
+        recent_events.add(event_id)
+
+    return len(events)
+
+
+async def prune_stripe_events(db: AsyncSession, older_than: datetime, batch_size: int) -> int:
+    """Forget a batch of the events processed before `older_than`, the caller commits.
+
+    Args:
+        db (AsyncSession): The database session.
+        older_than (datetime): The events processed before then are forgotten.
+        batch_size (int): The maximum number of rows deleted from each table.
+
+    Returns:
+        int: The number of rows deleted from the table that had the most to delete.
+    """
+    processed = (await db.execute(
+        delete(models.ProcessedStripeEvent).where(
+            models.ProcessedStripeEvent.event_id.in_(
+                select(models.ProcessedStripeEvent.event_id).where(
+                    models.ProcessedStripeEvent.processed_at < older_than
+                ).limit(batch_size).with_for_update(skip_locked=True).scalar_subquery()
+            )
+        ),
+        execution_options=_no_sync
+    )).rowcount
+
+    stored = (await db.execute(
+        delete(models.StripeEvent).where(
+            models.StripeEvent.id.in_(
+                select(models.StripeEvent.id).where(
+                    models.StripeEvent.processed_at < older_than
+                ).limit(batch_size).with_for_update(skip_locked=True).scalar_subquery()
+            )
+        ),
+        execution_options=_no_sync
+    )).rowcount
+
+    return max(processed, stored)
+
+
+def _list_events_since(created: int) -> List[dict]:
+    # paging fetches the next pages lazily, so it runs on the gateway's pool too
+    return list(stripe.Event.list(
+        types=APPLIED_EVENT_TYPES, created={"gte": created}, limit=100
+    ).auto_paging_iter())
+
+
+async def _events_after(cursor: Optional[str], page_size: int, since: datetime) -> List[dict]:
+    if cursor is not None:
+        try:
+            # the events right after the cursor, stripe lists them newest first
+            page = await stripe_gateway.call(
+                "event.list", stripe.Event.list,
+                types=APPLIED_EVENT_TYPES, ending_before=cursor, limit=page_size
+            )
+            return list(reversed(page.data))
+        except stripe.error.InvalidRequestError:
+            # stripe only keeps 30 days of events, the cursor fell off the list
+            logger.warning(f"The Stripe event {cursor} is gone, reconciling from {since} instead.")
+
+    events = await stripe_gateway.call(
+        "event.list", _list_events_since, int(since.replace(tzinfo=timezone.utc).timestamp()),
+        timeout=stripe_gateway.timeout * 10
+    )
+    return list(reversed(events))
+
+
+async def reconcile_stripe_events(db: AsyncSession, page_size: int, since: datetime) -> Optional[int]:
+    """Apply a page of the events that came after the cursor, and move the cursor past them.
+
+    Without a cursor, every event since `since` is applied. The cursor row stays locked until
+    the caller commits, reconciliations running elsewhere meanwhile skip their turn.
+
+    Args:
+        db (AsyncSession): The database session.
+        page_size (int): The maximum number of events fetched and applied.
+        since (datetime): How far back to look without a cursor, in UTC.
+
+    Returns:
+        Optional[int]: The number of events fetched, a full page means more may be waiting.
+            None when another reconciliation holds the cursor.
+    """
+    await db.execute(
+        postgresql.insert(models.StripeCursor).values(name=EVENTS_CURSOR).on_conflict_do_nothing()
+    )
+    cursor = (await db.execute(
+        select(models.StripeCursor).where(
+            models.StripeCursor.name == EVENTS_CURSOR
+        ).with_for_update(skip_locked=True).execution_options(populate_existing=True)
+    )).scalars().first()
+
+    if cursor is None:
+        return None
+
+    events = await _events_after(cursor.object_id, page_size, since)
+
+    # a first run may fetch thousands, they are applied a page at a time
+    for start in range(0, len(events), page_size):
+        applied = await apply_events(db, {event['id']: event for event in events[start:start + page_size]})
+        if applied:
+            logger.info(f"Reconciled {len(applied)} Stripe events the webhook missed.")
+
+    if events:
+        cursor.object_id = events[-1]['id']
+
+    return len(events)
+
+
+async def _expire_checkout_session(session_id: str) -> Optional[dict]:
+    try:
+        return await stripe_gateway.call("checkout.session.expire", stripe.checkout.Session.expire, session_id)
+    except stripe.error.InvalidRequestError:
+        # only open sessions can be expired, this one was completed or expired already
+        pass
+
+    try:
+        return await stripe_gateway.call("checkout.session.retrieve", stripe.checkout.Session.retrieve, session_id)
+    except stripe.error.InvalidRequestError:
+        # stripe doesn't know the session, it can't be paid
+        return None
+
+
+async def settle_expired_checkouts(db: AsyncSession, batch_size: int) -> int:
+    """Expire the checkout sessions of the carts whose hold ran out, a batch at a time.
+
+    The carts of the expired sessions forget them, so their items can be released. The carts
+    of the completed sessions become orders. A cart Stripe couldn't answer for is left as is
+    until the next run. No row is locked during the Stripe calls, each batch is committed.
+
+    Args:
+        db (AsyncSession): The database session.
+        batch_size (int): The number of carts settled at once.
+
+    Returns:
+        int: The number of carts looked at.
+    """
+    settled = 0
+    last_id = 0
+    while True:
+        carts = (await db.execute(
+            select(models.Order.id, models.Order.checkout_session_id).where(
+                (models.Order.id > last_id)
+                & (models.Order.status == models.OrderStatus.CART)
+                & models.Order.checkout_session_id.isnot(None)
+                & models.Order.id.in_(
+                    select(models.OrderItem.order_id).where(models.OrderItem.reserved_until < datetime.utcnow())
+                )
+            ).order_by(models.Order.id).limit(batch_size)
+        )).all()
+        if not carts:
+            break
+        last_id = carts[-1].id
+        settled += len(carts)
+
+        results = await asyncio.gather(
+            *(_expire_checkout_session(cart.checkout_session_id) for cart in carts), return_exceptions=True
+        )
+
+        expired, completed = [], []
+        for cart, result in zip(carts, results):
+            if isinstance(result, Exception):
+                logger.error(f"Expiring the checkout session {cart.checkout_session_id} failed: {result}")
+            elif result is None or result['status'] == 'expired':
+                expired.append(cart.checkout_session_id)
+            elif result['status'] == 'complete':
+                completed.append(result)
+
+        # a cart that got a new session meanwhile keeps it
+        if expired:
+            await db.execute(
+                update(models.Order).where(
+                    models.Order.checkout_session_id.in_(expired)
+                ).values(
+                    checkout_session_id=None, checkout_url=None, checkout_hash=None, checkout_expires_at=None
+                ),
+                execution_options=_no_sync
+            )
+
+        ordered = await complete_orders(db, completed)
+        if ordered:
+            logger.info(f"Completed {len(ordered)} orders whose checkout outlived their hold.")
+
+        await db.commit()
+
+        if len(carts) < batch_size:
+            break
+
+    return settled
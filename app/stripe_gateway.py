@@ -0,0 +1,107 @@
+import asyncio
+import bisect
+import functools
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, TypeVar
+
+import stripe
+from app import environ
+
+T = TypeVar("T")
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+
+class StripeTimeoutError(Exception):
+    """Raised when a Stripe call takes longer than its timeout."""
+    pass
+
+
+class LatencyHistogram():
+    def __init__(self):
+        """Counts durations into the `LATENCY_BUCKETS`."""
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "buckets": {str(bound): count for bound, count in zip(LATENCY_BUCKETS, self.counts)},
+        }
+
+
+class StripeGateway():
+    def __init__(self, max_workers: int, timeout: float):
+        """Runs the blocking Stripe SDK calls on a dedicated thread pool, so they never stall the event loop.
+
+        The pool bounds how many calls are in flight, the others queue without holding
+        an event loop slot. Every worker thread keeps its own keep-alive session to Stripe.
+
+        Args:
+            max_workers (int): The maximum number of concurrent Stripe calls.
+            timeout (float): How many seconds a call may take by default.
+        """
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stripe")
+
+        self._latencies: Dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.timeouts: Dict[str, int] = defaultdict(int)
+
+    async def call(self, operation: str, fn: Callable[..., T], *args, timeout: Optional[float] = None, **kwargs) -> T:
+        """Call a Stripe SDK function on the pool.
+
+        Args:
+            operation (str): The name the call's latency is recorded under, like `customer.create`.
+            fn (Callable[..., T]): The SDK function.
+            timeout (Optional[float], optional): How many seconds the call may take. Defaults to the gateway's timeout.
+
+        Raises:
+            StripeTimeoutError: If the call took longer than the timeout.
+
+        Returns:
+            T: What the SDK function returned.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs)),
+                timeout or self.timeout
+            )
+        except asyncio.TimeoutError:
+            self.timeouts[operation] += 1
+            raise StripeTimeoutError(f"Stripe call {operation} timed out.")
+        except Exception:
+            self.errors[operation] += 1
+            raise
+        finally:
+            self._latencies[operation].observe(time.perf_counter() - start)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            operation: {
+                **histogram.stats(),
+                "errors": self.errors[operation],
+                "timeouts": self.timeouts[operation],
+            } for operation, histogram in self._latencies.items()
+        }
+
+
+# the SDK's own timeout stops a call the gateway gave up on from holding its worker much longer
+stripe.default_http_client = stripe.http_client.RequestsClient(timeout=environ.STRIPE_TIMEOUT_SECONDS)
+
+stripe_gateway = StripeGateway(max_workers=environ.STRIPE_MAX_WORKERS, timeout=environ.STRIPE_TIMEOUT_SECONDS)
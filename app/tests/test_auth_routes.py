@@ -1,8 +1,17 @@
 import base64
 import json
+import time
 
+from datetime import datetime
+
+import stripe
+from app import models
+from app.stripe_customers import dispatch_customers
+from app.stripe_gateway import stripe_gateway
 from httpx import AsyncClient
 
+from .conftest import async_session_factory
+
 AUTH_TOKEN_ENDPOINT = "/auth/token/"
 AUTH_REGISTER_ENDPOINT = "/auth/register/"
 
@@ -143,6 +152,92 @@ async def test_register_new_user_and_login(client):
     assert 'access_token' in data
 
 
+async def test_register_new_user_stripe_timeout(client, monkeypatch):
+    keys = []
+
+    def slow_create(cls, **kwargs):
+        keys.append(kwargs['idempotency_key'])
+        time.sleep(0.5)
+        return {'id': 'cus_slow'}
+
+    def rejected_create(cls, **kwargs):
+        keys.append(kwargs['idempotency_key'])
+        raise stripe.error.APIError('Something went wrong on our end.')
+
+    monkeypatch.setattr(stripe.Customer, 'create', classmethod(slow_create))
+    monkeypatch.setattr(stripe_gateway, 'timeout', 0.05)
+
+    email = "slow.stripe@sjsu.edu"
+    password = "4f79ce357d3173545055e5a33a710cec"
+
+    # signing up doesn't wait on stripe, the customer is created later
+    response = await client.post(AUTH_REGISTER_ENDPOINT, json={
+        "firstname": "Slow",
+        "lastname": "Stripe",
+        "username": email,
+        "password": password,
+    })
+
+    assert response.status_code == 200
+    assert decode_auth_token(response.json()["access_token"])['stripe_id'] is None
+
+    user_id = decode_auth_token(response.json()["access_token"])['id']
+
+    async with async_session_factory() as db:
+        await dispatch_customers(db, 100)
+        await db.commit()
+
+        entry = await db.get(models.StripeCustomerOutbox, user_id)
+
+        assert entry.attempts == 1
+        assert entry.next_attempt_at > datetime.utcnow()
+        # the request may have reached stripe, the retry replays it
+        assert f'customer:{entry.idempotency_key}' in keys
+
+        # stripe would replay the error it answered, the retry gets a new key
+        monkeypatch.setattr(stripe.Customer, 'create', classmethod(rejected_create))
+        entry.next_attempt_at = datetime.utcnow()
+        await db.commit()
+
+        await dispatch_customers(db, 100)
+        await db.commit()
+
+        entry = await db.get(models.StripeCustomerOutbox, user_id)
+
+        assert entry.attempts == 2
+        assert f'customer:{entry.idempotency_key}' not in keys
+
+    assert stripe_gateway.stats()['customer.create']['timeouts'] >= 1
+
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        "username": "jeff.bezos@sjsu.edu",
+        "password": "superuser"
+    })
+    response = await client.get('/metrics/')
+
+    assert response.status_code == 200
+    assert response.json()['stripe']['customer.create']['count'] >= 1
+
+    # checking out doesn't wait for the next dispatch
+    monkeypatch.undo()
+
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        "username": email,
+        "password": password
+    })
+    response = await client.post('/cart/', json={'product_id': 14, 'quantity': 1})
+
+    assert response.status_code == 200
+
+    response = await client.post('/cart/checkout/')
+
+    assert response.status_code == 200
+
+    async with async_session_factory() as db:
+        assert (await db.get(models.User, user_id)).stripe_id is not None
+        assert await db.get(models.StripeCustomerOutbox, user_id) is None
+
+
 async def test_register_new_user_with_duplicate_email(client):
     response = await client.post(AUTH_REGISTER_ENDPOINT, json={
         "firstname": "Morganna",
@@ -1,12 +1,30 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import stripe
+from app import models
+from app.inventory import (delete_abandoned_carts, reconcile_stock_shards,
+                           release_expired_reservations, set_stock_shards)
 from httpx import AsyncClient
+from sqlalchemy import select, update
 
+from .conftest import async_session_factory
 from .test_auth_routes import AUTH_TOKEN_ENDPOINT
 from .test_category_routes import (GET_ALL_CATEGORY_ENDPOINT,
                                    GET_CATEGORY_BY_SLUG_ENDPOINT)
+from .test_product_routes import UPDATE_PRODUCT_ENDPOINT
 
 GET_CART_ENDPOINT = '/cart/'
 GET_CART_CHECKOUT = '/cart/checkout/'
 UPDATE_CART_ENDPOINT = '/cart/{id}'
+GET_CART_SUMMARY_ENDPOINT = '/cart/summary/'
+
+
+def assert_cart_totals(cart: dict):
+    assert cart['item_count'] == sum(item['quantity'] for item in cart['items'])
+    assert cart['subtotal_cents'] == sum(round(item['product']['price'] * 100) * item['quantity'] for item in cart['items'])
+    assert abs(cart['total_weight'] - sum(item['product']['weight'] * item['quantity'] for item in cart['items'])) < 1e-6
 
 
 async def test_get_cart_unauthenticated(client: AsyncClient):
@@ -55,6 +73,53 @@ async def test_get_cart(client: AsyncClient):
     assert 'items' in data
 
     
+async def test_get_cart_is_created_with_first_item(client: AsyncClient):
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'jeff.bezos@sjsu.edu',
+        'password': 'superuser'
+    })
+
+    assert response.status_code == 200
+
+    async def carts():
+        async with async_session_factory() as db:
+            return (await db.execute(select(models.Order.id).join(models.User).where(
+                (models.User.email == 'jeff.bezos@sjsu.edu') & (models.Order.status == models.OrderStatus.CART)
+            ))).scalars().all()
+
+    # reading the cart doesn't create it
+    response = await client.get(GET_CART_ENDPOINT)
+
+    assert response.status_code == 200
+    assert response.json()['id'] is None
+    assert response.json()['items'] == []
+    assert await carts() == []
+
+    response = await client.post(GET_CART_CHECKOUT)
+
+    assert response.status_code == 400
+
+    # nor does failing to add an item
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': 44, 'quantity': 100000})
+
+    assert response.status_code == 400
+    assert await carts() == []
+
+    # concurrent first adds share a single cart
+    responses = await asyncio.gather(*[
+        client.post(GET_CART_ENDPOINT, json={'product_id': product_id, 'quantity': 1}) for product_id in (44, 45)
+    ])
+
+    assert all(response.status_code == 200 for response in responses)
+    assert await carts() == [responses[0].json()['order_id']]
+    assert responses[1].json()['order_id'] == responses[0].json()['order_id']
+
+    for response in responses:
+        response = await client.delete(UPDATE_CART_ENDPOINT.format(id=response.json()['id']))
+
+        assert response.status_code == 204
+
+
 async def test_add_to_cart_and_delete(client: AsyncClient):
      # login
     response = await client.post(AUTH_TOKEN_ENDPOINT, data={
@@ -124,6 +189,451 @@ async def test_add_to_cart_not_enough_stock(client: AsyncClient):
     assert response.status_code == 400
 
     
+async def test_add_to_cart_product_dne(client: AsyncClient):
+     # login
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'morgan.freemen@sjsu.edu',
+        'password': 'customer'
+    })
+
+    assert response.status_code == 200
+
+    response = await client.post(
+        GET_CART_ENDPOINT, 
+        json={
+            'product_id': 463786,
+            'quantity': 1
+        }
+    )
+
+    assert response.status_code == 404
+
+
+async def test_add_to_cart_concurrently_never_oversells(client: AsyncClient):
+    PRODUCT_ID = 40
+    STOCK = 5
+
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'jeff.bezos@sjsu.edu',
+        'password': 'superuser'
+    })
+
+    assert response.status_code == 200
+
+    response = await client.patch(UPDATE_PRODUCT_ENDPOINT.format(id=PRODUCT_ID), json={
+        'quantity': STOCK,
+        'price': 9.99,
+    })
+
+    assert response.status_code == 200
+
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'morgan.freemen@sjsu.edu',
+        'password': 'customer'
+    })
+
+    assert response.status_code == 200
+
+    responses = await asyncio.gather(*[
+        client.post(GET_CART_ENDPOINT, json={'product_id': PRODUCT_ID, 'quantity': 1}) for _ in range(STOCK * 2)
+    ])
+
+    assert sorted(response.status_code for response in responses) == [200] * STOCK + [400] * STOCK
+
+    # every successful add landed on the same cart item
+    items = [item for item in (await client.get(GET_CART_ENDPOINT)).json()['items'] if item['product']['id'] == PRODUCT_ID]
+
+    assert len(items) == 1
+    assert items[0]['quantity'] == STOCK
+    assert items[0]['product']['quantity'] == 0
+
+    response = await client.delete(UPDATE_CART_ENDPOINT.format(id=items[0]['id']))
+
+    assert response.status_code == 204
+
+
+async def test_add_to_cart_sharded_stock(client: AsyncClient):
+    PRODUCT_ID = 41
+    STOCK = 10
+
+    async with async_session_factory() as db:
+        assert await set_stock_shards(db, PRODUCT_ID, 4, STOCK) == STOCK
+        await db.commit()
+
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'morgan.freemen@sjsu.edu',
+        'password': 'customer'
+    })
+
+    assert response.status_code == 200
+
+    responses = await asyncio.gather(*[
+        client.post(GET_CART_ENDPOINT, json={'product_id': PRODUCT_ID, 'quantity': 1}) for _ in range(STOCK + 5)
+    ])
+    reserved = sum(response.status_code == 200 for response in responses)
+
+    assert all(response.status_code in (200, 400) for response in responses)
+    # the whole stock is sold, spread over the shards, and nothing more
+    assert reserved == STOCK
+
+    async def shard_quantities():
+        async with async_session_factory() as db:
+            return (await db.execute(select(models.ProductStockShard.quantity).where(
+                models.ProductStockShard.product_id == PRODUCT_ID
+            ))).scalars().all()
+
+    shards = await shard_quantities()
+
+    assert len(shards) == 4
+    assert min(shards) >= 0
+    assert sum(shards) == 0
+
+    item_id = next(response.json()['id'] for response in responses if response.status_code == 200)
+
+    response = await client.patch(UPDATE_CART_ENDPOINT.format(id=item_id), json={'quantity': 1})
+
+    assert response.status_code == 200
+
+    shards = await shard_quantities()
+
+    assert min(shards) >= 0
+    assert sum(shards) == STOCK - 1
+
+    async with async_session_factory() as db:
+
+        # a product with a shard held by a reservation is skipped
+        async with async_session_factory() as reservation:
+            await reservation.execute(select(models.ProductStockShard).where(
+                models.ProductStockShard.product_id == PRODUCT_ID
+            ).limit(1).with_for_update())
+
+            assert await reconcile_stock_shards(db) == 0
+            await db.commit()
+
+        assert await reconcile_stock_shards(db) == 1
+        await db.commit()
+
+        # nothing drifted since
+        assert await reconcile_stock_shards(db) == 0
+        await db.commit()
+
+    response = await client.get(GET_CART_ENDPOINT)
+    item = next(item for item in response.json()['items'] if item['id'] == item_id)
+
+    assert item['quantity'] == 1
+    assert item['product']['quantity'] == STOCK - 1
+
+    response = await client.delete(UPDATE_CART_ENDPOINT.format(id=item_id))
+
+    assert response.status_code == 204
+
+    async with async_session_factory() as db:
+        # disabling sharding moves the whole stock back onto the product
+        assert await set_stock_shards(db, PRODUCT_ID, 0) == STOCK
+        await db.commit()
+
+
+async def test_expired_cart_hold_is_released(client: AsyncClient):
+    PRODUCT_ID = 42
+
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'morgan.freemen@sjsu.edu',
+        'password': 'customer'
+    })
+
+    assert response.status_code == 200
+
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': PRODUCT_ID, 'quantity': 2})
+
+    assert response.status_code == 200
+
+    item = response.json()
+    stock = item['product']['quantity']
+
+    assert item['reserved_until'] is not None
+
+    async with async_session_factory() as db:
+        # nothing expired yet
+        await release_expired_reservations(db, 500)
+        await db.commit()
+
+        assert (await db.get(models.OrderItem, item['id'])) is not None
+
+        await db.execute(
+            update(models.OrderItem)
+            .where(models.OrderItem.id == item['id'])
+            .values(reserved_until=datetime.utcnow() - timedelta(minutes=1))
+        )
+        await db.commit()
+
+        assert await release_expired_reservations(db, 500) >= 1
+        await db.commit()
+
+        assert (await db.get(models.OrderItem, item['id'])) is None
+        product = (await db.execute(
+            select(models.Product).where(models.Product.id == PRODUCT_ID).execution_options(populate_existing=True)
+        )).scalar_one()
+
+        assert product.quantity == stock + 2
+
+    response = await client.get(GET_CART_ENDPOINT)
+
+    assert all(cart_item['id'] != item['id'] for cart_item in response.json()['items'])
+    assert_cart_totals(response.json())
+
+
+async def test_abandoned_cart_is_deleted(client: AsyncClient):
+    PRODUCT_ID = 43
+
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'amy.dyken@sjsu.edu',
+        'password': 'employee'
+    })
+
+    assert response.status_code == 200
+
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': PRODUCT_ID, 'quantity': 3})
+
+    assert response.status_code == 200
+
+    item = response.json()
+    stock = item['product']['quantity']
+
+    async with async_session_factory() as db:
+        cart_id = (await db.get(models.OrderItem, item['id'])).order_id
+        await db.execute(
+            update(models.Order)
+            .where(models.Order.id == cart_id)
+            .values(updated_at=datetime.utcnow() - timedelta(days=60))
+        )
+        await db.commit()
+
+        # the item still holds its stock, so the cart may be checked out
+        assert await delete_abandoned_carts(db, datetime.utcnow() - timedelta(days=30), 500) == 0
+        await db.commit()
+
+        await db.execute(
+            update(models.OrderItem)
+            .where(models.OrderItem.id == item['id'])
+            .values(reserved_until=None)
+        )
+        # the hold lapsed, but the checkout session may have been paid
+        await db.execute(
+            update(models.Order)
+            .where(models.Order.id == cart_id)
+            .values(checkout_session_id='cs_abandoned')
+        )
+        await db.commit()
+
+        assert await delete_abandoned_carts(db, datetime.utcnow() - timedelta(days=30), 500) == 0
+        await db.commit()
+
+        assert (await db.get(models.Order, cart_id)) is not None
+
+        # and so is a cart whose completion event wasn't applied yet
+        await db.execute(
+            update(models.Order)
+            .where(models.Order.id == cart_id)
+            .values(checkout_session_id=None)
+        )
+        event = models.StripeEvent(event_id='evt_abandoned', type='checkout.session.completed', payload={
+            'id': 'evt_abandoned',
+            'type': 'checkout.session.completed',
+            'data': {'object': {'metadata': {'order_id': str(cart_id)}}},
+        })
+        db.add(event)
+        await db.commit()
+
+        assert await delete_abandoned_carts(db, datetime.utcnow() - timedelta(days=30), 500) == 0
+        await db.commit()
+
+        await db.delete(event)
+        await db.commit()
+
+        assert await delete_abandoned_carts(db, datetime.utcnow() - timedelta(days=30), 500) >= 1
+        await db.commit()
+
+        assert (await db.get(models.Order, cart_id)) is None
+        assert (await db.get(models.OrderItem, item['id'])) is None
+        product = (await db.execute(
+            select(models.Product).where(models.Product.id == PRODUCT_ID).execution_options(populate_existing=True)
+        )).scalar_one()
+
+        assert product.quantity == stock + 3
+
+    # the next visit shows an empty cart until an item is added
+    response = await client.get(GET_CART_ENDPOINT)
+
+    assert response.status_code == 200
+    assert response.json()['id'] is None
+    assert response.json()['items'] == []
+
+
+async def test_change_cart(client: AsyncClient):
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'amy.dyken@sjsu.edu',
+        'password': 'employee'
+    })
+
+    assert response.status_code == 200
+
+    async def stock():
+        async with async_session_factory() as db:
+            return dict((await db.execute(
+                select(models.Product.id, models.Product.quantity).where(models.Product.id.in_([50, 51, 52]))
+            )).all())
+
+    before = await stock()
+
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': 50, 'quantity': 2})
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': 51, 'quantity': 2})
+
+    assert response.status_code == 200
+
+    response = await client.patch(GET_CART_ENDPOINT, json={'changes': [
+        {'product_id': 50, 'op': 'add', 'quantity': 3},
+        {'product_id': 51, 'op': 'remove'},
+        {'product_id': 52, 'op': 'set', 'quantity': 4},
+        {'product_id': 53, 'op': 'set', 'quantity': 100000},
+        {'product_id': 54, 'op': 'remove'},
+        {'product_id': 4673, 'op': 'add', 'quantity': 1},
+    ]})
+
+    assert response.status_code == 200
+
+    cart = response.json()
+    assert {item['product']['id']: item['quantity'] for item in cart['items']} == {50: 5, 52: 4}
+    assert cart['errors'] == [
+        {'product_id': 53, 'detail': 'Not enough stock'},
+        {'product_id': 54, 'detail': 'Cart item was not found'},
+        {'product_id': 4673, 'detail': 'Product not found'},
+    ]
+    assert await stock() == {50: before[50] - 5, 51: before[51], 52: before[52] - 4}
+
+    response = await client.patch(GET_CART_ENDPOINT, json={'changes': [
+        {'product_id': 50, 'op': 'set', 'quantity': 1},
+        {'product_id': 50, 'op': 'remove'},
+    ]})
+
+    assert response.status_code == 422
+
+    response = await client.patch(GET_CART_ENDPOINT, json={'changes': [
+        {'product_id': 50, 'op': 'set', 'quantity': 0},
+        {'product_id': 52, 'op': 'remove'},
+    ]})
+
+    assert response.status_code == 200
+    assert response.json()['items'] == []
+    assert response.json()['errors'] == []
+    assert await stock() == before
+
+
+async def test_cart_summary(client: AsyncClient):
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'jeff.bezos@sjsu.edu',
+        'password': 'superuser'
+    })
+
+    assert response.status_code == 200
+
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': 55, 'quantity': 2})
+    first_id = response.json()['id']
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': 56, 'quantity': 1})
+    response = await client.patch(UPDATE_CART_ENDPOINT.format(id=first_id), json={'quantity': 3})
+    response = await client.patch(GET_CART_ENDPOINT, json={'changes': [{'product_id': 57, 'op': 'add', 'quantity': 1}]})
+
+    assert response.status_code == 200
+    assert_cart_totals(response.json())
+
+    cart = (await client.get(GET_CART_ENDPOINT)).json()
+    assert_cart_totals(cart)
+
+    response = await client.get(GET_CART_SUMMARY_ENDPOINT)
+
+    assert response.status_code == 200
+    assert response.json() == {
+        'id': cart['id'],
+        'item_count': cart['item_count'],
+        'subtotal_cents': cart['subtotal_cents'],
+        'total_weight': cart['total_weight'],
+        'free_shipping': cart['total_weight'] < 20,
+    }
+
+    # the totals follow the price of the products
+    product = next(item['product'] for item in cart['items'] if item['product']['id'] == 56)
+    response = await client.patch(UPDATE_PRODUCT_ENDPOINT.format(id=56), json={
+        'quantity': product['quantity'],
+        'price': product['price'] + 1,
+    })
+
+    assert response.status_code == 200
+
+    cart = (await client.get(GET_CART_ENDPOINT)).json()
+    assert_cart_totals(cart)
+    assert (await client.get(GET_CART_SUMMARY_ENDPOINT)).json()['subtotal_cents'] == cart['subtotal_cents']
+
+    for item in cart['items']:
+        response = await client.delete(UPDATE_CART_ENDPOINT.format(id=item['id']))
+
+        assert response.status_code == 204
+
+    response = await client.get(GET_CART_SUMMARY_ENDPOINT)
+
+    assert response.json()['item_count'] == 0
+    assert response.json()['subtotal_cents'] == 0
+
+
+async def test_get_cart_etag(client: AsyncClient):
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'amy.dyken@sjsu.edu',
+        'password': 'employee'
+    })
+
+    assert response.status_code == 200
+
+    response = await client.get(GET_CART_ENDPOINT)
+    etag = response.headers['etag']
+
+    assert response.status_code == 200
+    assert etag.startswith('W/')
+
+    response = await client.get(GET_CART_ENDPOINT, headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.headers['etag'] == etag
+    assert response.content == b''
+
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': 58, 'quantity': 1})
+    item_id = response.json()['id']
+
+    # every change to the cart gives it a new version
+    etags = [etag]
+    for request in [
+        lambda: client.patch(UPDATE_CART_ENDPOINT.format(id=item_id), json={'quantity': 2}),
+        lambda: client.patch(GET_CART_ENDPOINT, json={'changes': [{'product_id': 58, 'op': 'add', 'quantity': 1}]}),
+        lambda: client.delete(UPDATE_CART_ENDPOINT.format(id=item_id)),
+    ]:
+        response = await client.get(GET_CART_ENDPOINT, headers={'If-None-Match': etags[-1]})
+
+        assert response.status_code == 200
+        assert response.headers['etag'] not in etags
+        etags.append(response.headers['etag'])
+
+        response = await request()
+
+        assert response.status_code in (200, 204)
+
+    response = await client.get(GET_CART_ENDPOINT, headers={'If-None-Match': f'"x", {etags[-1]}'})
+
+    assert response.status_code == 200
+    assert response.headers['etag'] not in etags
+
+    # the strong form of the tag matches too
+    response = await client.get(GET_CART_ENDPOINT, headers={'If-None-Match': f'"x", {response.headers["etag"][2:]}'})
+
+    assert response.status_code == 304
+
+
 async def test_update_cart_item_dne(client: AsyncClient):
      # login
     response = await client.post(AUTH_TOKEN_ENDPOINT, data={
@@ -222,6 +732,74 @@ async def test_checkout_under_20lbs(client: AsyncClient):
 
     print('\nunder:', response.json()['url'])
 
+    # checking out holds the stock until the session expires
+    response = await client.get(GET_CART_ENDPOINT)
+    reserved_until = datetime.fromisoformat(response.json()['items'][0]['reserved_until'])
+
+    assert reserved_until > datetime.utcnow() + timedelta(minutes=30)
+
+async def test_checkout_reuses_session(client: AsyncClient):
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'morgan.freemen@sjsu.edu',
+        'password': 'customer'
+    })
+
+    assert response.status_code == 200
+
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': 12, 'quantity': 1})
+
+    assert response.status_code == 200
+
+    response = await client.post(GET_CART_CHECKOUT)
+
+    assert response.status_code == 200
+    session = response.json()
+
+    # the cart didn't change, so neither does its session
+    response = await client.post(GET_CART_CHECKOUT)
+
+    assert response.status_code == 200
+    assert response.json() == session
+
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': 12, 'quantity': 1})
+
+    assert response.status_code == 200
+
+    response = await client.post(GET_CART_CHECKOUT)
+
+    assert response.status_code == 200
+    assert response.json()['id'] != session['id']
+
+async def test_checkout_idempotency_key_reused_with_other_parameters(client: AsyncClient, monkeypatch):
+    keys = []
+
+    def create(cls, idempotency_key=None, **params):
+        keys.append((idempotency_key, params['expires_at']))
+        if len(keys) == 1:
+            raise stripe.error.IdempotencyError('Keys for idempotent requests can only be used with the same parameters.')
+        return SimpleNamespace(id='cs_retried', url='https://checkout.stripe.com/c/pay/cs_retried')
+
+    monkeypatch.setattr(stripe.checkout.Session, 'create', classmethod(create))
+
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'morgan.freemen@sjsu.edu',
+        'password': 'customer'
+    })
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': 13, 'quantity': 1})
+
+    assert response.status_code == 200
+
+    response = await client.post(GET_CART_CHECKOUT)
+
+    assert response.status_code == 200
+    assert response.json()['id'] == 'cs_retried'
+
+    # the key carries the session's expiry, the retry gets a fresh one
+    (first, expires_at), (retry, _) = keys
+
+    assert first.endswith(f':{expires_at}')
+    assert retry.startswith(f'{first}:')
+
 async def test_checkout_over_20lbs(client: AsyncClient):
      # login
     response = await client.post(AUTH_TOKEN_ENDPOINT, data={
@@ -3,6 +3,7 @@ from httpx import AsyncClient
 from .test_auth_routes import AUTH_TOKEN_ENDPOINT
 
 GET_ALL_CATEGORY_ENDPOINT = '/category/'
+GET_ALL_CATEGORY_CURSOR_ENDPOINT = '/category/cursor/'
 CREATE_CATEGORY_ENDPOINT = '/category/'
 GET_CATEGORY_BY_SLUG_ENDPOINT = '/category/{slug}'
 
@@ -20,6 +21,37 @@ async def test_get_all_categories(client: AsyncClient):
     assert 'total' in data
     assert 'page' in data
     assert 'size' in data
+    assert data['total_is_approximate'] is False
+
+
+async def test_get_all_categories_with_cursor(client: AsyncClient):
+    response = await client.get(GET_ALL_CATEGORY_ENDPOINT, params={'size': 100})
+
+    assert response.status_code == 200
+
+    expected = [item['slug'] for item in response.json()['items']]
+    slugs = []
+    params = {'size': 3}
+
+    while True:
+        response = await client.get(GET_ALL_CATEGORY_CURSOR_ENDPOINT, params=params)
+
+        assert response.status_code == 200
+
+        data = response.json()
+        slugs += [item['slug'] for item in data['items']]
+
+        if data['next_page'] is None:
+            break
+        params['cursor'] = data['next_page']
+
+    assert slugs == expected
+
+
+async def test_get_all_categories_with_invalid_cursor(client: AsyncClient):
+    response = await client.get(GET_ALL_CATEGORY_CURSOR_ENDPOINT, params={'cursor': 'garbage'})
+
+    assert response.status_code == 400
 
     
 async def test_get_category_by_slug(client: AsyncClient):
@@ -74,6 +106,12 @@ async def test_create_category_privileged(client: AsyncClient):
     
     assert response.status_code == 200
 
+    response = await client.get(GET_ALL_CATEGORY_ENDPOINT)
+
+    assert response.status_code == 200
+
+    total = response.json()['total']
+
     response = await client.post(CREATE_CATEGORY_ENDPOINT, json={
         'image_url': 'https://allthatsinteresting.com/wordpress/wp-content/uploads/2012/06/iconic-photos-1950-einstein.jpg',
         'name': TEST_CATEGORY_NAME,
@@ -87,6 +125,8 @@ async def test_create_category_privileged(client: AsyncClient):
     assert response.status_code == 200
     
     assert TEST_CATEGORY_NAME in [item['name'] for item in response.json()['items']]    
+    # the cached total is invalidated by the new category
+    assert response.json()['total'] == total + 1
 
 
 async def test_create_existing_category_privileged(client: AsyncClient):
@@ -0,0 +1,98 @@
+from app import models
+from httpx import AsyncClient
+from sqlalchemy import select
+
+from .conftest import async_session_factory
+from .test_auth_routes import AUTH_TOKEN_ENDPOINT
+from .test_cart_routes import GET_CART_ENDPOINT
+
+GUEST_CART_ENDPOINT = '/guest-cart/'
+GUEST_CART_ITEM_ENDPOINT = '/guest-cart/{product_id}'
+
+
+async def test_guest_cart(client: AsyncClient):
+    response = await client.get(GUEST_CART_ENDPOINT)
+
+    assert response.status_code == 200
+    assert response.json()['items'] == []
+
+    response = await client.post(GUEST_CART_ENDPOINT, json={'product_id': 46, 'quantity': 2})
+
+    assert response.status_code == 200
+    assert [(item['product']['id'], item['quantity']) for item in response.json()['items']] == [(46, 2)]
+
+    response = await client.post(GUEST_CART_ENDPOINT, json={'product_id': 47, 'quantity': 1})
+    response = await client.post(GUEST_CART_ENDPOINT, json={'product_id': 46, 'quantity': 1})
+
+    assert response.status_code == 200
+    assert [(item['product']['id'], item['quantity']) for item in response.json()['items']] == [(46, 3), (47, 1)]
+    assert all(item['in_stock'] for item in response.json()['items'])
+
+    response = await client.patch(GUEST_CART_ITEM_ENDPOINT.format(product_id=47), json={'quantity': 4})
+
+    assert response.status_code == 200
+    assert [(item['product']['id'], item['quantity']) for item in response.json()['items']] == [(46, 3), (47, 4)]
+
+    response = await client.patch(GUEST_CART_ITEM_ENDPOINT.format(product_id=47), json={'quantity': 100000})
+
+    assert response.status_code == 400
+
+    response = await client.post(GUEST_CART_ENDPOINT, json={'product_id': 4673, 'quantity': 1})
+
+    assert response.status_code == 404
+
+    response = await client.delete(GUEST_CART_ITEM_ENDPOINT.format(product_id=46))
+
+    assert response.status_code == 204
+
+    response = await client.delete(GUEST_CART_ITEM_ENDPOINT.format(product_id=46))
+
+    assert response.status_code == 404
+
+    response = await client.get(GUEST_CART_ENDPOINT)
+
+    assert [(item['product']['id'], item['quantity']) for item in response.json()['items']] == [(47, 4)]
+
+    # a tampered cookie is an empty cart
+    cookie = client.cookies['guest_cart']
+    client.cookies.set('guest_cart', cookie.replace('47:4', '47:40'))
+    response = await client.get(GUEST_CART_ENDPOINT)
+
+    assert response.status_code == 200
+    assert response.json()['items'] == []
+
+
+async def test_guest_cart_merges_at_login(client: AsyncClient):
+    async def stock():
+        async with async_session_factory() as db:
+            return dict((await db.execute(
+                select(models.Product.id, models.Product.quantity).where(models.Product.id.in_([48, 49]))
+            )).all())
+
+    before = await stock()
+
+    await client.post(GUEST_CART_ENDPOINT, json={'product_id': 48, 'quantity': 2})
+    await client.post(GUEST_CART_ENDPOINT, json={'product_id': 49, 'quantity': 1})
+
+    # the guest cart holds no stock
+    assert await stock() == before
+
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'morgan.freemen@sjsu.edu',
+        'password': 'customer'
+    })
+
+    assert response.status_code == 200
+    assert 'guest_cart' not in client.cookies
+
+    response = await client.get(GET_CART_ENDPOINT)
+    items = {item['product']['id']: item for item in response.json()['items']}
+
+    assert items[48]['quantity'] == 2
+    assert items[49]['quantity'] == 1
+    assert await stock() == {48: before[48] - 2, 49: before[49] - 1}
+
+    for product_id in (48, 49):
+        response = await client.delete(f"{GET_CART_ENDPOINT}{items[product_id]['id']}")
+
+        assert response.status_code == 204
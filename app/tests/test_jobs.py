@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+from app import models
+from app.jobs import JobQueue
+from sqlalchemy import select
+
+from .conftest import async_session_factory
+
+job_queue = JobQueue(async_session_factory)
+ran = []
+
+
+@job_queue.task
+async def record(db, value: str):
+    ran.append(value)
+
+
+@job_queue.task
+async def fail(db):
+    raise RuntimeError("Nope.")
+
+
+async def test_jobs_run_by_priority():
+    async with async_session_factory() as db:
+        job_queue.enqueue(db, record, value="later", priority=5)
+        job_queue.enqueue(db, record, value="first", priority=-5)
+        job_queue.enqueue(db, record, value="second")
+        job_queue.enqueue(db, record, value="delayed", delay=timedelta(hours=1))
+        await db.commit()
+
+    assert await job_queue.work_once(10) == 3
+    assert ran == ["first", "second", "later"]
+
+    # a job is deleted once it ran, the delayed one isn't due yet
+    async with async_session_factory() as db:
+        jobs = (await db.execute(select(models.Job).where(models.Job.task == "record"))).scalars().all()
+
+        assert [job.payload for job in jobs] == [{"value": "delayed"}]
+
+    assert await job_queue.work_once(10) == 0
+
+
+async def test_failed_jobs_are_retried():
+    async with async_session_factory() as db:
+        retried = job_queue.enqueue(db, fail, max_attempts=2)
+        await db.commit()
+
+    assert await job_queue.work_once(10) == 1
+
+    async with async_session_factory() as db:
+        job = await db.get(models.Job, retried.id)
+
+        assert job.attempts == 1
+        assert job.failed_at is None
+        assert job.run_at > datetime.utcnow()
+        assert "Nope." in job.last_error
+
+        # due again
+        job.run_at = datetime.utcnow()
+        await db.commit()
+
+    assert await job_queue.work_once(10) == 1
+
+    async with async_session_factory() as db:
+        job = await db.get(models.Job, retried.id)
+
+        assert job.attempts == 2
+        assert job.failed_at is not None
+
+        # out of attempts, it is never claimed again
+        job.run_at = datetime.utcnow()
+        await db.commit()
+
+    assert await job_queue.work_once(10) == 0
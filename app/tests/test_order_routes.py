@@ -5,6 +5,7 @@ from .test_category_routes import (GET_ALL_CATEGORY_ENDPOINT,
                                    GET_CATEGORY_BY_SLUG_ENDPOINT)
 
 GET_ORDERS_ENDPOINT = '/order/'
+GET_ORDERS_CURSOR_ENDPOINT = '/order/cursor/'
 GET_ORDER_ENDPOINT = '/order/{id}/'
 
 
@@ -21,6 +22,26 @@ async def test_get_past_orders(client: AsyncClient):
 
     assert response.status_code == 200
 
+
+async def test_get_past_orders_with_cursor(client: AsyncClient):
+    # login
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'morgan.freemen@sjsu.edu',
+        'password': 'customer'
+    })
+
+    assert response.status_code == 200
+
+    response = await client.get(GET_ORDERS_CURSOR_ENDPOINT)
+
+    assert response.status_code == 200
+
+    data = response.json()
+
+    assert 'items' in data
+    assert 'next_page' in data
+    assert 'total' not in data
+
     
 async def test_get_past_order(client: AsyncClient):
     # login
@@ -0,0 +1,353 @@
+from app import models
+from app.pagination import search_count
+from app.search.bm25 import BM25Index
+from app.search.cache import reindex_catalog
+from httpx import AsyncClient
+
+from .conftest import async_session_factory
+from .test_auth_routes import AUTH_TOKEN_ENDPOINT
+from .test_category_routes import CREATE_CATEGORY_ENDPOINT
+from .test_product_routes import UPDATE_PRODUCT_ENDPOINT
+
+GET_SEARCH_ENDPOINT = '/search/'
+GET_SEARCH_CURSOR_ENDPOINT = '/search/cursor/'
+GET_SUGGEST_ENDPOINT = '/search/suggest/'
+GET_METRICS_ENDPOINT = '/metrics/'
+
+
+async def test_search_fulltext_stems_query(client: AsyncClient):
+    response = await client.get(GET_SEARCH_ENDPOINT, params={'q': 'apple'})
+
+    assert response.status_code == 200
+
+    data = response.json()
+
+    assert data['total'] > 0
+    assert data['items'][0]['slug'] == 'apples'
+
+
+async def test_search_fulltext_websearch_syntax(client: AsyncClient):
+    response = await client.get(GET_SEARCH_ENDPOINT, params={'q': 'rice -brown'})
+
+    assert response.status_code == 200
+    assert [item['slug'] for item in response.json()['items']] == ['jasmine-rice']
+
+
+async def test_search_ilike_matches_partial_words(client: AsyncClient):
+    response = await client.get(GET_SEARCH_ENDPOINT, params={'q': 'strawb', 'mode': 'ilike'})
+
+    assert response.status_code == 200
+    assert [item['slug'] for item in response.json()['items']] == ['strawberries']
+
+    response = await client.get(GET_SEARCH_ENDPOINT, params={'q': 'strawb', 'mode': 'fulltext'})
+
+    assert response.status_code == 200
+    assert response.json()['total'] == 0
+
+
+async def test_search_invalid_mode(client: AsyncClient):
+    response = await client.get(GET_SEARCH_ENDPOINT, params={'q': 'apple', 'mode': 'magic'})
+
+    assert response.status_code == 422
+
+
+async def test_search_fuzzy_tolerates_typos(client: AsyncClient):
+    response = await client.get(GET_SEARCH_ENDPOINT, params={'q': 'brocoli', 'mode': 'fuzzy'})
+
+    assert response.status_code == 200
+
+    data = response.json()
+
+    assert data['items'][0]['slug'] == 'broccoli'
+    assert data['total'] == len(data['items'])
+    assert data['suggestions'][0] == 'Broccoli'
+
+
+async def test_search_fuzzy_exact_match_has_no_suggestions(client: AsyncClient):
+    response = await client.get(GET_SEARCH_ENDPOINT, params={'q': 'tomatoes', 'mode': 'fuzzy'})
+
+    assert response.status_code == 200
+
+    data = response.json()
+
+    assert data['items'][0]['slug'] == 'tomatoes'
+    assert 'suggestions' not in data
+
+
+async def test_search_long_query(client: AsyncClient):
+    response = await client.get(GET_SEARCH_ENDPOINT, params={
+        'q': 'fresh local strawberries for a summer fruit salad with friends'
+    })
+
+    assert response.status_code == 200
+
+
+async def test_suggest_product_and_category_names(client: AsyncClient):
+    response = await client.get(GET_SUGGEST_ENDPOINT, params={'q': 'Veg'})
+
+    assert response.status_code == 200
+    assert response.json() == [{'type': 'category', 'name': 'Vegetables', 'slug': 'vegetables'}]
+
+    response = await client.get(GET_SUGGEST_ENDPOINT, params={'q': 'cream', 'limit': 10})
+
+    assert response.status_code == 200
+    assert {'ice-cream', 'whipped-cream'} <= {item['slug'] for item in response.json()}
+
+
+async def test_suggest_no_match(client: AsyncClient):
+    response = await client.get(GET_SUGGEST_ENDPOINT, params={'q': 'xyzzy'})
+
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+async def test_suggest_new_category(client: AsyncClient):
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'jeff.bezos@sjsu.edu',
+        'password': 'superuser'
+    })
+
+    assert response.status_code == 200
+
+    response = await client.post(CREATE_CATEGORY_ENDPOINT, json={
+        'image_url': 'https://allthatsinteresting.com/wordpress/wp-content/uploads/2012/06/iconic-photos-1950-einstein.jpg',
+        'name': 'Mushrooms',
+        'description': 'Fresh mushrooms from local farms',
+    })
+
+    assert response.status_code == 200
+
+    response = await client.get(GET_SUGGEST_ENDPOINT, params={'q': 'mush'})
+
+    assert response.status_code == 200
+    assert [item['slug'] for item in response.json()] == ['mushrooms']
+
+
+async def test_search_facets(client: AsyncClient):
+    response = await client.get(GET_SEARCH_ENDPOINT, params={'q': 'farms', 'facets': True, 'size': 1})
+
+    assert response.status_code == 200
+
+    data = response.json()
+    facets = data['facets']
+
+    assert len(data['items']) == 1
+    assert sum(facet['count'] for facet in facets['categories']) == data['total']
+    assert sum(facet['count'] for facet in facets['price']) == data['total']
+    assert sum(facet['count'] for facet in facets['weight']) == data['total']
+    assert facets['in_stock'] + facets['out_of_stock'] == data['total']
+    assert all(facet['end'] > facet['start'] for facet in facets['price'])
+
+
+async def test_search_filters(client: AsyncClient):
+    response = await client.get(GET_SEARCH_ENDPOINT, params={
+        'q': 'farms',
+        'facets': True,
+        'min_price': 2,
+        'max_price': 3,
+        'in_stock': True,
+    })
+
+    assert response.status_code == 200
+
+    data = response.json()
+
+    assert data['total'] > 0
+    assert all(2 <= item['price'] <= 3 and item['quantity'] > 0 for item in data['items'])
+    assert data['facets']['out_of_stock'] == 0
+
+    category_id = data['items'][0]['category_id']
+
+    response = await client.get(GET_SEARCH_ENDPOINT, params={
+        'q': 'fresh',
+        'mode': 'fuzzy',
+        'facets': True,
+        'category_id': category_id,
+    })
+
+    assert response.status_code == 200
+
+    data = response.json()
+
+    assert all(item['category_id'] == category_id for item in data['items'])
+    assert data['facets']['categories'] == [{'category_id': category_id, 'count': data['total']}]
+
+
+async def test_search_cache(client: AsyncClient):
+    params = {'q': 'Paprika', 'expand': 'category'}
+
+    response = await client.get(GET_SEARCH_ENDPOINT, params=params)
+
+    assert response.status_code == 200
+    assert response.headers['x-cache'] == 'miss'
+
+    product = response.json()['items'][0]
+
+    # normalized queries share the same entry
+    response = await client.get(GET_SEARCH_ENDPOINT, params={**params, 'q': '  paprika '})
+
+    assert response.status_code == 200
+    assert response.headers['x-cache'] == 'hit'
+    assert response.json()['items'][0] == product
+
+    # updating a product invalidates the cache
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'jeff.bezos@sjsu.edu',
+        'password': 'superuser'
+    })
+
+    assert response.status_code == 200
+
+    response = await client.patch(UPDATE_PRODUCT_ENDPOINT.format(id=product['id']), json={
+        'quantity': product['quantity'],
+        'price': product['price'] + 1,
+    })
+
+    assert response.status_code == 200
+
+    response = await client.get(GET_SEARCH_ENDPOINT, params=params)
+
+    assert response.status_code == 200
+    assert response.headers['x-cache'] == 'miss'
+    assert response.json()['items'][0]['price'] == product['price'] + 1
+
+    response = await client.get(GET_METRICS_ENDPOINT)
+
+    assert response.status_code == 200
+    assert response.json()['search_cache']['hits'] >= 1
+    assert response.json()['search_cache']['invalidations'] >= 1
+
+
+async def test_search_bm25(client: AsyncClient):
+    response = await client.get(GET_SEARCH_ENDPOINT, params={'q': 'apple', 'mode': 'bm25', 'expand': 'category'})
+
+    assert response.status_code == 200
+
+    data = response.json()
+
+    assert data['total'] > 0
+    assert data['items'][0]['slug'] == 'apples'
+    assert 'category' in data['items'][0]
+
+    # filters are applied on top of the ranking
+    response = await client.get(GET_SEARCH_ENDPOINT, params={
+        'q': 'apple', 'mode': 'bm25', 'category_id': data['items'][0]['category_id'], 'max_price': 0})
+
+    assert response.status_code == 200
+    assert response.json()['total'] == 0
+
+    response = await client.get(GET_SEARCH_ENDPOINT, params={'q': 'zzzz', 'mode': 'bm25'})
+
+    assert response.status_code == 200
+    assert response.json()['total'] == 0
+
+
+def test_bm25_incremental_updates_match_rebuild():
+    products = [(i, f"product {i} {'apple' if i % 3 else 'pear'}", f"sweet fresh {'pears' if i % 2 else 'apples'}") for i in range(200)]
+
+    index = BM25Index()
+    for product in products:
+        index.add(*product)
+    # replacing every product more than once forces a compaction
+    for product_id, name, description in products + products:
+        index.add(product_id, name + ' organic', description)
+    index.remove(0)
+
+    rebuilt = BM25Index()
+    rebuilt.build([(product_id, name + ' organic', description) for product_id, name, description in products[1:]])
+
+    for q in ['apple', 'pear', 'fresh organic', 'product 7', 'unknown']:
+        assert index.search(q) == rebuilt.search(q)
+    assert len(index) == len(rebuilt) == 199
+    assert index.search('pear')[0] % 3 == 0
+
+
+async def test_catalog_change_from_another_process_is_reindexed(client: AsyncClient):
+    PRODUCT_ID = 64
+
+    async with async_session_factory() as db:
+        product = await db.get(models.Product, PRODUCT_ID)
+        name = product.name
+
+        # another process renamed the product, this one only got the notification
+        product.name = 'Zanzibar Quince'
+        await db.commit()
+
+        await reindex_catalog(db, f'product:{PRODUCT_ID}')
+
+        response = await client.get(GET_SEARCH_ENDPOINT, params={'q': 'zanzibar', 'mode': 'bm25'})
+
+        assert [item['id'] for item in response.json()['items']] == [PRODUCT_ID]
+
+        response = await client.get(GET_SUGGEST_ENDPOINT, params={'q': 'zanz'})
+
+        assert [item['name'] for item in response.json()] == ['Zanzibar Quince']
+
+        product.name = name
+        await db.commit()
+
+        await reindex_catalog(db, f'product:{PRODUCT_ID}')
+
+        response = await client.get(GET_SUGGEST_ENDPOINT, params={'q': 'zanz'})
+
+        assert response.json() == []
+
+
+async def test_metrics_underprivileged(client: AsyncClient):
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'morgan.freemen@sjsu.edu',
+        'password': 'customer'
+    })
+
+    assert response.status_code == 200
+
+    response = await client.get(GET_METRICS_ENDPOINT)
+
+    assert response.status_code == 401
+
+
+async def test_search_with_cursor(client: AsyncClient):
+    for mode in ['fulltext', 'fuzzy', 'ilike', 'bm25']:
+        response = await client.get(GET_SEARCH_ENDPOINT, params={'q': 'fresh', 'mode': mode, 'size': 100})
+
+        assert response.status_code == 200
+
+        expected = [item['slug'] for item in response.json()['items']]
+        slugs = []
+        params = {'q': 'fresh', 'mode': mode, 'size': 7}
+
+        while True:
+            response = await client.get(GET_SEARCH_CURSOR_ENDPOINT, params=params)
+
+            assert response.status_code == 200
+
+            data = response.json()
+            slugs += [item['slug'] for item in data['items']]
+
+            if data.get('next_page') is None:
+                break
+            params['cursor'] = data['next_page']
+
+        assert slugs == expected
+
+
+async def test_search_estimated_total(client: AsyncClient, monkeypatch):
+    params = {'q': 'fresh', 'size': 3}
+
+    response = await client.get(GET_SEARCH_ENDPOINT, params={**params, 'in_stock': True})
+
+    assert response.status_code == 200
+    assert response.json()['total_is_approximate'] is False
+
+    # above the threshold the planner's estimate is returned instead of counting
+    monkeypatch.setattr(search_count, 'threshold', 0)
+
+    response = await client.get(GET_SEARCH_ENDPOINT, params=params)
+
+    assert response.status_code == 200
+
+    data = response.json()
+
+    assert data['total_is_approximate'] is True
+    assert data['total'] > 0
+    assert len(data['items']) == 3
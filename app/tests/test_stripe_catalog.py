@@ -0,0 +1,181 @@
+import itertools
+from types import SimpleNamespace
+
+import stripe
+from app import models
+from app.stripe_catalog import (catalog_hash, is_synced, price_cents,
+                                sync_catalog, sync_product)
+from httpx import AsyncClient
+from sqlalchemy import func, select, update
+
+from .conftest import async_session_factory
+from .test_auth_routes import AUTH_TOKEN_ENDPOINT
+from .test_cart_routes import GET_CART_CHECKOUT, GET_CART_ENDPOINT
+
+
+class StripeCatalogStandIn():
+    def __init__(self):
+        """Serves the `stripe.Product` and `stripe.Price` calls of the catalog sync from memory."""
+        self.calls = []
+        self.failing = set()
+        self._ids = itertools.count(1)
+
+    def install(self, monkeypatch):
+        monkeypatch.setattr(stripe.Product, 'create', classmethod(self.create_product))
+        monkeypatch.setattr(stripe.Product, 'modify', classmethod(self.modify_product))
+        monkeypatch.setattr(stripe.Price, 'create', classmethod(self.create_price))
+        monkeypatch.setattr(stripe.Price, 'modify', classmethod(self.modify_price))
+
+    def create_product(self, cls, idempotency_key=None, **params):
+        self.calls.append(('product.create', None, idempotency_key, params))
+        n = next(self._ids)
+        return SimpleNamespace(id=f'prod_{n}', default_price=f'price_{n}')
+
+    def create_price(self, cls, idempotency_key=None, **params):
+        self.calls.append(('price.create', None, idempotency_key, params))
+        return SimpleNamespace(id=f'price_{next(self._ids)}')
+
+    def modify_product(self, cls, id, idempotency_key=None, **params):
+        self.calls.append(('product.modify', id, idempotency_key, params))
+        if id in self.failing:
+            raise stripe.error.APIError('Something went wrong on our end.')
+        return SimpleNamespace(id=id, **params)
+
+    def modify_price(self, cls, id, idempotency_key=None, **params):
+        self.calls.append(('price.modify', id, idempotency_key, params))
+        return SimpleNamespace(id=id, **params)
+
+
+async def forget_stripe_catalog(db):
+    # the other tests send the products inline
+    await db.execute(update(models.Product).values(
+        stripe_product_id=None, stripe_price_id=None, stripe_unit_amount=None, stripe_hash=None
+    ))
+    await db.commit()
+
+
+def test_catalog_hash():
+    product = models.Product(name='Apple', description='Crisp.', image_url='https://img/apple.png', price=1.99)
+
+    assert price_cents(product.price) == 199
+    assert catalog_hash(product) == catalog_hash(models.Product(
+        name='Apple', description='Crisp.', image_url='https://img/apple.png', price=1.99
+    ))
+    assert not is_synced(product)
+
+    product.stripe_price_id = 'price_apple'
+    product.stripe_hash = catalog_hash(product)
+
+    assert is_synced(product)
+
+    # any detail stripe shows makes it stale
+    product.price = 2.49
+
+    assert not is_synced(product)
+
+
+async def test_sync_catalog(monkeypatch):
+    stand_in = StripeCatalogStandIn()
+    stand_in.install(monkeypatch)
+
+    async with async_session_factory() as db:
+        count = (await db.execute(select(func.count()).select_from(models.Product))).scalar_one()
+
+        # the whole catalog is created, a batch at a time
+        assert await sync_catalog(db, batch_size=7) == (count, 0)
+        assert [call[0] for call in stand_in.calls] == ['product.create'] * count
+        assert all(key.startswith('catalog-product:') for _, _, key, _ in stand_in.calls)
+
+        # nothing changed, nothing is sent
+        stand_in.calls.clear()
+
+        assert await sync_catalog(db, batch_size=7) == (0, 0)
+        assert stand_in.calls == []
+
+        repriced, renamed = (await db.execute(
+            select(models.Product).order_by(models.Product.id).limit(2)
+        )).scalars().all()
+        old_price_id = repriced.stripe_price_id
+        repriced.price = repriced.price + 1
+        renamed.name = renamed.name + ' (organic)'
+        await db.commit()
+
+        stand_in.failing.add(renamed.stripe_product_id)
+
+        assert await sync_catalog(db, batch_size=7) == (1, 1)
+
+        assert all(key is not None for _, _, key, _ in stand_in.calls)
+
+        # a new price becomes the default before the old one is archived
+        calls = [call for call in stand_in.calls if call[1] != renamed.stripe_product_id]
+
+        assert [(name, id) for name, id, _, _ in calls] == [
+            ('price.create', None),
+            ('product.modify', repriced.stripe_product_id),
+            ('price.modify', old_price_id),
+        ]
+
+        _, _, _, modified = calls[1]
+        _, _, _, archived = calls[2]
+
+        assert modified['default_price'] == repriced.stripe_price_id != old_price_id
+        assert archived == {'active': False}
+        assert repriced.stripe_unit_amount == price_cents(repriced.price)
+        assert is_synced(repriced)
+
+        # the failed product is retried next time, its price didn't change
+        assert not is_synced(renamed)
+
+        stand_in.failing.clear()
+        stand_in.calls.clear()
+
+        assert await sync_catalog(db, batch_size=7) == (1, 0)
+        assert [(name, id) for name, id, _, _ in stand_in.calls] == [('product.modify', renamed.stripe_product_id)]
+        assert is_synced(renamed)
+
+        await forget_stripe_catalog(db)
+
+
+async def test_checkout_sends_synced_prices(client: AsyncClient, monkeypatch):
+    SYNCED_PRODUCT_ID = 62
+    INLINE_PRODUCT_ID = 63
+
+    StripeCatalogStandIn().install(monkeypatch)
+    sessions = []
+
+    def create_session(cls, **params):
+        sessions.append(params)
+        return SimpleNamespace(id=f'cs_catalog_{len(sessions)}', url='https://checkout.stripe.com/c/pay/cs_catalog')
+
+    monkeypatch.setattr(stripe.checkout.Session, 'create', classmethod(create_session))
+
+    async with async_session_factory() as db:
+        synced = await db.get(models.Product, SYNCED_PRODUCT_ID)
+        await sync_product(synced)
+        await db.commit()
+
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'morgan.freemen@sjsu.edu',
+        'password': 'customer'
+    })
+    for product_id in (SYNCED_PRODUCT_ID, INLINE_PRODUCT_ID):
+        response = await client.post(GET_CART_ENDPOINT, json={'product_id': product_id, 'quantity': 1})
+
+        assert response.status_code == 200
+
+    inline_name = response.json()['product']['name']
+
+    response = await client.post(GET_CART_CHECKOUT)
+
+    assert response.status_code == 200
+
+    line_items = sessions[-1]['line_items']
+
+    assert {'price': synced.stripe_price_id, 'quantity': 1} in line_items
+    assert any(
+        'price_data' in line_item and line_item['price_data']['product_data']['name'] == inline_name
+        for line_item in line_items
+    )
+
+    async with async_session_factory() as db:
+        await forget_stripe_catalog(db)
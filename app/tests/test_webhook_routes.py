@@ -0,0 +1,326 @@
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import stripe
+from app import models
+from app.inventory import release_expired_reservations
+from app.stripe_events import (EVENTS_CURSOR, process_stripe_events,
+                               prune_stripe_events, reconcile_stripe_events,
+                               settle_expired_checkouts)
+from httpx import AsyncClient
+from sqlalchemy import delete, select, update
+
+from .conftest import async_session_factory
+from .test_auth_routes import AUTH_TOKEN_ENDPOINT
+from .test_cart_routes import GET_CART_ENDPOINT
+from .test_order_routes import GET_ORDERS_ENDPOINT
+
+STRIPE_WEBHOOK_ENDPOINT = '/webhook/stripe/'
+
+
+def checkout_completed_event(event_id: str, order_id: int) -> dict:
+    return {
+        'id': event_id,
+        'type': 'checkout.session.completed',
+        'data': {
+            'object': {
+                'id': f'cs_{event_id}',
+                'metadata': {'order_id': str(order_id)},
+                'payment_intent': f'pi_{event_id}',
+                'amount_total': 2599,
+                'amount_subtotal': 2000,
+                'total_details': {'amount_tax': 0, 'amount_shipping': 599},
+                'shipping_details': {
+                    'address': {
+                        'line1': '1 Washington Sq',
+                        'line2': None,
+                        'city': 'San Jose',
+                        'state': 'CA',
+                        'postal_code': '95192',
+                        'country': 'US',
+                    },
+                },
+            },
+        },
+    }
+
+
+async def test_stripe_webhook_checkout_completed(client: AsyncClient):
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'amy.dyken@sjsu.edu',
+        'password': 'employee'
+    })
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': 15, 'quantity': 2})
+
+    assert response.status_code == 200
+
+    order_id = (await client.get(GET_CART_ENDPOINT)).json()['id']
+    past_orders = (await client.get(GET_ORDERS_ENDPOINT)).json()['total']
+
+    response = await client.post(STRIPE_WEBHOOK_ENDPOINT, json=checkout_completed_event('evt_completed', order_id))
+    await client.post(STRIPE_WEBHOOK_ENDPOINT, json={'id': 'evt_other', 'type': 'customer.created', 'data': {'object': {}}})
+
+    assert response.status_code == 200
+
+    # the event is only stored when stripe is answered
+    async with async_session_factory() as db:
+        order = await db.get(models.Order, order_id)
+
+        assert order.status == models.OrderStatus.CART
+
+        assert await process_stripe_events(db, 100) == 2
+        await db.commit()
+
+    async with async_session_factory() as db:
+        order = await db.get(models.Order, order_id)
+
+        assert order.status == models.OrderStatus.ORDERED
+        assert order.stripe_id == 'pi_evt_completed'
+        assert order.amount_total == 25.99
+        assert order.amount_shipping == 5.99
+        assert order.address == '1 Washington Sq, San Jose'
+        assert all(item.reserved_until is None for item in order.items)
+
+        events = (await db.execute(select(models.StripeEvent))).scalars().all()
+
+        assert all(event.processed_at is not None for event in events)
+
+        geocode = (await db.execute(delete(models.Job).where(
+            models.Job.task == 'geocode_order'
+        ).returning(models.Job.payload))).scalars().all()
+        await db.commit()
+
+        assert geocode == [{'order_id': order_id, 'address': '1 Washington Sq, San Jose, CA, 95192, US'}]
+
+        assert await process_stripe_events(db, 100) == 0
+
+    # the order is counted right away, by every process
+    assert (await client.get(GET_ORDERS_ENDPOINT)).json()['total'] == past_orders + 1
+
+
+async def test_stripe_webhook_duplicate_events(client: AsyncClient):
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'amy.dyken@sjsu.edu',
+        'password': 'employee'
+    })
+    response = await client.post(GET_CART_ENDPOINT, json={'product_id': 16, 'quantity': 1})
+
+    assert response.status_code == 200
+
+    order_id = (await client.get(GET_CART_ENDPOINT)).json()['id']
+    event = checkout_completed_event('evt_duplicate', order_id)
+
+    # a redelivery to the same process isn't stored again
+    for _ in range(2):
+        response = await client.post(STRIPE_WEBHOOK_ENDPOINT, json=event)
+
+        assert response.status_code == 200
+
+    async with async_session_factory() as db:
+        stored = (await db.execute(select(models.StripeEvent).where(
+            models.StripeEvent.event_id == 'evt_duplicate'
+        ))).scalars().all()
+
+        assert len(stored) == 1
+
+        assert await process_stripe_events(db, 100) == 1
+        await db.commit()
+
+        # a redelivery stored by another process is skipped before any order work
+        await db.execute(update(models.Order).where(models.Order.id == order_id).values(
+            status=models.OrderStatus.CART
+        ))
+        db.add(models.StripeEvent(event_id='evt_duplicate', type=event['type'], payload=event))
+        await db.commit()
+
+        assert await process_stripe_events(db, 100) == 1
+        await db.commit()
+
+        order = (await db.execute(select(models.Order).where(models.Order.id == order_id).execution_options(
+            populate_existing=True
+        ))).scalars().first()
+
+        assert order.status == models.OrderStatus.CART
+
+        # restore the order and drop its geocoding job
+        order.status = models.OrderStatus.ORDERED
+        await db.execute(delete(models.Job).where(models.Job.task == 'geocode_order'))
+        await db.commit()
+
+        # processed events are forgotten once they are old enough
+        await prune_stripe_events(db, datetime.utcnow() + timedelta(days=1), 1000)
+        await db.commit()
+
+        assert (await db.execute(select(models.StripeEvent))).scalars().all() == []
+        assert (await db.execute(select(models.ProcessedStripeEvent))).scalars().all() == []
+
+
+class StripeEventsStandIn():
+    def __init__(self):
+        """Serves `stripe.Event.list` from memory, newest first and paginated like the API."""
+        self.events = []
+        self.calls = []
+
+    def add(self, event: dict):
+        self.events.append({**event, 'created': int(time.time())})
+
+    def list(self, cls, types=None, created=None, ending_before=None, starting_after=None, limit=10):
+        self.calls.append({'ending_before': ending_before, 'starting_after': starting_after})
+        events = [
+            event for event in reversed(self.events)
+            if (types is None or event['type'] in types)
+            and (created is None or event['created'] >= created['gte'])
+        ]
+        ids = [event['id'] for event in events]
+
+        if ending_before is not None:
+            end = ids.index(ending_before)
+            page = events[max(end - limit, 0):end]
+            has_more = end - limit > 0
+        else:
+            start = ids.index(starting_after) + 1 if starting_after is not None else 0
+            page = events[start:start + limit]
+            has_more = start + limit < len(events)
+
+        def auto_paging_iter():
+            yield from page
+            if has_more:
+                yield from self.list(cls, types, created, starting_after=page[-1]['id'], limit=limit).auto_paging_iter()
+
+        return SimpleNamespace(data=page, has_more=has_more, auto_paging_iter=auto_paging_iter)
+
+
+async def test_reconcile_missed_stripe_events(client: AsyncClient, monkeypatch):
+    stand_in = StripeEventsStandIn()
+    monkeypatch.setattr(stripe.Event, 'list', classmethod(stand_in.list))
+
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'amy.dyken@sjsu.edu',
+        'password': 'employee'
+    })
+    await client.post(GET_CART_ENDPOINT, json={'product_id': 17, 'quantity': 1})
+    first_order_id = (await client.get(GET_CART_ENDPOINT)).json()['id']
+
+    stand_in.add(checkout_completed_event('evt_missed_1', first_order_id))
+    stand_in.add({'id': 'evt_missed_other', 'type': 'customer.created', 'data': {'object': {}}})
+
+    since = datetime.utcnow() - timedelta(days=1)
+
+    # the first run walks back to `since`
+    async with async_session_factory() as db:
+        assert await reconcile_stripe_events(db, 2, since) == 1
+        await db.commit()
+
+        order = await db.get(models.Order, first_order_id)
+
+        assert order.status == models.OrderStatus.ORDERED
+        assert (await db.get(models.StripeCursor, EVENTS_CURSOR)).object_id == 'evt_missed_1'
+
+    await client.post(GET_CART_ENDPOINT, json={'product_id': 18, 'quantity': 1})
+    second_order_id = (await client.get(GET_CART_ENDPOINT)).json()['id']
+
+    for i in range(2, 5):
+        stand_in.add(checkout_completed_event(f'evt_missed_{i}', second_order_id))
+
+    # the next runs resume from the cursor, a page at a time
+    stand_in.calls.clear()
+    async with async_session_factory() as db:
+        assert await reconcile_stripe_events(db, 2, since) == 2
+        await db.commit()
+        assert await reconcile_stripe_events(db, 2, since) == 1
+        await db.commit()
+        assert await reconcile_stripe_events(db, 2, since) == 0
+        await db.commit()
+
+        assert [call['ending_before'] for call in stand_in.calls] == ['evt_missed_1', 'evt_missed_3', 'evt_missed_4']
+
+        order = await db.get(models.Order, second_order_id)
+
+        assert order.status == models.OrderStatus.ORDERED
+        assert order.stripe_id == 'pi_evt_missed_2'
+
+        await db.execute(delete(models.Job).where(models.Job.task == 'geocode_order'))
+        await db.commit()
+
+
+async def test_checkout_completed_after_the_hold_expired(client: AsyncClient, monkeypatch):
+    def expire(cls, session_id):
+        if session_id == 'cs_late':
+            raise stripe.error.InvalidRequestError('Only open sessions can be expired.', None)
+        return {'id': session_id, 'status': 'expired'}
+
+    def retrieve(cls, session_id):
+        return {**checkout_completed_event('late', order_id)['data']['object'], 'status': 'complete'}
+
+    monkeypatch.setattr(stripe.checkout.Session, 'expire', classmethod(expire))
+    monkeypatch.setattr(stripe.checkout.Session, 'retrieve', classmethod(retrieve))
+
+    response = await client.post(AUTH_TOKEN_ENDPOINT, data={
+        'username': 'jeff.bezos@sjsu.edu',
+        'password': 'superuser'
+    })
+    item = (await client.post(GET_CART_ENDPOINT, json={'product_id': 60, 'quantity': 1})).json()
+    order_id = (await client.get(GET_CART_ENDPOINT)).json()['id']
+    stock = item['product']['quantity']
+
+    async with async_session_factory() as db:
+        await db.execute(update(models.OrderItem).where(models.OrderItem.id == item['id']).values(
+            reserved_until=datetime.utcnow() - timedelta(minutes=1)
+        ))
+        # a pending event may be the cart's completion
+        event = models.StripeEvent(event_id='evt_pending', type='checkout.session.completed',
+                                   payload=checkout_completed_event('evt_pending', order_id))
+        db.add(event)
+        await db.commit()
+
+        await release_expired_reservations(db, 500)
+        await db.commit()
+
+        assert await db.get(models.OrderItem, item['id']) is not None
+
+        # and so may the checkout session, until stripe expired it
+        await db.delete(event)
+        await db.execute(update(models.Order).where(models.Order.id == order_id).values(
+            checkout_session_id='cs_late'
+        ))
+        await db.commit()
+
+        await release_expired_reservations(db, 500)
+        await db.commit()
+
+        assert await db.get(models.OrderItem, item['id']) is not None
+
+        # the session was paid after the hold ran out, the items stay with the order
+        assert await settle_expired_checkouts(db, 100) == 1
+
+        order = (await db.execute(select(models.Order).where(models.Order.id == order_id).execution_options(
+            populate_existing=True
+        ))).scalars().first()
+
+        assert order.status == models.OrderStatus.ORDERED
+        assert [(i.id, i.reserved_until) for i in order.items] == [(item['id'], None)]
+        assert (await db.get(models.Product, 60)).quantity == stock
+
+        await db.execute(delete(models.Job).where(models.Job.task == 'geocode_order'))
+        await db.commit()
+
+    item = (await client.post(GET_CART_ENDPOINT, json={'product_id': 61, 'quantity': 1})).json()
+    order_id = (await client.get(GET_CART_ENDPOINT)).json()['id']
+
+    async with async_session_factory() as db:
+        await db.execute(update(models.OrderItem).where(models.OrderItem.id == item['id']).values(
+            reserved_until=datetime.utcnow() - timedelta(minutes=1)
+        ))
+        await db.execute(update(models.Order).where(models.Order.id == order_id).values(
+            checkout_session_id='cs_unpaid'
+        ))
+        await db.commit()
+
+        # an unpaid session is expired, then the cart loses its items
+        assert await settle_expired_checkouts(db, 100) == 1
+        assert await release_expired_reservations(db, 500) >= 1
+        await db.commit()
+
+        assert await db.get(models.OrderItem, item['id']) is None
+        assert (await db.get(models.Order, order_id)).checkout_session_id is None
@@ -11,7 +11,9 @@ sys.path.append(APP_DIR)
 
 from app.environ import STRIPE_PRIVATE_KEY  # noqa
 from manage.database import db_app  # noqa
+from manage.inventory import inventory_app  # noqa
 from manage.stripe_utils import stripe_app  # noqa
+from manage.worker import worker  # noqa
 
 stripe.api_key = STRIPE_PRIVATE_KEY
 
@@ -19,6 +21,8 @@ app = typer.Typer(help="A colletion of commands to help with development.")
 
 app.add_typer(db_app, name="db")
 app.add_typer(stripe_app, name="stripe")
+app.add_typer(inventory_app, name="inventory")
+app.command()(worker)
 
 if __name__ == "__main__":
     app()
@@ -1,9 +1,14 @@
+from datetime import datetime, timedelta
+
 import stripe
 from typer import Option, Typer
 
 from app.database import async_session_factory
+from app.environ import ABANDONED_CART_DAYS, CART_SWEEP_BATCH_SIZE
+from app.inventory import delete_abandoned_carts, refresh_cart_totals
 from app.models import (Category, Order, OrderItem, OrderStatus, Product, User,
                         create_all_tables)
+from app.search.cache import notify_catalog_changed
 from app.security import pwd_context
 from manage.utils import coro
 
@@ -759,6 +764,10 @@ async def populate_database(session_factory):
         ]
 
         session.add_all(past_orders)
+        await refresh_cart_totals(session)
+
+        # let the running app know the catalog was reloaded
+        await notify_catalog_changed(session)
         await session.commit()
         
         
@@ -769,3 +778,24 @@ async def populate_database(session_factory):
 async def populate():
     """Populate the database with default data"""
     await populate_database(async_session_factory)
+
+
+@db_app.command()
+@coro
+async def sweep(
+    days: float = Option(ABANDONED_CART_DAYS, "--days", "-d", min=0,
+                         help="How many days a cart must be untouched to be deleted."),
+    batch_size: int = Option(CART_SWEEP_BATCH_SIZE, "--batch-size", "-b", min=1,
+                             help="The number of carts deleted per transaction."),
+):
+    """Delete the abandoned carts and give their stock back. The app does it periodically."""
+    older_than = datetime.utcnow() - timedelta(days=days)
+    total = 0
+    while True:
+        async with async_session_factory() as db:
+            deleted = await delete_abandoned_carts(db, older_than, batch_size)
+            await db.commit()
+        total += deleted
+        if deleted < batch_size:
+            break
+    print(f"Deleted {total} abandoned carts.")
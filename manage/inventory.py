@@ -0,0 +1,139 @@
+import asyncio
+import time
+
+from sqlalchemy import delete, select
+from typer import Argument, Option, Typer
+
+from app.database import async_session_factory
+from app.environ import RESERVATION_SWEEP_BATCH_SIZE
+from app.inventory import (add_cart_item, reconcile_stock_shards,
+                           refresh_cart_totals, release_expired_reservations,
+                           set_stock_shards)
+from app.models import Order, OrderItem, OrderStatus, Product, User
+from app.stripe_events import settle_expired_checkouts
+from manage.utils import coro
+
+inventory_app = Typer(
+    help="A collection of commands to manage the stock of high contention products."
+)
+
+
+@inventory_app.command()
+@coro
+async def shard(
+    product_id: int = Argument(..., help="The product's ID."),
+    shards: int = Argument(..., min=0, help="The number of shards to spread the stock over, 0 to disable sharding."),
+):
+    """Spread the stock of a product over several rows so concurrent carts don't wait on each other."""
+    async with async_session_factory() as db:
+        quantity = await set_stock_shards(db, product_id, shards)
+        await db.commit()
+
+    if quantity is None:
+        print(f"Product {product_id} not found.")
+    elif shards:
+        print(f"Spread {quantity} units of product {product_id} over {shards} shards.")
+    else:
+        print(f"Moved {quantity} units of product {product_id} back onto the product.")
+
+
+@inventory_app.command()
+@coro
+async def reconcile():
+    """Copy the stock of the sharded products back into their quantity. The app does it periodically."""
+    async with async_session_factory() as db:
+        reconciled = await reconcile_stock_shards(db)
+        await db.commit()
+    print(f"Reconciled the sharded stock of {reconciled} products.")
+
+
+@inventory_app.command()
+@coro
+async def release(
+    batch_size: int = Option(RESERVATION_SWEEP_BATCH_SIZE, "--batch-size", "-b", min=1,
+                             help="The number of cart items released per transaction."),
+):
+    """Give back the stock of the cart items whose hold expired. The app does it periodically."""
+    async with async_session_factory() as db:
+        settled = await settle_expired_checkouts(db, batch_size)
+    print(f"Settled the checkout sessions of {settled} carts.")
+
+    total = 0
+    while True:
+        async with async_session_factory() as db:
+            released = await release_expired_reservations(db, batch_size)
+            await db.commit()
+        total += released
+        if released < batch_size:
+            break
+    print(f"Released {total} expired cart items.")
+
+
+@inventory_app.command()
+@coro
+async def totals():
+    """Recompute the item count, subtotal and weight of every cart from its items."""
+    async with async_session_factory() as db:
+        await refresh_cart_totals(db)
+        await db.commit()
+    print("Refreshed the cart totals.")
+
+
+async def _reserve(cart_ids, product_id: int, reservations: int) -> float:
+    async def worker(cart_id: int, count: int):
+        for _ in range(count):
+            async with async_session_factory() as db:
+                await add_cart_item(db, cart_id, product_id, 1)
+                await db.commit()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        worker(cart_id, reservations // len(cart_ids) + (i < reservations % len(cart_ids)))
+        for i, cart_id in enumerate(cart_ids)
+    ])
+    return time.perf_counter() - start
+
+
+@inventory_app.command()
+@coro
+async def benchmark(
+    product_id: int = Argument(..., help="The product to reserve."),
+    shards: int = Option(8, "--shards", "-s", min=1, help="The number of shards of the sharded run."),
+    concurrency: int = Option(10, "--concurrency", "-c", min=1,
+                              help="The number of concurrent carts. Keep it within the connection pool (15)."),
+    reservations: int = Option(1000, "--reservations", "-n", min=1, help="The number of units reserved per run."),
+):
+    """Compare the throughput of concurrent reservations of a product with and without sharding.
+
+    Uses temporary orders and restores the product's stock afterwards, don't run it against production.
+    """
+    async with async_session_factory() as db:
+        product = (await db.execute(select(Product).where(Product.id == product_id))).scalars().first()
+        if product is None:
+            print(f"Product {product_id} not found.")
+            return
+
+        original_shards = product.stock_shards
+        original_quantity = await set_stock_shards(db, product_id, original_shards)
+
+        user_id = (await db.execute(select(User.id).limit(1))).scalar_one()
+        orders = [Order(user_id=user_id, status=OrderStatus.ORDERED) for _ in range(concurrency)]
+        db.add_all(orders)
+        await db.commit()
+        cart_ids = [order.id for order in orders]
+
+    try:
+        for run_shards in [0, shards]:
+            async with async_session_factory() as db:
+                await set_stock_shards(db, product_id, run_shards, reservations)
+                await db.commit()
+
+            elapsed = await _reserve(cart_ids, product_id, reservations)
+            label = f"{run_shards} shards" if run_shards else "single row"
+            print(f"{label:>12}: {reservations / elapsed:8.1f} reservations/s ({elapsed:.2f}s)")
+    finally:
+        async with async_session_factory() as db:
+            await db.execute(delete(OrderItem).where(OrderItem.order_id.in_(cart_ids)))
+            await db.execute(delete(Order).where(Order.id.in_(cart_ids)))
+            await set_stock_shards(db, product_id, original_shards, original_quantity)
+            await db.commit()
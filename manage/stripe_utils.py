@@ -1,10 +1,17 @@
+from datetime import datetime, timedelta
 from typing import Optional
 
 import stripe
+from app import stripe_catalog
+from app.database import async_session_factory
+from app.environ import STRIPE_MAX_WORKERS, STRIPE_RECONCILE_LOOKBACK_DAYS
+from app.stripe_events import RECONCILE_PAGE_SIZE, reconcile_stripe_events
 from app.stripe_config import (StripeShippingRateError, load_shipping_rates,
                                shipping_rates)
 from typer import Option, Typer
 
+from manage.utils import coro
+
 stripe_app = Typer(
     help="A collection of commands to help with Stripe.")
 
@@ -79,7 +86,8 @@ shipping_options = [
 
 
 @stripe_app.command()
-def setup(
+@coro
+async def setup(
     api_key: Optional[str] = Option(
         None, 
         help="Use to configure on another Stripe Account, in production for example."
@@ -91,7 +99,7 @@ def setup(
         stripe.api_key = api_key
 
     try:
-        load_shipping_rates()
+        await load_shipping_rates()
         print('Shipping options already loaded.')
     except StripeShippingRateError:
         for shipping_option in shipping_options:
@@ -100,3 +108,45 @@ def setup(
                 shipping_rates[shipping_type] = stripe.ShippingRate.create(**shipping_option)
                 print(f"Created shipping option: {shipping_type}")              
         print('Shipping options loaded.')
+
+
+@stripe_app.command()
+@coro
+async def sync_catalog(
+    concurrency: int = Option(STRIPE_MAX_WORKERS, "--concurrency", "-c", min=1,
+                              help="The number of products synced at once."),
+    batch_size: int = Option(100, "--batch-size", "-b", min=1,
+                             help="The number of products compared and committed at once."),
+    force: bool = Option(False, "--force", "-f", help="Sync every product, even the unchanged ones."),
+):
+    """Create or update the Stripe Product and Price of every product changed since the last sync."""
+    async with async_session_factory() as db:
+        synced, failed = await stripe_catalog.sync_catalog(db, concurrency, batch_size, force)
+
+    print(f"Synced {synced} products to Stripe.")
+    if failed:
+        print(f"{failed} products failed, run the command again to retry them.")
+
+
+@stripe_app.command()
+@coro
+async def reconcile(
+    page_size: int = Option(RECONCILE_PAGE_SIZE, "--page-size", "-p", min=1, max=RECONCILE_PAGE_SIZE,
+                            help="The number of events fetched and applied per transaction."),
+    lookback_days: float = Option(STRIPE_RECONCILE_LOOKBACK_DAYS, "--lookback-days", "-l", min=0,
+                                  help="How far back the first reconciliation looks."),
+):
+    """Apply the Stripe events the webhook missed, from where the last reconciliation stopped. The app does it periodically."""
+    since = datetime.utcnow() - timedelta(days=lookback_days)
+    total = 0
+    while True:
+        async with async_session_factory() as db:
+            fetched = await reconcile_stripe_events(db, page_size, since)
+            await db.commit()
+        if fetched is None:
+            print("Another reconciliation is running, try again later.")
+            return
+        total += fetched
+        if fetched < page_size:
+            break
+    print(f"Went through {total} Stripe events.")
@@ -0,0 +1,20 @@
+import asyncio
+
+from typer import Option
+
+from app.environ import JOB_BATCH_SIZE, JOB_POLL_INTERVAL_SECONDS
+from app.jobs import job_queue
+from manage.utils import coro
+
+
+@coro
+async def worker(
+    workers: int = Option(4, "--workers", "-w", min=1, help="The number of jobs run at once."),
+    batch_size: int = Option(JOB_BATCH_SIZE, "--batch-size", "-b", min=1,
+                             help="The number of jobs a worker claims at once."),
+    poll_interval: float = Option(JOB_POLL_INTERVAL_SECONDS, "--poll-interval", "-p", min=0.1,
+                                  help="The seconds between polls of an empty queue."),
+):
+    """Run the background jobs until interrupted, alongside or instead of the app's own workers ($JOB_WORKERS)."""
+    print(f"Running the background jobs with {workers} workers.")
+    await asyncio.gather(*(job_queue.work(batch_size, poll_interval) for _ in range(workers)))